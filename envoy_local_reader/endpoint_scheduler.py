@@ -0,0 +1,55 @@
+import time
+
+
+class EndpointScheduler:
+    """
+    Keeps track of when every endpoint of the Envoy was fetched and decides which endpoints are due in a poll.
+
+    Every endpoint has its own refresh interval in seconds, endpoints without an interval are fetched on
+    every poll. The reader is polled at the shortest interval, an endpoint is due on the poll closest to
+    its due time so a slow poll never pushes an endpoint a whole poll interval back.
+    """
+
+    def __init__(self, intervals, clock=time.monotonic):
+        self.intervals = dict(intervals)
+        self.clock = clock
+        self._last_fetched = dict()
+
+    @property
+    def poll_interval(self):
+        """
+        The interval in seconds the reader has to be polled at, this is the shortest endpoint interval
+        """
+        return min(self.intervals.values()) if len(self.intervals) > 0 else 0
+
+    def now(self):
+        return self.clock()
+
+    def due(self, url_paths, now=None):
+        """
+        :param url_paths: the url paths needed for a complete snapshot
+        :param now: the time of the poll, defaults to the current time of the clock
+        :return: list with the url paths that have to be fetched in this poll
+        """
+        if now is None:
+            now = self.clock()
+        slack = self.poll_interval / 2
+        return [url_path for url_path in url_paths
+                if url_path not in self._last_fetched
+                or now - self._last_fetched[url_path] + slack >= self.intervals.get(url_path, 0)]
+
+    def mark_fetched(self, url_paths, fetched_at):
+        for url_path in url_paths:
+            self._last_fetched[url_path] = fetched_at
+
+    def last_fetched(self, url_path):
+        return self._last_fetched.get(url_path)
+
+    def invalidate(self, url_path=None):
+        """
+        Make one or, when no url path is given, all endpoints due in the next poll
+        """
+        if url_path is None:
+            self._last_fetched.clear()
+        else:
+            self._last_fetched.pop(url_path, None)
@@ -0,0 +1,93 @@
+import asyncio
+import gzip
+import hashlib
+import json
+
+
+class CapturedResponse:
+    """
+    One recorded response of an Envoy
+    """
+
+    def __init__(self, timestamp, url_path, status, latency, content):
+        self.timestamp = timestamp
+        self.url_path = url_path
+        self.status = status
+        self.latency = latency
+        self.content = content
+
+
+class EnvoyCapture:
+    """
+    Records the raw responses of an EnvoyReader, ie. to replay a real day of an Envoy against the mock Envoy.
+
+    The archive is a gzip file with a JSON line per response: the wall clock time, the url path, the status
+    code, the latency in seconds and the body. A body that is already in the archive is stored as a reference to
+    it, so the unchanged responses of the inventory and the inverters hardly take space.
+
+    record() only buffers the response, flush() appends the buffered responses in an executor so the event loop
+    is not blocked by the compression. Every flush adds a gzip member, a capture that is cut off loses at most
+    the responses of the last refresh.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._pending = []
+        self._bodies = set()
+        self._lock = None
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def record(self, url_path, timestamp, latency, status, content):
+        """
+        :param timestamp: the time.time() the request was sent
+        :param latency: the seconds until the response was received
+        :param content: the raw response body
+        """
+        self._pending.append(CapturedResponse(timestamp, url_path, status, latency, content))
+
+    async def flush(self):
+        """
+        Append the buffered responses to the archive
+        """
+        if len(self._pending) == 0:
+            return
+        responses, self._pending = self._pending, []
+        async with self.lock:
+            await asyncio.get_event_loop().run_in_executor(None, self.__write, responses)
+
+    def __write(self, responses):
+        lines = []
+        for response in responses:
+            body_id = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+            entry = {"t": response.timestamp, "url": response.url_path, "status": response.status,
+                     "latency": round(response.latency, 6), "body_id": body_id}
+            if body_id not in self._bodies:
+                self._bodies.add(body_id)
+                # latin-1 maps every byte to one character, so any body survives the JSON round trip unchanged
+                entry["body"] = response.content.decode("latin-1")
+            lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+        with gzip.open(self.path, "at", encoding="utf-8") as file:
+            file.write("".join(lines))
+
+    @staticmethod
+    def read(path):
+        """
+        :param path: the path of an archive written by EnvoyCapture
+        :return: list with the CapturedResponse of the archive, ordered by timestamp
+        """
+        bodies = dict()
+        responses = []
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                if "body" in entry:
+                    bodies[entry["body_id"]] = entry["body"].encode("latin-1")
+                responses.append(CapturedResponse(entry["t"], entry["url"], entry["status"], entry["latency"],
+                                                  bodies[entry["body_id"]]))
+        responses.sort(key=lambda response: response.timestamp)
+        return responses
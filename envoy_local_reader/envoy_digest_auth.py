@@ -0,0 +1,116 @@
+import hashlib
+import os
+import re
+from urllib.request import parse_http_list
+
+import httpx
+
+
+class EnvoyDigestAuth(httpx.Auth):
+    """
+    Digest authentication that remembers the last challenge of the Envoy.
+
+    httpx.DigestAuth sends every request unauthenticated first and only answers the 401 challenge
+    afterwards, so every request costs two round trips. This implementation keeps the nonce of the
+    last challenge and sends the next requests pre-authorized with an incremented nonce count.
+    A new challenge round trip is only made when the Envoy rejects the nonce (ie. it became stale).
+    """
+
+    HASH_FUNCTIONS = {
+        "MD5": hashlib.md5,
+        "MD5-SESS": hashlib.md5,
+        "SHA-256": hashlib.sha256,
+        "SHA-256-SESS": hashlib.sha256,
+    }
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.challenge = None
+        self.nonce_count = 0
+
+    def auth_flow(self, request):
+        if self.challenge is not None:
+            request.headers["Authorization"] = self.__build_auth_header(request)
+
+        response = yield request
+
+        if response.status_code != 401 or "www-authenticate" not in response.headers:
+            return
+
+        # No challenge known yet or the nonce was rejected, answer the new challenge
+        challenge = self.parse_challenge(response.headers["www-authenticate"])
+        if challenge is None:
+            return
+        self.challenge = challenge
+        self.nonce_count = 0
+        request.headers["Authorization"] = self.__build_auth_header(request)
+        yield request
+
+    def reset(self):
+        """
+        Forget the cached challenge, the next request will do a full challenge round trip again
+        """
+        self.challenge = None
+        self.nonce_count = 0
+
+    @staticmethod
+    def parse_challenge(header):
+        """
+        Parse a WWW-Authenticate header into a dict with the challenge fields
+        :param header: the WWW-Authenticate header value
+        :return: dict with the challenge fields or None when it is not a (valid) Digest challenge
+        """
+        scheme, _, fields = header.partition(" ")
+        if scheme.lower() != "digest":
+            return None
+
+        challenge = dict()
+        for field in parse_http_list(fields):
+            key, _, value = field.strip().partition("=")
+            challenge[key.lower()] = value.strip('"')
+
+        if "realm" not in challenge or "nonce" not in challenge:
+            return None
+        return challenge
+
+    def __build_auth_header(self, request):
+        challenge = self.challenge
+        algorithm = challenge.get("algorithm", "MD5").upper()
+        hash_func = self.HASH_FUNCTIONS.get(algorithm, hashlib.md5)
+
+        def digest(data):
+            return hash_func(data.encode()).hexdigest()
+
+        self.nonce_count += 1
+        nc_value = "%08x" % self.nonce_count
+        cnonce = hashlib.sha1(os.urandom(8)).hexdigest()[:16]
+        nonce = challenge["nonce"]
+        path = request.url.full_path
+
+        ha1 = digest("{}:{}:{}".format(self.username, challenge["realm"], self.password))
+        if algorithm.endswith("-SESS"):
+            ha1 = digest("{}:{}:{}".format(ha1, nonce, cnonce))
+        ha2 = digest("{}:{}".format(request.method, path))
+
+        qop = self.__resolve_qop(challenge.get("qop"))
+        if qop is None:
+            response = digest("{}:{}:{}".format(ha1, nonce, ha2))
+        else:
+            response = digest("{}:{}:{}:{}:{}:{}".format(ha1, nonce, nc_value, cnonce, qop, ha2))
+
+        header = 'Digest username="{}", realm="{}", nonce="{}", uri="{}", response="{}", algorithm={}'.format(
+            self.username, challenge["realm"], nonce, path, response, algorithm)
+        if "opaque" in challenge:
+            header += ', opaque="{}"'.format(challenge["opaque"])
+        if qop is not None:
+            header += ', qop={}, nc={}, cnonce="{}"'.format(qop, nc_value, cnonce)
+        return header
+
+    @staticmethod
+    def __resolve_qop(qop):
+        if qop is None:
+            return None
+        if "auth" in re.split(", ?", qop):
+            return "auth"
+        raise httpx.ProtocolError("Unsupported qop value {} in digest auth".format(qop))
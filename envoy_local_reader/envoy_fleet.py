@@ -0,0 +1,203 @@
+import asyncio
+import time
+
+from .envoy_metrics import prometheus_text
+from .envoy_reader import EnvoyReader
+from .envoy_reader_exception import EnvoyReaderError
+from .envoy_reader_factory import EnvoyReaderFactory
+
+
+class EnvoyFleetResult:
+    """
+    The result of polling one Envoy of the fleet, either data or error is set
+    """
+
+    def __init__(self, host, data=None, error=None, duration=0.0):
+        self.host = host
+        self.data = data
+        self.error = error
+        self.duration = duration
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+class EnvoyFleet:
+    """
+    Polls several Envoys concurrently with shared infrastructure.
+
+    All readers of the fleet share one connection pool and one request semaphore, so at most
+    max_concurrent_requests requests are in flight for the whole fleet. The readers of Envoys with token auth
+    share a second pool for https (https_session) that does not verify the self-signed certificates of the Envoys. The start of every poll is
+    spaced stagger_delay seconds after the start of the previous poll of the fleet, so the hosts are
+    never all polled at the same instant.
+
+    Hosts are given as "host" or "host:port", the same username and password (empty means: derive it
+    from the serial number) are used for all hosts unless given per host in add_host.
+
+    With a cache (EnvoyReaderCache) the readers are created from the persisted discovery data. When a
+    poll fails with an authentication or schema error info.xml is probed again, and when the firmware
+    changed the reader of the host is replaced.
+    """
+
+    MAX_CONCURRENT_REQUESTS = 4
+    STAGGER_DELAY = 0.5
+
+    def __init__(self, hosts=(), username="envoy", password="", max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+                 stagger_delay=STAGGER_DELAY, cache=None, **reader_kwargs):
+        self.username = username
+        self.password = password
+        self.max_concurrent_requests = max_concurrent_requests
+        self.stagger_delay = stagger_delay
+        self.reader_kwargs = reader_kwargs
+        self.cache = cache
+        self.readers = dict()
+        self._factories = dict()
+        self._pending_hosts = list(hosts)
+        self._session = None
+        self._https_session = None
+        self._request_semaphore = None
+        self._slot_lock = None
+        self._last_poll_start = None
+
+    @property
+    def hosts(self):
+        return list(self.readers) + [host for host in self._pending_hosts if host not in self.readers]
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = EnvoyReader.create_session(max_keep_alive_connections=self.max_concurrent_requests)
+        return self._session
+
+    @property
+    def https_session(self):
+        if self._https_session is None:
+            self._https_session = EnvoyReader.create_session(max_keep_alive_connections=self.max_concurrent_requests,
+                                                             verify=False)
+        return self._https_session
+
+    @property
+    def request_semaphore(self):
+        if self._request_semaphore is None:
+            self._request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        return self._request_semaphore
+
+    async def add_host(self, host, username=None, password=None, **reader_kwargs):
+        """
+        Detect the Envoy type of the host and add a reader for it to the fleet
+        :param host: "host" or "host:port"
+        :param reader_kwargs: reader options for this host, overriding the options of the fleet
+        :return: the reader of the host
+        """
+        if host in self.readers:
+            return self.readers[host]
+
+        hostname, port = self.split_host(host)
+        factory = EnvoyReaderFactory(hostname, port=port,
+                                     username=self.username if username is None else username,
+                                     password=self.password if password is None else password,
+                                     session=self.session, https_session=self.https_session,
+                                     request_semaphore=self.request_semaphore,
+                                     cache=self.cache, **dict(self.reader_kwargs, **reader_kwargs))
+        async with self.request_semaphore:
+            reader = await factory.get_reader()
+        self._factories[host] = factory
+        self.readers[host] = reader
+        return reader
+
+    async def remove_host(self, host):
+        if host in self._pending_hosts:
+            self._pending_hosts.remove(host)
+        factory = self._factories.pop(host, None)
+        if factory is not None:
+            await factory.close()
+        reader = self.readers.pop(host, None)
+        if reader is not None:
+            await reader.close()
+
+    async def poll_host(self, host):
+        """
+        Poll one host of the fleet, the poll waits for its stagger slot
+        :return: EnvoyFleetResult of the host
+        """
+        start = time.monotonic()
+        try:
+            reader = self.readers.get(host)
+            if reader is None:
+                reader = await self.add_host(host)
+            elif self._factories[host].reader_outdated:
+                reader = await self.__replace_reader(host)
+            await self.__wait_for_slot()
+            return EnvoyFleetResult(host, data=await reader.get_data(), duration=time.monotonic() - start)
+        except EnvoyReaderError as ex:
+            if host in self._factories and EnvoyReaderFactory.needs_reprobe(ex):
+                await self.__reprobe(host)
+            return EnvoyFleetResult(host, error=ex, duration=time.monotonic() - start)
+
+    async def get_data(self):
+        """
+        Poll all hosts of the fleet concurrently
+        :return: dict with the EnvoyFleetResult per host
+        """
+        results = await asyncio.gather(*[self.poll_host(host) for host in self.hosts])
+        return {result.host: result for result in results}
+
+    def metrics_text(self):
+        """
+        :return: the metrics of all readers in the Prometheus text format
+        """
+        return prometheus_text({host: reader.metrics for host, reader in self.readers.items()})
+
+    async def close(self):
+        # The background probes of the factories use the session of the fleet
+        for factory in self._factories.values():
+            await factory.close()
+        self._factories = dict()
+        for reader in self.readers.values():
+            await reader.close()
+        self.readers = dict()
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+        if self._https_session is not None:
+            await self._https_session.aclose()
+            self._https_session = None
+
+    async def __reprobe(self, host):
+        try:
+            async with self.request_semaphore:
+                await self._factories[host].reprobe()
+        except EnvoyReaderError:
+            pass
+
+    async def __replace_reader(self, host):
+        old_reader = self.readers[host]
+        reader = await self._factories[host].get_reader()
+        # Keep the metrics history of the host
+        reader.metrics = old_reader.metrics
+        self.readers[host] = reader
+        await old_reader.close()
+        return reader
+
+    async def __wait_for_slot(self):
+        if self._slot_lock is None:
+            self._slot_lock = asyncio.Lock()
+        async with self._slot_lock:
+            if self._last_poll_start is not None:
+                delay = self._last_poll_start + self.stagger_delay - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._last_poll_start = time.monotonic()
+
+    @staticmethod
+    def split_host(host):
+        """
+        :param host: "host" or "host:port"
+        :return: tuple (host, port)
+        """
+        hostname, _, port = host.rpartition(":")
+        if len(hostname) == 0 or not port.isdigit():
+            return host, 80
+        return hostname, int(port)
@@ -0,0 +1,217 @@
+import time
+from array import array
+
+from .property_names_const import PRODUCTION, INVERTERS, WATTS_NOW, LAST_REPORT_WATTS, LAST_REPORT_DATE
+
+
+class RingBuffer:
+    """
+    Fixed capacity, array backed buffer of (timestamp, mean, max, count) samples. All memory is allocated up
+    front, when the buffer is full the oldest sample is overwritten.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.means = array('f', bytes(4 * capacity))
+        self.maxima = array('f', bytes(4 * capacity))
+        self.counts = array('H', bytes(2 * capacity))
+        self.size = 0
+        self.overwritten = False
+        self._next = 0
+
+    def append(self, timestamp, mean, maximum, count=1):
+        i = self._next
+        self.timestamps[i] = timestamp
+        self.means[i] = mean
+        self.maxima[i] = maximum
+        self.counts[i] = min(count, 0xFFFF)
+        self._next = (i + 1) % self.capacity
+        self.overwritten = self.overwritten or self.size == self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    @property
+    def oldest(self):
+        """
+        :return: the timestamp of the oldest sample or None when empty
+        """
+        if self.size == 0:
+            return None
+        return self.timestamps[(self._next - self.size) % self.capacity]
+
+    @property
+    def newest(self):
+        if self.size == 0:
+            return None
+        return self.timestamps[(self._next - 1) % self.capacity]
+
+    def samples(self, start=None, end=None):
+        """
+        :return: list with the (timestamp, mean, max, count) samples within [start, end], oldest first
+        """
+        samples = []
+        for n in range(self.size):
+            i = (self._next - self.size + n) % self.capacity
+            timestamp = self.timestamps[i]
+            if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                samples.append((timestamp, self.means[i], self.maxima[i], self.counts[i]))
+        return samples
+
+    def memory_bytes(self):
+        return sum(column.itemsize * len(column) for column in (self.timestamps, self.means, self.maxima, self.counts))
+
+
+class DownsampledSeries:
+    """
+    Time series of one reading stored in tiers of ring buffers.
+
+    Tiers are (resolution, capacity) tuples from fine to coarse, resolution 0 stores every sample as is. Every
+    sample is also aggregated into the current bucket of the coarser tiers, a bucket is stored with its mean,
+    max and sample count when a sample of a next bucket arrives. Old data so automatically ends up in the
+    coarser tiers while the memory use stays fixed. A bucket is stamped at the mean time of its samples, the
+    time its mean stands for, so integrating over buckets and samples alike is not shifted.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = [(resolution, RingBuffer(capacity)) for resolution, capacity in tiers]
+        # Open bucket per tier: [bucket start, sum, max, count, sum of the timestamps]
+        self._buckets = [None] * len(self.tiers)
+
+    @property
+    def last_timestamp(self):
+        return self.tiers[0][1].newest
+
+    def add(self, timestamp, value):
+        for n, (resolution, buffer) in enumerate(self.tiers):
+            if resolution == 0:
+                buffer.append(timestamp, value, value)
+                continue
+
+            bucket_start = timestamp - timestamp % resolution
+            bucket = self._buckets[n]
+            if bucket is not None and bucket[0] != bucket_start:
+                buffer.append(*self.__bucket_sample(bucket))
+                bucket = None
+            if bucket is None:
+                self._buckets[n] = [bucket_start, value, value, 1, timestamp]
+            else:
+                bucket[1] += value
+                bucket[2] = max(bucket[2], value)
+                bucket[3] += 1
+                bucket[4] += timestamp
+
+    @staticmethod
+    def __bucket_sample(bucket):
+        """
+        :return: the (timestamp, mean, max, count) sample of a bucket
+        """
+        return bucket[4] / bucket[3], bucket[1] / bucket[3], bucket[2], bucket[3]
+
+    def points(self, start=None, end=None):
+        """
+        Samples within [start, end] from all tiers, every period taken from the finest tier that still has it
+        :return: list with (timestamp, mean, max, count) tuples, oldest first
+        """
+        points = []
+        covered_from = None
+        for n, (resolution, buffer) in enumerate(self.tiers):
+            samples = buffer.samples(start, end)
+            bucket = self._buckets[n]
+            if bucket is not None:
+                sample = self.__bucket_sample(bucket)
+                if (start is None or sample[0] >= start) and (end is None or sample[0] <= end):
+                    samples.append(sample)
+            if covered_from is not None:
+                samples = [sample for sample in samples if sample[0] < covered_from]
+                if len(samples) > 0:
+                    # The last bucket can overlap the finer tiers, it replaces their samples within it
+                    bucket_end = samples[-1][0] - samples[-1][0] % resolution + resolution
+                    points = [point for point in points if point[0] >= bucket_end]
+            points = samples + points
+
+            if not buffer.overwritten:
+                # Nothing was dropped from this tier, so the coarser tiers have nothing to add
+                break
+            covered_from = buffer.oldest if covered_from is None else min(covered_from, buffer.oldest)
+        return points
+
+    def mean(self, start=None, end=None):
+        """
+        :return: the mean of the samples within [start, end] or None when there are none
+        """
+        points = self.points(start, end)
+        count = sum(point[3] for point in points)
+        if count == 0:
+            return None
+        return sum(point[1] * point[3] for point in points) / count
+
+    def max(self, start=None, end=None):
+        points = self.points(start, end)
+        if len(points) == 0:
+            return None
+        return max(point[2] for point in points)
+
+    def energy_between(self, start, end):
+        """
+        Integrate the power (W) over [start, end] with the trapezoidal rule
+        :return: the energy in Wh
+        """
+        points = self.points(start, end)
+        energy = 0.0
+        for (t0, p0, _, _), (t1, p1, _, _) in zip(points, points[1:]):
+            energy += (p0 + p1) / 2 * (t1 - t0)
+        return energy / 3600
+
+    def memory_bytes(self):
+        return sum(buffer.memory_bytes() for _, buffer in self.tiers)
+
+
+class ReadingHistory:
+    """
+    In-memory history of the readings of a site with a fixed memory use.
+
+    The watts_now of the site is stored on every poll, every inverter stores its last_report_watts at its
+    last_report_date when it reported a new value. The default tiers keep every site reading of the last
+    3 hours and 1 minute means for 24 hours, and every inverter report of the last 2 hours and 15 minute
+    means for 24 hours. The history of an inverter that is no longer in the snapshot is dropped.
+    """
+
+    SITE_TIERS = ((0, 720), (60, 1440))
+    INVERTER_TIERS = ((0, 24), (900, 96))
+
+    def __init__(self, site_tiers=SITE_TIERS, inverter_tiers=INVERTER_TIERS):
+        self.inverter_tiers = inverter_tiers
+        self.site = DownsampledSeries(site_tiers)
+        self.inverters = dict()
+
+    def add_snapshot(self, data, timestamp=None):
+        """
+        Store the readings of a snapshot
+        :param data: the snapshot of EnvoyReader.get_data
+        :param timestamp: the time of the site reading, defaults to now
+        """
+        production = data.get(PRODUCTION)
+        if production is not None and production.get(WATTS_NOW) is not None:
+            self.site.add(time.time() if timestamp is None else timestamp, production[WATTS_NOW])
+
+        inverters = data.get(INVERTERS) or {}
+        for serial_number in [serial_number for serial_number in self.inverters if serial_number not in inverters]:
+            del self.inverters[serial_number]
+        for serial_number, inverter in inverters.items():
+            series = self.inverters.get(serial_number)
+            if series is None:
+                series = self.inverters[serial_number] = DownsampledSeries(self.inverter_tiers)
+            report_date = inverter[LAST_REPORT_DATE]
+            last_timestamp = series.last_timestamp
+            if last_timestamp is None or report_date > last_timestamp:
+                series.add(report_date, inverter[LAST_REPORT_WATTS])
+
+    def inverter(self, serial_number):
+        return self.inverters.get(serial_number)
+
+    def memory_bytes(self):
+        return self.site.memory_bytes() + sum(series.memory_bytes() for series in self.inverters.values())
+
+    @classmethod
+    def memory_bytes_per_inverter(cls, inverter_tiers=INVERTER_TIERS):
+        return DownsampledSeries(inverter_tiers).memory_bytes()
@@ -0,0 +1,45 @@
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class EnvoyJsonDecoder:
+    """
+    Decodes the raw response bytes of the Envoy without decoding them to text first.
+
+    orjson is used when it is installed, otherwise the json module of the standard library. The parse time
+    of the last response of every endpoint is kept in parse_timings (seconds, keyed by url path).
+    """
+
+    BACKEND_ORJSON = "orjson"
+    BACKEND_JSON = "json"
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = self.BACKEND_ORJSON if orjson is not None else self.BACKEND_JSON
+        if backend == self.BACKEND_ORJSON and orjson is None:
+            raise ValueError("orjson is not installed")
+        self.backend = backend
+        self._loads = orjson.loads if backend == self.BACKEND_ORJSON else json.loads
+        self.parse_timings = dict()
+
+    @classmethod
+    def available_backends(cls):
+        return [cls.BACKEND_JSON] + ([cls.BACKEND_ORJSON] if orjson is not None else [])
+
+    def decode(self, raw, url_path=None):
+        """
+        :param raw: the response body as bytes
+        :param url_path: the endpoint the body came from, used for the parse timings
+        :return: the decoded JSON document
+        :raises ValueError: when raw is not valid JSON
+        """
+        start = time.perf_counter()
+        document = self._loads(raw)
+        if url_path is not None:
+            self.parse_timings[url_path] = time.perf_counter() - start
+        return document
@@ -0,0 +1,186 @@
+from bisect import bisect_left
+from collections import defaultdict
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket upper bounds, like a Prometheus histogram
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.last = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else None
+
+    def cumulative_counts(self):
+        """
+        :return: list with (upper bound, cumulative count) tuples, the last upper bound is +Inf
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class EnvoyMetrics:
+    """
+    Instrumentation of the requests, parsing and refreshes of one EnvoyReader.
+
+    Per endpoint it keeps a latency histogram, the response bytes, the count per status code ('error' when
+    the request failed without a response, 'timeout' when it missed its deadline), the number of retries
+    (digest challenge round trips and requests retried with a renewed token) and a parse time histogram. Per
+    snapshot section the build time and for the whole reader the refresh duration and the number of successful
+    and failed refreshes.
+    """
+
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+    PARSE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+    STATUS_ERROR = "error"
+    STATUS_TIMEOUT = "timeout"
+
+    def __init__(self):
+        self.latency = defaultdict(lambda: Histogram(self.LATENCY_BUCKETS))
+        self.response_bytes = defaultdict(int)
+        self.status_codes = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.parse_time = defaultdict(lambda: Histogram(self.PARSE_BUCKETS))
+        self.build_time = defaultdict(lambda: Histogram(self.PARSE_BUCKETS))
+        self.refresh_duration = Histogram(self.LATENCY_BUCKETS)
+        self.refreshes = 0
+        self.failed_refreshes = 0
+
+    def record_request(self, url_path, duration, status, response_bytes=0, retries=0):
+        """
+        :param status: the http status code or STATUS_ERROR
+        :param retries: the number of extra round trips the request needed
+        """
+        self.latency[url_path].observe(duration)
+        self.response_bytes[url_path] += response_bytes
+        self.status_codes[(url_path, str(status))] += 1
+        self.retries[url_path] += retries
+
+    def record_parse(self, url_path, duration):
+        self.parse_time[url_path].observe(duration)
+
+    def record_build(self, section, duration):
+        self.build_time[section].observe(duration)
+
+    def record_refresh(self, duration, success):
+        self.refresh_duration.observe(duration)
+        self.refreshes += 1
+        if not success:
+            self.failed_refreshes += 1
+
+    def errors(self, url_path=None):
+        """
+        :return: the number of requests that did not return 200, of one or all endpoints
+        """
+        return sum(count for (path, status), count in self.status_codes.items()
+                   if status != "200" and (url_path is None or path == url_path))
+
+    def summary(self):
+        """
+        :return: dict with the last and mean values, ie. for diagnostic entities
+        """
+        endpoints = dict()
+        for url_path, latency in self.latency.items():
+            parse_time = self.parse_time.get(url_path)
+            endpoints[url_path] = {
+                "requests": latency.count,
+                "last_latency_ms": round(latency.last * 1000, 1),
+                "mean_latency_ms": round(latency.mean * 1000, 1),
+                "response_bytes": self.response_bytes[url_path],
+                "errors": self.errors(url_path),
+                "retries": self.retries[url_path],
+                "last_parse_ms": round(parse_time.last * 1000, 3) if parse_time is not None else None,
+            }
+        return {
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes,
+            "last_refresh_ms": (round(self.refresh_duration.last * 1000, 1)
+                                if self.refresh_duration.last is not None else None),
+            "mean_refresh_ms": (round(self.refresh_duration.mean * 1000, 1)
+                                if self.refresh_duration.mean is not None else None),
+            "endpoints": endpoints,
+        }
+
+
+def prometheus_text(metrics_by_host):
+    """
+    Render the metrics of readers in the Prometheus text exposition format
+    :param metrics_by_host: dict with the EnvoyMetrics per host
+    :return: str
+    """
+    lines = []
+
+    def family(name, metric_type, help_text, samples):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels, value in samples:
+            lines.append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+
+    def histogram_family(name, help_text, histograms):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} histogram".format(name))
+        for labels, histogram in histograms:
+            for bound, count in histogram.cumulative_counts():
+                lines.append("{}_bucket{} {}".format(name, format_labels(dict(labels, le=format_value(bound))), count))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), format_value(histogram.sum)))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), histogram.count))
+
+    hosts = sorted(metrics_by_host.items())
+    histogram_family("envoy_request_duration_seconds", "Latency of the requests to the Envoy",
+                     [({"host": host, "endpoint": url_path}, histogram)
+                      for host, metrics in hosts for url_path, histogram in sorted(metrics.latency.items())])
+    family("envoy_response_bytes_total", "counter", "Bytes of the response bodies of the Envoy",
+           [({"host": host, "endpoint": url_path}, value)
+            for host, metrics in hosts for url_path, value in sorted(metrics.response_bytes.items())])
+    family("envoy_responses_total", "counter", "Responses of the Envoy per status code",
+           [({"host": host, "endpoint": url_path, "status": status}, value)
+            for host, metrics in hosts for (url_path, status), value in sorted(metrics.status_codes.items())])
+    family("envoy_request_retries_total", "counter", "Extra round trips of the requests, ie. digest challenges",
+           [({"host": host, "endpoint": url_path}, value)
+            for host, metrics in hosts for url_path, value in sorted(metrics.retries.items())])
+    histogram_family("envoy_parse_duration_seconds", "Time to decode the responses of the Envoy",
+                     [({"host": host, "endpoint": url_path}, histogram)
+                      for host, metrics in hosts for url_path, histogram in sorted(metrics.parse_time.items())])
+    histogram_family("envoy_build_duration_seconds", "Time to build the sections of the snapshot",
+                     [({"host": host, "section": section}, histogram)
+                      for host, metrics in hosts for section, histogram in sorted(metrics.build_time.items())])
+    histogram_family("envoy_refresh_duration_seconds", "Duration of the refreshes of the reader",
+                     [({"host": host}, metrics.refresh_duration) for host, metrics in hosts])
+    family("envoy_refreshes_total", "counter", "Refreshes of the reader per result",
+           [({"host": host, "result": result}, value) for host, metrics in hosts
+            for result, value in (("success", metrics.refreshes - metrics.failed_refreshes),
+                                  ("failure", metrics.failed_refreshes))])
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in labels.items()) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
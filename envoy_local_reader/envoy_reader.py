@@ -1,6 +1,16 @@
+import asyncio
+import hashlib
+import time
+
 import httpx
 
-from .envoy_reader_exception import EnvoyReaderError
+from .endpoint_scheduler import EndpointScheduler
+from .envoy_digest_auth import EnvoyDigestAuth
+from .envoy_json_decoder import EnvoyJsonDecoder
+from .envoy_metrics import EnvoyMetrics
+from .envoy_reader_exception import EnvoyReaderError, EnvoyReaderAuthError, EnvoyReaderEndpointError, \
+    EnvoyReaderTimeoutError
+from .property_names_const import STATUS, AGE, FRESH, STALE
 
 
 class EnvoyReader:
@@ -12,6 +22,9 @@ class EnvoyReader:
     production data only (ie. Envoy model C, s/w >= R3.9)
     for production and consumption data (ie. Envoy model S, s/w >= R3.9 < R4.10)
     for production and consumption data (ie. Envoy model S, s/w >= R4.10)
+
+    A reader polls one Envoy: get_data fetches the endpoints that are due concurrently and merges them with the
+    last data of the other endpoints into a snapshot. Call close() when the reader is no longer used.
     """
 
     INFO_URL = "info.xml"
@@ -21,28 +34,318 @@ class EnvoyReader:
     INVERTERS_API_URL = "api/v1/production/inverters"
     INVENTORY_JSON_URL = "inventory.json"
 
-    def __init__(self, host, port=80, username="envoy", password="", serial_number=""):
+    HTTP_SCHEME = "http"
+    HTTPS_SCHEME = "https"
+    HTTPS_PORT = 443
+
+    HTTP_TIMEOUT = 20
+    MAX_KEEP_ALIVE_CONNECTIONS = 4
+    MAX_CONCURRENT_REQUESTS = 2
+    SNAPSHOT_MAX_AGE = 0
+    REFRESH_DEADLINE = 8
+    OFFLOAD_THRESHOLD = 64 * 1024
+    MAX_STALE_AGE = 900
+
+    # The share of refresh_deadline an endpoint may use, including the time waiting for the request semaphore.
+    # The production endpoints get the smallest share so a slow inventory never delays the production data.
+    DEADLINE_SHARES = {
+        PRODUCTION_JSON_URL: 0.5,
+        PRODUCTION_URL: 0.5,
+    }
+
+    # The production data changes continuously, the inverters report about every 5 minutes and the inventory
+    # hardly ever changes, see poll_interval
+    REFRESH_INTERVALS = {
+        PRODUCTION_JSON_URL: 15,
+        PRODUCTION_URL: 15,
+        PRODUCTION_API_URL: 300,
+        INVERTERS_API_URL: 300,
+        INVENTORY_JSON_URL: 3600,
+    }
+
+    def __init__(self, host, port=80, username="envoy", password="", serial_number="", session=None,
+                 max_concurrent_requests=MAX_CONCURRENT_REQUESTS, refresh_intervals=None, request_semaphore=None,
+                 json_decoder=None, snapshot_max_age=SNAPSHOT_MAX_AGE, refresh_deadline=REFRESH_DEADLINE,
+                 offload_threshold=OFFLOAD_THRESHOLD, parse_executor=None, token_auth=None,
+                 capture=None, max_stale_age=MAX_STALE_AGE, scheme=None):
         self.host = host.lower()
         self.port = port
         self.username = username
         self.password = password
         self.serial_number = serial_number
+        self.token_auth = token_auth
+        if scheme is None:
+            scheme = self.HTTPS_SCHEME if token_auth is not None else self.HTTP_SCHEME
+        self.scheme = scheme
+        self.auth = token_auth if token_auth is not None else EnvoyDigestAuth(self.username, self.password)
+        self._session = session
+        self._owns_session = session is None
+        self.max_concurrent_requests = max_concurrent_requests
+        self._request_semaphore = request_semaphore
+        self.json_decoder = json_decoder if json_decoder is not None else EnvoyJsonDecoder()
+        self.scheduler = EndpointScheduler(dict(self.REFRESH_INTERVALS, **(refresh_intervals or {})))
+        # The requests, parse times and refreshes of the reader
+        self.metrics = EnvoyMetrics()
+        self.snapshot_max_age = snapshot_max_age
+        self.refresh_deadline = refresh_deadline
+        self.offload_threshold = offload_threshold
+        self.parse_executor = parse_executor
+        # Records every raw response, the recording can be replayed by the mock Envoy of the tests
+        self.capture = capture
+        self.max_stale_age = max_stale_age
+        self._failing_since = dict()
+        self._snapshot = None
+        self._snapshot_time = None
+        self._refresh = None
+
+    @classmethod
+    def create_session(cls, max_keep_alive_connections=MAX_KEEP_ALIVE_CONNECTIONS, verify=True):
+        """
+        Create a connection pool that keeps the connections to the Envoy open between polls.
+        :param verify: False only for a pool of the https pages of Envoys, their self-signed certificate cannot be
+        verified. Such a pool must not be used for other hosts.
+        """
+        return httpx.AsyncClient(timeout=httpx.Timeout(cls.HTTP_TIMEOUT), verify=verify,
+                                 pool_limits=httpx.PoolLimits(soft_limit=max_keep_alive_connections))
+
+    @property
+    def session(self):
+        """
+        The keep-alive connection pool of the reader, in steady state every endpoint costs one request on an already
+        open connection. The pool of a reader with token_auth (https with the self-signed certificate of the Envoy)
+        does not verify the certificate. When a session is passed in, its owner is responsible for closing it.
+        """
+        if self._session is None:
+            self._session = self.create_session(verify=self.scheme != self.HTTPS_SCHEME)
+            self._owns_session = True
+        return self._session
+
+    @property
+    def poll_interval(self):
+        """
+        The interval in seconds get_data has to be called at, the shortest refresh interval of the endpoints used.
+        A poll only fetches the endpoints that are due, every endpoint has its own refresh interval (refresh_intervals).
+        """
+        intervals = [self.scheduler.intervals[url_path] for url_path in self.url_paths()]
+        return min(intervals) if len(intervals) > 0 else self.scheduler.poll_interval
+
+    @staticmethod
+    def fingerprint(content):
+        """
+        Responses with the same fingerprint as the previous response of the endpoint are not parsed again, when
+        nothing changed at all the snapshot has 'unchanged' set so consumers can skip their work.
+        :param content: the raw response body
+        :return: a short digest of the body to detect unchanged responses
+        """
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    @property
+    def parse_timings(self):
+        return self.json_decoder.parse_timings
+
+    async def run_parser(self, payload_size, parser, *args):
+        """
+        Run the parser on the event loop for small payloads and on the parse executor for large ones: changed
+        responses of together at least offload_threshold bytes are parsed on parse_executor (None is the default
+        executor of the event loop), so a big site does not block the event loop.
+        :param payload_size: the number of bytes the parser handles
+        :return: the result of parser(*args)
+        """
+        if self.offload_threshold is None or payload_size < self.offload_threshold:
+            return parser(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.parse_executor, parser, *args)
+
+    def url_paths(self):
+        """
+        :return: list with the url paths this reader needs for a complete snapshot
+        """
+        return []
+
+    @property
+    def request_semaphore(self):
+        # Created on first use so it belongs to the running event loop. Readers that share a request_semaphore
+        # (ie. in an EnvoyFleet) share the limit of requests in flight, so the web server of the Envoy is not overloaded
+        if self._request_semaphore is None:
+            self._request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        return self._request_semaphore
 
-    async def call_http_api(self, url_path):
-        digest_auth = httpx.DigestAuth(self.username, self.password)
-        timeout = httpx.Timeout(20)
+    def endpoint_deadline(self, url_path):
+        """
+        :return: the seconds the endpoint may take from the start of a poll, None when there is no deadline
+        """
+        if self.refresh_deadline is None:
+            return None
+        return self.refresh_deadline * self.DEADLINE_SHARES.get(url_path, 1.0)
+
+    def check_failures(self, responses, errors, now):
+        """
+        Keep track of the endpoints that fail since an earlier poll. A section of which an endpoint failed falls back
+        to the last good response of that endpoint and is marked stale, but an unreachable Envoy is not hidden
+        behind old data.
+        :param responses: dict with the responses of the poll per url path
+        :param errors: dict with the error of the poll per failed url path
+        :raises EnvoyReaderEndpointError: when every endpoint of the poll failed or an endpoint has been failing for
+        more than max_stale_age seconds
+        """
+        for url_path in responses:
+            self._failing_since.pop(url_path, None)
+        for url_path in errors:
+            self._failing_since.setdefault(url_path, now)
+        if len(errors) == 0:
+            return
+        if len(responses) == 0:
+            raise EnvoyReaderEndpointError(errors)
+        if self.max_stale_age is not None and any(now - self._failing_since[url_path] > self.max_stale_age
+                                                  for url_path in errors):
+            raise EnvoyReaderEndpointError(errors)
+
+    def section_status(self, url_paths, errors, now):
+        """
+        :return: dict with the status (fresh or stale when an endpoint failed) and the age in seconds of the
+        oldest response the section is built from
+        """
+        fetched = [self.scheduler.last_fetched(url_path) for url_path in url_paths]
+        return {
+            STATUS: STALE if any(url_path in errors for url_path in url_paths) else FRESH,
+            AGE: round(now - min(fetched), 1) if None not in fetched else None,
+        }
+
+    async def call_http_api(self, url_path, deadline=None):
+        """
+        :param deadline: the time.monotonic() time the response has to be received by, None for no deadline
+        :raises EnvoyReaderTimeoutError: when the deadline passed
+        """
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
         try:
-            async with httpx.AsyncClient(timeout=timeout) as session:
-                resp = await session.get("http://{}:{}/{}".format(self.host, self.port, url_path), auth=digest_auth)
-                if resp.status_code == 200:
-                    return resp
-                raise EnvoyReaderError("Cannot complete http request, error: {}".format(resp.status_code))
+            return await asyncio.wait_for(self.__call_http_api(url_path), timeout)
+        except asyncio.TimeoutError:
+            self.metrics.record_request(url_path, timeout, EnvoyMetrics.STATUS_TIMEOUT)
+            raise EnvoyReaderTimeoutError("No response of {} within {:.1f} seconds".format(url_path, timeout))
+
+    async def __call_http_api(self, url_path):
+        start = time.perf_counter()
+        try:
+            async with self.request_semaphore:
+                # The time waiting for the semaphore is not part of the latency of the Envoy
+                start = time.perf_counter()
+                sent_at = time.time()
+                url = "{}://{}:{}/{}".format(self.scheme, self.host, self.port, url_path)
+                generation = self.token_auth.generation if self.token_auth is not None else None
+                resp = await self.session.get(url, auth=self.auth)
+                retries = len(resp.history)
+                if (resp.status_code == 401 and self.token_auth is not None
+                        and await self.token_auth.renew(self.session, generation)):
+                    resp = await self.session.get(url, auth=self.auth)
+                    retries += 1
+            latency = time.perf_counter() - start
+            # Every earlier response in the history is a digest challenge round trip
+            self.metrics.record_request(url_path, latency, resp.status_code, len(resp.content), retries)
+            if self.capture is not None:
+                self.capture.record(url_path, sent_at, latency, resp.status_code, resp.content)
+            if resp.status_code == 200:
+                return resp
+            if resp.status_code == 401:
+                raise EnvoyReaderAuthError("Authentication failed for {}".format(url_path))
+            raise EnvoyReaderError("Cannot complete http request, error: {}".format(resp.status_code))
 
         except httpx.HTTPError as ex:
+            self.metrics.record_request(url_path, time.perf_counter() - start, EnvoyMetrics.STATUS_ERROR)
             raise EnvoyReaderError("Cannot connect: {}".format(ex.__str__()))
 
+    async def call_http_apis(self, url_paths):
+        """
+        Fetch the url paths concurrently, the number of requests in flight is limited by max_concurrent_requests
+        :param url_paths: list with the url paths to fetch
+        :return: dict with the response per url path
+        :raises EnvoyReaderEndpointError: with the error per failed url path, after all requests are finished
+        """
+        responses, errors = await self.fetch_http_apis(url_paths)
+        if len(errors) > 0:
+            raise EnvoyReaderEndpointError(errors)
+        return responses
+
+    async def fetch_http_apis(self, url_paths):
+        """
+        Fetch the url paths concurrently, every url path within its deadline. With token_auth the token is checked
+        first and a request the Envoy rejects is retried once with renewed credentials.
+        :param url_paths: list with the url paths to fetch
+        :return: tuple with a dict with the response per url path and a dict with the error per failed url path
+        """
+        if self.token_auth is not None:
+            # Fetching a new token may take long, it is not part of the deadlines of the endpoints
+            await self.token_auth.ensure_token(self.session)
+        start = time.monotonic()
+
+        def call(url_path):
+            deadline = self.endpoint_deadline(url_path)
+            return self.call_http_api(url_path, None if deadline is None else start + deadline)
+
+        results = []
+        if self.token_auth is None and self.auth.challenge is None and len(url_paths) > 1:
+            # Let the first request answer the digest challenge so the others are sent pre-authorized
+            results += await asyncio.gather(call(url_paths[0]), return_exceptions=True)
+        results += await asyncio.gather(*[call(url_path) for url_path in url_paths[len(results):]],
+                                        return_exceptions=True)
+        responses = dict()
+        errors = dict()
+        for url_path, result in zip(url_paths, results):
+            if isinstance(result, EnvoyReaderError):
+                errors[url_path] = result
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                responses[url_path] = result
+        return responses, errors
+
     async def get_data(self):
-        data = await self.update()
+        """
+        Concurrent calls share one refresh, so many callers asking at once cost one round trip per endpoint
+        :return: the snapshot of the Envoy, a cached one when it is younger than snapshot_max_age seconds
+        """
+        if (self._snapshot is not None and self.snapshot_max_age > 0
+                and self.scheduler.now() - self._snapshot_time < self.snapshot_max_age):
+            return self._snapshot
+
+        # Callers arriving while a refresh is in flight wait for that refresh instead of starting another one
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self.__refresh())
+            self._refresh.add_done_callback(self.__refresh_done)
+        # A cancelled caller (ie. a timeout) does not cancel the refresh of the other callers
+        return await asyncio.shield(self._refresh)
+
+    def invalidate_snapshot(self):
+        """
+        Make the next get_data refresh, even within snapshot_max_age
+        """
+        self._snapshot = None
+
+    async def __refresh(self):
+        start = time.perf_counter()
+        try:
+            data = await self.update()
+        except EnvoyReaderError:
+            self.metrics.record_refresh(time.perf_counter() - start, False)
+            raise
+        finally:
+            if self.capture is not None:
+                await self.capture.flush()
+        self.metrics.record_refresh(time.perf_counter() - start, True)
         data['serial_number'] = self.serial_number
-        return data;
+        self._snapshot = data
+        self._snapshot_time = self.scheduler.now()
+        return data
+
+    def __refresh_done(self, refresh):
+        self._refresh = None
+        # Retrieve the error, all callers may have been cancelled
+        if not refresh.cancelled():
+            refresh.exception()
 
+    async def close(self):
+        """
+        Close the connection pool of this reader, a next call will open a new one
+        """
+        if self._session is not None and self._owns_session:
+            await self._session.aclose()
+        self._session = None
+        self.auth.reset()
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+
+
+class EnvoyReaderCache:
+    """
+    Small JSON file store with an entry per Envoy host, ie. the discovered serial number, firmware version
+    and reader type, or its token. The file is read and written in an executor so the event loop is never blocked,
+    several factories (ie. of an EnvoyFleet) can share one cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = None
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def get(self, key):
+        """
+        :return: the entry of the key or None when there is no (readable) entry
+        """
+        entries = await asyncio.get_event_loop().run_in_executor(None, self.__read)
+        return entries.get(key)
+
+    async def set(self, key, value):
+        async with self.lock:
+            loop = asyncio.get_event_loop()
+            entries = await loop.run_in_executor(None, self.__read)
+            entries[key] = value
+            await loop.run_in_executor(None, self.__write, entries)
+
+    async def remove(self, key):
+        async with self.lock:
+            loop = asyncio.get_event_loop()
+            entries = await loop.run_in_executor(None, self.__read)
+            if entries.pop(key, None) is not None:
+                await loop.run_in_executor(None, self.__write, entries)
+
+    def __read(self):
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+            return entries if isinstance(entries, dict) else dict()
+        except (OSError, ValueError):
+            return dict()
+
+    def __write(self, entries):
+        # Write to a temporary file first so a crash never leaves a half written cache behind, only the owner
+        # may read it as it can hold tokens
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w", opener=lambda path, flags: os.open(path, flags, 0o600)) as file:
+            json.dump(entries, file, indent=2)
+        os.replace(tmp_path, self.path)
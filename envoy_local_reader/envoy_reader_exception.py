@@ -1,3 +1,34 @@
-class EnvoyReaderError(Exception):
-    def __init__(self, msg):
-        pass
+class EnvoyReaderError(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+
+
+class EnvoyReaderAuthError(EnvoyReaderError):
+    """
+    The Envoy rejected the credentials
+    """
+
+
+class EnvoyReaderTimeoutError(EnvoyReaderError):
+    """
+    The Envoy did not answer a request within its deadline
+    """
+
+
+class EnvoyReaderSchemaError(EnvoyReaderError):
+    """
+    The data of the Envoy did not have the expected format, ie. after a firmware upgrade
+    """
+
+
+class EnvoyReaderEndpointError(EnvoyReaderError):
+    """
+    One or more endpoints of a poll failed, errors maps the url path to the EnvoyReaderError of that endpoint
+    """
+    def __init__(self, errors):
+        super().__init__("Failed endpoints: {}".format(
+            ", ".join("{} ({})".format(url_path, error) for url_path, error in errors.items())))
+        self.errors = errors
+
+    def has_error(self, error_type):
+        return any(isinstance(error, error_type) for error in self.errors.values())
@@ -1,19 +1,55 @@
 import asyncio
+import logging
+import time
+
 import httpx
 
 import xml.etree.ElementTree as ET
 
-from .envoy_reader_exception import EnvoyReaderError
+from .envoy_reader import EnvoyReader
+from .envoy_reader_exception import EnvoyReaderError, EnvoyReaderAuthError, EnvoyReaderSchemaError, \
+    EnvoyReaderEndpointError
 from .envoy_reader_model_c_old import EnvoyReaderOldC
 from .envoy_reader_model_s import EnvoyReaderS
+from .envoy_token_auth import EnvoyTokenAuth
+
+_LOGGER = logging.getLogger(__name__)
 
 
 class EnvoyReaderFactory:
     """
     The factory returns based on the firmware version the correct EnvoyReader implementation
+
+    When a cache (EnvoyReaderCache) is given, the serial number, firmware version and reader type found in
+    info.xml are persisted. A next start builds the reader from the cache right away and probes info.xml in
+    the background, close() cancels that probe. A firmware upgrade is detected by that probe or by reprobe() after
+    an authentication or schema error, reader_outdated tells a new reader has to be created with get_reader().
+
+    Envoys with newer firmware (info.xml reports web-tokens, or firmware 7 and later) only accept tokens,
+    with auth_mode AUTH_AUTO they are read with an EnvoyTokenAuth, the username and password are then the
+    credentials of Enlighten. The tokens are persisted in token_cache (EnvoyReaderCache), the readers created
+    by one factory share its EnvoyTokenAuth. These Envoys are read over https at https_port, info.xml is read
+    over http and over https when the Envoy redirects it. The certificate of the Envoy is self-signed, so their
+    readers get https_session, a session that does not verify certificates, instead of session.
     """
 
-    def __init__(self, host, port=80, username="envoy", password="", firmware_version=""):
+    READER_OLD_C = "old_c"
+    READER_S_PRODUCTION_JSON = "s_production_json"
+    READER_S = "s"
+
+    AUTH_AUTO = "auto"
+    AUTH_DIGEST = "digest"
+    AUTH_TOKEN = "token"
+    TOKEN_AUTH_MIN_VERSION = 7
+    REDIRECT_STATUS_CODES = (301, 302, 307, 308)
+
+    def __init__(self, host, port=80, username="envoy", password="", firmware_version="",
+                 max_concurrent_requests=EnvoyReader.MAX_CONCURRENT_REQUESTS, refresh_intervals=None, session=None,
+                 request_semaphore=None, cache=None, snapshot_max_age=EnvoyReader.SNAPSHOT_MAX_AGE,
+                 refresh_deadline=EnvoyReader.REFRESH_DEADLINE, offload_threshold=EnvoyReader.OFFLOAD_THRESHOLD,
+                 auth_mode=AUTH_AUTO, token_cache=None, login_url=EnvoyTokenAuth.LOGIN_URL,
+                 token_url=EnvoyTokenAuth.TOKEN_URL, capture=None, max_stale_age=EnvoyReader.MAX_STALE_AGE,
+                 https_port=EnvoyReader.HTTPS_PORT, https_session=None):
         self.host = host.lower()
         self.username = username
         self.password = password
@@ -21,6 +57,42 @@ class EnvoyReaderFactory:
         self.serial_number = None
         self.firmware_version = None
         self.port = port
+        self.https_port = https_port
+        self.max_concurrent_requests = max_concurrent_requests
+        self.refresh_intervals = refresh_intervals
+        self.session = session
+        self.https_session = https_session
+        self.request_semaphore = request_semaphore
+        self.cache = cache
+        self.snapshot_max_age = snapshot_max_age
+        self.refresh_deadline = refresh_deadline
+        self.offload_threshold = offload_threshold
+        self.auth_mode = auth_mode
+        self.token_cache = token_cache
+        self.login_url = login_url
+        self.token_url = token_url
+        self.capture = capture
+        self.max_stale_age = max_stale_age
+        self.web_tokens = False
+        self.reader_type = None
+        self.reader_outdated = False
+        self._derived_password = len(password) == 0
+        self._background_probe = None
+        self._token_auth = None
+        self._reader_token_auth = None
+
+    @property
+    def cache_key(self):
+        return "{}:{}".format(self.host, self.port)
+
+    @property
+    def uses_token_auth(self):
+        """
+        :return: True when the Envoy is read with token auth instead of digest auth
+        """
+        if self.auth_mode == self.AUTH_AUTO:
+            return self.web_tokens or self.to_version_tuple(self.firmware_version)[0] >= self.TOKEN_AUTH_MIN_VERSION
+        return self.auth_mode == self.AUTH_TOKEN
 
     async def get_reader(self, fw_version=""):
         """
@@ -29,28 +101,107 @@ class EnvoyReaderFactory:
         for production and consumption data (ie. Envoy model S, s/w >= R3.9 < R4.10)
         for consumption data and production from separate api call (ie. Envoy model S, s/w >= R4.10)
         """
-        if self.firmware_version is None or len(self.firmware_version) == 0:
-            await self.__get_info()
+        if self.reader_outdated:
+            self.reader_type = self.reader_type_for_version(self.firmware_version)
+        elif self.firmware_version is None or len(self.firmware_version) == 0:
+            if await self.__load_cache():
+                # Verify the cached firmware version without delaying the start
+                self._background_probe = asyncio.ensure_future(self.__background_probe())
+            else:
+                await self.__get_info()
+                self.reader_type = self.reader_type_for_version(self.firmware_version)
+                await self.__save_cache()
+        elif self.reader_type is None:
+            self.reader_type = self.reader_type_for_version(self.firmware_version)
+        self.reader_outdated = False
 
-        # If no password is set use the serial number as password
-        if len(self.password) == 0 and not self.serial_number is None:
+        kwargs = dict(max_concurrent_requests=self.max_concurrent_requests, refresh_intervals=self.refresh_intervals,
+                      session=self.session, request_semaphore=self.request_semaphore,
+                      snapshot_max_age=self.snapshot_max_age, refresh_deadline=self.refresh_deadline,
+                      offload_threshold=self.offload_threshold, capture=self.capture,
+                      max_stale_age=self.max_stale_age)
+
+        self._reader_token_auth = self.uses_token_auth
+        port = self.port
+        if self._reader_token_auth:
+            kwargs["token_auth"] = self.__get_token_auth()
+            kwargs["scheme"] = EnvoyReader.HTTPS_SCHEME
+            kwargs["session"] = self.https_session
+            port = self.https_port
+        elif self._derived_password and not self.serial_number is None:
+            # If no password is set use the serial number as password
             self.password = self.serial_number[6:]
 
-        _v = self.to_version_tuple(self.firmware_version)
+        if self.reader_type == self.READER_OLD_C:
+            return EnvoyReaderOldC(self.host, port, self.username, self.password,
+                                   serial_number=self.serial_number, **kwargs)
+        elif self.reader_type == self.READER_S_PRODUCTION_JSON:
+            return EnvoyReaderS(host=self.host, port=port, username=self.username, password=self.password,
+                                use_production_json=True, serial_number=self.serial_number, **kwargs)
+        else:
+            return EnvoyReaderS(host=self.host, port=port, username=self.username, password=self.password,
+                                use_production_json=False, serial_number=self.serial_number, **kwargs)
+
+    async def reprobe(self):
+        """
+        Fetch info.xml again and update the cache, ie. after an authentication or schema error
+        :return: True when the firmware changed so a different reader is needed, see reader_outdated
+        """
+        await self.__get_info()
+        await self.__save_cache()
+        if (self.reader_type_for_version(self.firmware_version) != self.reader_type
+                or self.uses_token_auth != self._reader_token_auth):
+            self.reader_outdated = True
+        return self.reader_outdated
+
+    async def close(self):
+        """
+        Cancel the background probe of info.xml, ie. before the session it uses is closed. The readers of the
+        factory are closed by their owner.
+        """
+        if self._background_probe is not None and not self._background_probe.done():
+            self._background_probe.cancel()
+            try:
+                await self._background_probe
+            except asyncio.CancelledError:
+                pass
+        self._background_probe = None
+
+    def __get_token_auth(self):
+        if self._derived_password:
+            raise EnvoyReaderAuthError("Envoy {} needs the Enlighten username and password for token auth"
+                                       .format(self.host))
+        # A new reader (ie. after a firmware upgrade) keeps the token, a replaced Envoy needs a new one
+        if self._token_auth is None or self._token_auth.serial_number != self.serial_number:
+            self._token_auth = EnvoyTokenAuth(self.username, self.password, self.serial_number, self.host,
+                                              port=self.https_port, cache=self.token_cache, cache_key=self.cache_key,
+                                              login_url=self.login_url, token_url=self.token_url,
+                                              scheme=EnvoyReader.HTTPS_SCHEME)
+        return self._token_auth
+
+    @staticmethod
+    def needs_reprobe(error):
+        """
+        :return: True when the error of a poll may be caused by a firmware upgrade
+        """
+        if isinstance(error, EnvoyReaderEndpointError):
+            return error.has_error(EnvoyReaderAuthError) or error.has_error(EnvoyReaderSchemaError)
+        return isinstance(error, (EnvoyReaderAuthError, EnvoyReaderSchemaError))
+
+    @classmethod
+    def reader_type_for_version(cls, firmware_version):
+        _v = cls.to_version_tuple(firmware_version)
 
         if _v[0] < 3:
-            return EnvoyReaderOldC(self.host, self.port, self.username, self.password)
+            return cls.READER_OLD_C
         elif _v[0] == 3 and _v[1] < 9:
-            return EnvoyReaderOldC(self.host, self.port, self.username, self.password)
+            return cls.READER_OLD_C
         elif _v[0] == 3 and _v[1] >= 9:
-            return EnvoyReaderS(host=self.host, port=self.port, username=self.username, password=self.password,
-                                use_production_json=True, serial_number=self.serial_number)
+            return cls.READER_S_PRODUCTION_JSON
         elif _v[0] == 4 and _v[1] < 10:
-            return EnvoyReaderS(host=self.host, port=self.port, username=self.username, password=self.password,
-                                use_production_json=True, serial_number=self.serial_number)
+            return cls.READER_S_PRODUCTION_JSON
         else:
-            return EnvoyReaderS(host=self.host, port=self.port, username=self.username, password=self.password,
-                                use_production_json=False, serial_number=self.serial_number)
+            return cls.READER_S
 
     @staticmethod
     def to_version_tuple(v):
@@ -70,15 +221,55 @@ class EnvoyReaderFactory:
             return 0, 0, 0
 
     async def __get_info(self):
-        timeout = httpx.Timeout(20)
         try:
-            async with httpx.AsyncClient(timeout=timeout) as session:
-                resp = await session.get("http://{}:{}/info.xml".format(self.host, self.port), allow_redirects=False)
-                if resp.status_code == 200:
-                    xml = ET.fromstring(resp.text)
-                    self.serial_number = xml.find("device/sn").text
-                    self.firmware_version = xml.find("device/software").text
-                else:
-                    raise EnvoyReaderError("Cannot complete http request, error: {}".format(resp.status_code))
+            resp = await self.__fetch_info("http://{}:{}/info.xml".format(self.host, self.port), self.session)
+            if resp.status_code in self.REDIRECT_STATUS_CODES:
+                # Newer firmware only serves https, at the port of this factory instead of the one of the redirect
+                resp = await self.__fetch_info("https://{}:{}/info.xml".format(self.host, self.https_port),
+                                               self.https_session, verify=False)
         except httpx.HTTPError as ex:
             raise EnvoyReaderError("Cannot connect: {}".format(ex.__str__()))
+        if resp.status_code == 200:
+            xml = ET.fromstring(resp.text)
+            self.serial_number = xml.find("device/sn").text
+            self.firmware_version = xml.find("device/software").text
+            self.web_tokens = xml.findtext("web-tokens") == "true"
+        else:
+            raise EnvoyReaderError("Cannot complete http request, error: {}".format(resp.status_code))
+
+    @staticmethod
+    async def __fetch_info(url, session, verify=True):
+        if session is not None:
+            return await session.get(url, allow_redirects=False)
+        async with EnvoyReader.create_session(max_keep_alive_connections=1, verify=verify) as session:
+            return await session.get(url, allow_redirects=False)
+
+    async def __background_probe(self):
+        try:
+            if await self.reprobe():
+                _LOGGER.info("Firmware of Envoy %s changed to %s", self.host, self.firmware_version)
+        except EnvoyReaderError as ex:
+            _LOGGER.debug("Probing info.xml of Envoy %s failed: %s", self.host, ex)
+
+    async def __load_cache(self):
+        if self.cache is None:
+            return False
+        entry = await self.cache.get(self.cache_key)
+        if entry is None:
+            return False
+        self.serial_number = entry["serial_number"]
+        self.firmware_version = entry["firmware_version"]
+        self.reader_type = entry["reader_type"]
+        self.web_tokens = entry.get("web_tokens", False)
+        return True
+
+    async def __save_cache(self):
+        if self.cache is None:
+            return
+        await self.cache.set(self.cache_key, {
+            "serial_number": self.serial_number,
+            "firmware_version": self.firmware_version,
+            "reader_type": self.reader_type_for_version(self.firmware_version),
+            "web_tokens": self.web_tokens,
+            "probed_at": int(time.time()),
+        })
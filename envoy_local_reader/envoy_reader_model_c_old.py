@@ -1,9 +1,112 @@
-from .envoy_reader import EnvoyReader
-from .property_names_const import SERIAL_NUMBER, LAST_REPORT_DATE, DEVICE_TYPE, LAST_REPORT_WATTS, MAX_REPORT_WATTS
-
-
-class EnvoyReaderOldC(EnvoyReader):
-
-    async def update(self):
-        print("updating Envoy Type Old C {}".format(self.host))
-
+import re
+import time
+
+from .envoy_reader import EnvoyReader
+from .envoy_reader_exception import EnvoyReaderSchemaError
+from .envoy_snapshot import ProductionData
+from .property_names_const import (
+    INVERTERS,
+    PRODUCTION,
+    WATT_HOURS_LIFETIME,
+    WATT_HOURS_SEVEN_DAYS,
+    WATT_HOURS_TODAY,
+    WATTS_NOW,
+    ACTIVE_INVERTERS,
+    UNCHANGED,
+    SECTION_STATUS)
+
+
+class EnvoyReaderOldC(EnvoyReader):
+    """
+    Reader of the Envoy model C with firmware older than R3.9, it has no json pages.
+
+    The production is scraped from the production html page in a single pass of one precompiled pattern over
+    the raw bytes, without decoding the page or building a DOM. The page has no data per inverter, the snapshot
+    has the same shape as the one of EnvoyReaderS with an empty inverters section.
+    """
+
+    # Matches the label and value cells of the rows of the statistics tables, ie. <td>Today</td> <td>4.56 kWh</td>
+    ROW_PATTERN = re.compile(
+        rb"<td>\s*(Currently|Today|Past Week|Since Installation|Number of Microinverters Online)\s*</td>"
+        rb"\s*<td>\s*(\d+(?:\.\d+)?)\s*([kM]?Wh?)?\s*</td>", re.IGNORECASE)
+
+    ROWS = {
+        b"currently": WATTS_NOW,
+        b"today": WATT_HOURS_TODAY,
+        b"past week": WATT_HOURS_SEVEN_DAYS,
+        b"since installation": WATT_HOURS_LIFETIME,
+        b"number of microinverters online": ACTIVE_INVERTERS,
+    }
+
+    UNIT_FACTORS = {
+        b"w": 1,
+        b"wh": 1,
+        b"kw": 1000,
+        b"kwh": 1000,
+        b"mw": 1000000,
+        b"mwh": 1000000,
+    }
+
+    def __init__(self, host, port=80, username="envoy", password="", serial_number="", **kwargs):
+        super().__init__(host, port, username, password, serial_number, **kwargs)
+        self._fingerprint = None
+        self._production = None
+
+    def url_paths(self):
+        return [self.PRODUCTION_URL]
+
+    def sections(self):
+        """
+        :return: dict with the url paths every section of the snapshot is built from
+        """
+        return {PRODUCTION: [self.PRODUCTION_URL]}
+
+    async def update(self):
+        now = self.scheduler.now()
+        responses, errors = await self.fetch_http_apis(self.scheduler.due(self.url_paths(), now))
+        # The production page is the only endpoint, when it fails the whole poll failed
+        self.check_failures(responses, errors, now)
+
+        changed = False
+        resp = responses.get(self.PRODUCTION_URL)
+        if resp is not None:
+            fingerprint = self.fingerprint(resp.content)
+            if fingerprint != self._fingerprint:
+                start = time.perf_counter()
+                self._production = self.parse_production_html(resp.content)
+                duration = time.perf_counter() - start
+                self.metrics.record_parse(self.PRODUCTION_URL, duration)
+                self.metrics.record_build(PRODUCTION, duration)
+                self._fingerprint = fingerprint
+                changed = True
+        self.scheduler.mark_fetched(responses, now)
+
+        data = dict()
+        data[PRODUCTION] = self._production
+        data[INVERTERS] = dict()
+        data[SECTION_STATUS] = {section: self.section_status(url_paths, errors, now)
+                                for section, url_paths in self.sections().items()}
+        data[UNCHANGED] = not changed
+        return data
+
+    @classmethod
+    def parse_production_html(cls, content):
+        """
+        :param content: the raw production html page
+        :return: ProductionData with the production, the energy values in Wh and the power in W
+        :raises EnvoyReaderSchemaError: when the page has no production values
+        """
+        data = {ACTIVE_INVERTERS: None}
+        for label, value, unit in cls.ROW_PATTERN.findall(content):
+            key = cls.ROWS[label.lower()]
+            if key == ACTIVE_INVERTERS:
+                data[key] = int(float(value))
+            else:
+                # Round away the float error of the scaling, ie. 4.56 kWh is 4560 Wh
+                data[key] = round(float(value) * cls.UNIT_FACTORS.get(unit.lower(), 1), 3)
+
+        missing = [key for key in (WATTS_NOW, WATT_HOURS_TODAY, WATT_HOURS_SEVEN_DAYS, WATT_HOURS_LIFETIME)
+                   if key not in data]
+        if len(missing) > 0:
+            raise EnvoyReaderSchemaError("Unexpected data from the Envoy, missing: {}".format(", ".join(missing)))
+        return ProductionData.from_dict(data)
@@ -1,4 +1,9 @@
+import time
+
 from .envoy_reader import EnvoyReader
+from .envoy_reader_exception import EnvoyReaderSchemaError, EnvoyReaderAuthError, EnvoyReaderEndpointError
+from .envoy_snapshot import ProductionData, InverterData
+from .inverter_health import InverterHealth
 from .property_names_const import (
     INVERTERS,
     PRODUCTION,
@@ -7,69 +12,239 @@ from .property_names_const import (
     WATT_HOURS_TODAY,
     WATTS_NOW,
     ACTIVE_INVERTERS,
-    MAX_REPORT_WATTS,
-    DEVICE_TYPE,
-    LAST_REPORT_DATE,
-    SERIAL_NUMBER,
-    LAST_REPORT_WATTS, PCU_PRODUCING, PCU_COMMUNICATING, PCU_DEVICE_STATUS)
+    UNCHANGED,
+    INVERTER_HEALTH,
+    SECTION_STATUS, TOTAL_CONSUMPTION, NET_CONSUMPTION, PHASES)
 
 
 class EnvoyReaderS(EnvoyReader):
+    """
+    Reader of the Envoy model S and model C with firmware R3.9 and later.
+
+    production.json has the production of the inverters and, on a metered Envoy, the readings of the production
+    and consumption meters (eim) with the values per phase. When the production meter is active the production is
+    taken from production.json. Without an active meter the power is the one of the inverters and the energy of the
+    inverters is only in api/v1/production, that endpoint is only fetched then. The consumption sections are taken
+    from the consumption meters that are active.
+    """
+
+    # The measurement types of the meters in production.json and their section in the snapshot
+    CONSUMPTION_SECTIONS = {
+        "total-consumption": TOTAL_CONSUMPTION,
+        "net-consumption": NET_CONSUMPTION,
+    }
+    # Names of the phases, like the meter stream
+    PHASE_NAMES = ("ph-a", "ph-b", "ph-c")
 
-    def __init__(self, host, port, username="envoy", password="", use_production_json=True, serial_number=""):
-        super().__init__(host, port, username, password, serial_number)
+    def __init__(self, host, port, username="envoy", password="", use_production_json=True, serial_number="",
+                 **kwargs):
+        super().__init__(host, port, username, password, serial_number, **kwargs)
         self.use_production_json = use_production_json
+        self._raw_json = dict()
+        self._fingerprints = dict()
+        self._production = None
+        self._inverters = None
+        self._inverter_health = None
+        self._consumption = dict()
+        # Unknown until the first production.json, the production api is fetched until then
+        self._metered = None
+        # The inverter health analytics need numpy, without it the snapshot has no inverter_health
+        self.inverter_health = InverterHealth() if InverterHealth.available() else None
+
+    @property
+    def needs_production_api(self):
+        """
+        :return: True when the energy of the production is not in production.json
+        """
+        return not self._metered
+
+    def url_paths(self):
+        url_paths = [self.PRODUCTION_JSON_URL, self.INVERTERS_API_URL, self.INVENTORY_JSON_URL]
+        if self.needs_production_api:
+            url_paths.append(self.PRODUCTION_API_URL)
+        return url_paths
+
+    def sections(self):
+        """
+        :return: dict with the url paths every section of the snapshot is built from
+        """
+        production_url_paths = [self.PRODUCTION_JSON_URL]
+        if self.needs_production_api:
+            production_url_paths.append(self.PRODUCTION_API_URL)
+        return {
+            PRODUCTION: production_url_paths,
+            INVERTERS: [self.INVERTERS_API_URL, self.INVENTORY_JSON_URL],
+        }
 
     async def update(self):
-        resp_prod_json = await self.call_http_api(self.PRODUCTION_JSON_URL)
-        if not self.use_production_json:
-            resp_extra_prod = await self.call_http_api(self.PRODUCTION_API_URL)
+        now = self.scheduler.now()
+        responses, errors = await self.fetch_http_apis(self.scheduler.due(self.url_paths(), now))
+        # Authentication errors are not a slow Envoy, a stale snapshot would hide them
+        if any(isinstance(error, EnvoyReaderAuthError) for error in errors.values()):
+            raise EnvoyReaderEndpointError(errors)
+        self.check_failures(responses, errors, now)
 
-        resp_inverter = await self.call_http_api(self.INVERTERS_API_URL)
-        resp_inventory = await self.call_http_api(self.INVENTORY_JSON_URL)
+        # Responses identical to the previous response of the endpoint are not parsed again
+        fingerprints = {url_path: self.fingerprint(resp.content) for url_path, resp in responses.items()}
+        changed = {url_path for url_path, fingerprint in fingerprints.items()
+                   if self._fingerprints.get(url_path) != fingerprint}
+
+        # Large payloads (ie. the inverters of a big site) are parsed on a worker thread, off the event loop
+        sections = self.sections()
+        parse_timings, build_timings = await self.run_parser(
+            sum(len(responses[url_path].content) for url_path in changed), self.__parse, responses, changed, sections)
+        # The metrics are iterated on the event loop (ie. by the metrics view), they are only written here
+        self.parse_timings.update(parse_timings)
+        for url_path, duration in parse_timings.items():
+            self.metrics.record_parse(url_path, duration)
+        for section, duration in build_timings.items():
+            self.metrics.record_build(section, duration)
+
+        self._fingerprints.update(fingerprints)
+        self.scheduler.mark_fetched(responses, now)
+        if not self.needs_production_api:
+            # The production meter became active, when it is deactivated again the production api is fetched anew
+            self._raw_json.pop(self.PRODUCTION_API_URL, None)
+            self._fingerprints.pop(self.PRODUCTION_API_URL, None)
+            self.scheduler.invalidate(self.PRODUCTION_API_URL)
+
+        # Without a last good value a section cannot fall back, ie. on the first poll
+        if len(errors) > 0 and (self._production is None or self._inverters is None):
+            raise EnvoyReaderEndpointError(errors)
 
         data = dict()
-        data[PRODUCTION] = self.__process_production_json(resp_prod_json.json(), resp_extra_prod.json())
-        data[INVERTERS] = self.__process_inverter_json(resp_inverter.json(), resp_inventory.json())
+        data[PRODUCTION] = self._production
+        data[INVERTERS] = self._inverters
+        data.update(self._consumption)
+        if self._inverter_health is not None:
+            data[INVERTER_HEALTH] = self._inverter_health
+        data[SECTION_STATUS] = {section: self.section_status(url_paths, errors, now)
+                                for section, url_paths in sections.items()}
+        data[UNCHANGED] = len(changed) == 0
         return data
 
+    def __parse(self, responses, changed, sections):
+        """
+        Decode the changed responses and rebuild the sections of which an endpoint changed, this may run on a
+        worker thread so the timings are returned instead of recorded
+        :return: tuple with dicts of the parse time per url path and of the build time per section
+        """
+        parse_timings = dict()
+        build_timings = dict()
+        try:
+            for url_path in changed:
+                start = time.perf_counter()
+                self._raw_json[url_path] = self.json_decoder.decode(responses[url_path].content)
+                parse_timings[url_path] = time.perf_counter() - start
+
+            # Only rebuild the sections of which an endpoint changed, the others keep their last data. A
+            # section of which an endpoint failed is built with the last good response of that endpoint.
+            if self.__needs_rebuild(sections[PRODUCTION], changed):
+                start = time.perf_counter()
+                self._production, self._consumption = self.__process_production_json(
+                    self._raw_json[self.PRODUCTION_JSON_URL], self._raw_json.get(self.PRODUCTION_API_URL))
+                build_timings[PRODUCTION] = time.perf_counter() - start
+            if self.__needs_rebuild(sections[INVERTERS], changed):
+                start = time.perf_counter()
+                # The records of the inverters without a new report are reused, unless the inventory changed
+                previous = self._inverters if self.INVENTORY_JSON_URL not in changed else None
+                self._inverters = self.__process_inverter_json(self._raw_json[self.INVERTERS_API_URL],
+                                                               self._raw_json[self.INVENTORY_JSON_URL], previous)
+                build_timings[INVERTERS] = time.perf_counter() - start
+                if self.inverter_health is not None:
+                    self._inverter_health = self.inverter_health.analyze(self._inverters)
+        except (KeyError, IndexError, TypeError, ValueError) as ex:
+            raise EnvoyReaderSchemaError("Unexpected data from the Envoy: {!r}".format(ex))
+        return parse_timings, build_timings
+
+    def __needs_rebuild(self, url_paths, changed):
+        return (any(url_path in changed for url_path in url_paths)
+                and all(url_path in self._raw_json for url_path in url_paths))
+
     def __process_production_json(self, raw_prod_json, raw_extra_prod_json):
-        data = dict()
-        if self.use_production_json:
-            raw_json = list(filter(lambda x: x['type'] == 'eim', raw_prod_json['production']))[0]
-            data[ACTIVE_INVERTERS] = raw_json['activeCount']
-            data[WATTS_NOW] = raw_json['wNow']
-            data[WATT_HOURS_TODAY] = raw_json['whToday']
-            data[WATT_HOURS_SEVEN_DAYS] = raw_json['whLastSevenDays']
-            data[WATT_HOURS_LIFETIME] = raw_json['whLifetime']
-        else:
-            raw_json = list(filter(lambda x: x['type'] == 'inverters', raw_prod_json['production']))[0]
-            data[ACTIVE_INVERTERS] = raw_json['activeCount']
-            data[WATTS_NOW] = raw_json['wNow']
-            data[WATT_HOURS_TODAY] = raw_extra_prod_json['wattHoursToday']
-            data[WATT_HOURS_SEVEN_DAYS] = raw_extra_prod_json['wattHoursSevenDays']
-            data[WATT_HOURS_LIFETIME] = raw_extra_prod_json['wattHoursLifetime']
-        return data
+        """
+        :return: tuple with the production section and a dict with the consumption sections of a metered Envoy
+        """
+        inverters_json = None
+        meter_json = None
+        for raw_json in raw_prod_json['production']:
+            if raw_json['type'] == 'inverters':
+                inverters_json = raw_json
+            elif raw_json['type'] == 'eim':
+                meter_json = raw_json
+        self._metered = meter_json is not None and meter_json['activeCount'] > 0
 
-    @staticmethod
-    def __process_inverter_json(raw_inverter_json, raw_inventory_json):
-        inverter_data = []
-        for raw_json in raw_inverter_json:
+        if self._metered:
+            data = self.__process_meter_json(meter_json)
+        else:
+            # An inactive meter reports noise (ie. a slightly negative power and no energy), the inverters entry
+            # has the power
             data = dict()
-            data[SERIAL_NUMBER] = raw_json['serialNumber']
-            data[LAST_REPORT_DATE] = raw_json['lastReportDate']
-            data[DEVICE_TYPE] = raw_json['devType']
-            data[LAST_REPORT_WATTS] = raw_json['lastReportWatts']
-            data[MAX_REPORT_WATTS] = raw_json['maxReportWatts']
+            data[WATTS_NOW] = (inverters_json if inverters_json is not None else meter_json)['wNow']
+            if raw_extra_prod_json is not None:
+                data[WATT_HOURS_TODAY] = raw_extra_prod_json['wattHoursToday']
+                data[WATT_HOURS_SEVEN_DAYS] = raw_extra_prod_json['wattHoursSevenDays']
+                data[WATT_HOURS_LIFETIME] = raw_extra_prod_json['wattHoursLifetime']
+            else:
+                # The production meter was deactivated, the production api is fetched from the next poll
+                data[WATT_HOURS_TODAY] = data[WATT_HOURS_SEVEN_DAYS] = data[WATT_HOURS_LIFETIME] = None
+        # The active count of a meter is the number of meters
+        data[ACTIVE_INVERTERS] = (inverters_json if inverters_json is not None else meter_json)['activeCount']
 
-            # Lookup the inverter in the inventory
-            pcus = list(filter(lambda x: x['type'] == 'PCU', raw_inventory_json))[0]
-            inverter_in_inventory = list(filter(lambda x: x['serial_num'] == data[SERIAL_NUMBER], pcus['devices']))[0]
+        consumption = dict()
+        for raw_json in raw_prod_json.get('consumption', []):
+            # Like the production meter an inactive consumption meter reports noise
+            section = self.CONSUMPTION_SECTIONS.get(raw_json.get('measurementType'))
+            if section is not None and raw_json.get('activeCount', 0) > 0:
+                consumption[section] = ProductionData.from_dict(self.__process_meter_json(raw_json))
+        return ProductionData.from_dict(data), consumption
 
-            data[PCU_PRODUCING] = inverter_in_inventory['producing']
-            data[PCU_COMMUNICATING] = inverter_in_inventory['communicating']
-            data[PCU_DEVICE_STATUS] = inverter_in_inventory['device_status']
+    def __process_meter_json(self, raw_json):
+        data = dict()
+        data[WATTS_NOW] = raw_json['wNow']
+        data[WATT_HOURS_TODAY] = raw_json.get('whToday')
+        data[WATT_HOURS_SEVEN_DAYS] = raw_json.get('whLastSevenDays')
+        data[WATT_HOURS_LIFETIME] = raw_json['whLifetime']
+        lines = raw_json.get('lines')
+        if lines:
+            data[PHASES] = {phase: line['wNow'] for phase, line in zip(self.PHASE_NAMES, lines)}
+        return data
 
-            inverter_data.append(data)
-        return inverter_data
+    @staticmethod
+    def __process_inverter_json(raw_inverter_json, raw_inventory_json, previous=None):
+        """
+        Join the inverter readings with the inventory
+        :param previous: dict with the inverter data of the previous build with the same inventory, the record of
+        an inverter that did not report since is reused
+        :return: dict with the inverter data keyed by serial number
+        """
+        # Index the PCU devices of the inventory once, so every inverter lookup is O(1)
+        pcu_devices = dict()
+        for group in raw_inventory_json:
+            if group['type'] == 'PCU':
+                pcu_devices = {device['serial_num']: device for device in group['devices']}
+                break
 
+        inverter_data = dict()
+        no_device = dict()
+        if previous is None:
+            previous = no_device
+        for raw_json in raw_inverter_json:
+            serial_number = raw_json['serialNumber']
+            # The reading of an inverter only changes with a new report
+            record = previous.get(serial_number)
+            if (record is not None and record.last_report_date == raw_json['lastReportDate']
+                    and record.last_report_watts == raw_json['lastReportWatts']):
+                inverter_data[serial_number] = record
+                continue
+            inverter_in_inventory = pcu_devices.get(serial_number, no_device)
+            inverter_data[serial_number] = InverterData(
+                serial_number,
+                raw_json['lastReportDate'],
+                raw_json['devType'],
+                raw_json['lastReportWatts'],
+                raw_json['maxReportWatts'],
+                inverter_in_inventory.get('producing'),
+                inverter_in_inventory.get('communicating'),
+                inverter_in_inventory.get('device_status', []))
+        return inverter_data
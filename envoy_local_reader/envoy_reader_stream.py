@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import random
+
+import httpx
+
+from .envoy_digest_auth import EnvoyDigestAuth
+from .envoy_json_decoder import EnvoyJsonDecoder
+from .envoy_reader import EnvoyReader
+from .envoy_reader_exception import EnvoyReaderError, EnvoyReaderAuthError
+from .property_names_const import PRODUCTION, TOTAL_CONSUMPTION, NET_CONSUMPTION, WATTS_NOW, PHASES
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class MeterStreamParser:
+    """
+    Incremental parser of the meter stream, records are lines starting with "data:" followed by a JSON object.
+    Chunks can end anywhere, an incomplete line is kept until the next chunk completes it.
+    """
+
+    MAX_BUFFER = 1024 * 1024
+    SECTIONS = (
+        ("production", PRODUCTION),
+        ("total-consumption", TOTAL_CONSUMPTION),
+        ("net-consumption", NET_CONSUMPTION),
+    )
+
+    def __init__(self, json_decoder=None):
+        self.json_decoder = json_decoder if json_decoder is not None else EnvoyJsonDecoder()
+        self._buffer = b""
+
+    def feed(self, chunk):
+        """
+        :param chunk: the next bytes of the stream
+        :return: list with the records that were completed by the chunk
+        """
+        lines = (self._buffer + chunk).split(b"\n")
+        self._buffer = lines.pop()
+        if len(self._buffer) > self.MAX_BUFFER:
+            raise EnvoyReaderError("Meter stream record too large")
+
+        records = []
+        for line in lines:
+            line = line.strip()
+            if line.startswith(b"data:"):
+                try:
+                    records.append(self.json_decoder.decode(line[5:]))
+                except ValueError:
+                    _LOGGER.debug("Skipping malformed meter stream record")
+        return records
+
+    @classmethod
+    def to_snapshot(cls, record):
+        """
+        Convert a stream record to the sections of a snapshot, the power of the phases is summed up
+        """
+        data = dict()
+        for stream_key, section in cls.SECTIONS:
+            phases = record.get(stream_key)
+            if not isinstance(phases, dict) or len(phases) == 0:
+                continue
+            phase_watts = {phase: values.get('p', 0) for phase, values in phases.items()}
+            data[section] = {WATTS_NOW: sum(phase_watts.values()), PHASES: phase_watts}
+        return data
+
+
+class EnvoyMeterStream:
+    """
+    Reads the live meter stream of a metered Envoy-S over one long-lived chunked HTTP connection.
+
+    Every record of the stream (several per second) is parsed as soon as it arrives. The callback is called
+    with the latest snapshot sections at most once per min_update_interval, records arriving in between are
+    coalesced into the next update. When the stream ends or fails the connection is made again after a
+    delay that doubles on every failed attempt up to max_reconnect_delay.
+
+    latest has the sections of the last record while the stream is connected, it is None when the connection
+    ended, so values of a closed stream are not taken for live values.
+
+    The stream needs the installer credentials of the Envoy.
+    """
+
+    STREAM_URL = "stream/meter"
+    MIN_UPDATE_INTERVAL = 1.0
+    RECONNECT_DELAY = 1.0
+    MAX_RECONNECT_DELAY = 300.0
+    READ_TIMEOUT = 30
+
+    def __init__(self, host, port=80, username="installer", password="", callback=None,
+                 min_update_interval=MIN_UPDATE_INTERVAL, reconnect_delay=RECONNECT_DELAY,
+                 max_reconnect_delay=MAX_RECONNECT_DELAY, session=None):
+        self.host = host.lower()
+        self.port = port
+        self.auth = EnvoyDigestAuth(username, password)
+        self.callback = callback
+        self.min_update_interval = min_update_interval
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.latest = None
+        self.record_count = 0
+        self.update_count = 0
+        self.connect_count = 0
+        self._session = session
+        self._owns_session = session is None
+        self._task = None
+        self._pending_update = None
+        self._last_update = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = EnvoyReader.create_session(max_keep_alive_connections=1)
+            self._owns_session = True
+        return self._session
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending_update is not None:
+            self._pending_update.cancel()
+            self._pending_update = None
+        if self._session is not None and self._owns_session:
+            await self._session.aclose()
+            self._session = None
+
+    async def run(self):
+        """
+        Read the stream until cancelled, reconnecting with exponential backoff
+        """
+        delay = self.reconnect_delay
+        while True:
+            try:
+                if await self.__read_stream():
+                    delay = self.reconnect_delay
+            except (httpx.HTTPError, EnvoyReaderError) as ex:
+                _LOGGER.debug("Meter stream of Envoy %s failed: %s", self.host, ex)
+
+            # Jitter keeps several streams from reconnecting in lockstep
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def __read_stream(self):
+        parser = MeterStreamParser()
+        received = False
+        self.connect_count += 1
+        timeout = httpx.Timeout(EnvoyReader.HTTP_TIMEOUT, read_timeout=self.READ_TIMEOUT)
+        try:
+            async with self.session.stream("GET", "http://{}:{}/{}".format(self.host, self.port, self.STREAM_URL),
+                                           auth=self.auth, timeout=timeout) as resp:
+                if resp.status_code == 401:
+                    raise EnvoyReaderAuthError("Authentication failed for {}".format(self.STREAM_URL))
+                if resp.status_code != 200:
+                    raise EnvoyReaderError("Cannot complete http request, error: {}".format(resp.status_code))
+
+                async for chunk in resp.aiter_bytes():
+                    for record in parser.feed(chunk):
+                        received = True
+                        self.__handle_record(record)
+        finally:
+            self.latest = None
+        return received
+
+    def __handle_record(self, record):
+        self.record_count += 1
+        self.latest = MeterStreamParser.to_snapshot(record)
+        if self._pending_update is not None:
+            # An update is already scheduled, it will send this record
+            return
+
+        loop = asyncio.get_event_loop()
+        wait = 0 if self._last_update is None else self._last_update + self.min_update_interval - loop.time()
+        if wait <= 0:
+            self.__send_update()
+        else:
+            self._pending_update = loop.call_later(wait, self.__send_update)
+
+    def __send_update(self):
+        self._pending_update = None
+        if self.latest is None:
+            # The stream was closed before the update was due
+            return
+        self._last_update = asyncio.get_event_loop().time()
+        self.update_count += 1
+        if self.callback is not None:
+            self.callback(self.latest)
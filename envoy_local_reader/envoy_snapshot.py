@@ -0,0 +1,195 @@
+import time
+from collections.abc import Mapping
+from operator import attrgetter
+
+from .property_names_const import (
+    WATTS_NOW,
+    WATT_HOURS_TODAY,
+    WATT_HOURS_SEVEN_DAYS,
+    WATT_HOURS_LIFETIME,
+    ACTIVE_INVERTERS,
+    PHASES,
+    SERIAL_NUMBER,
+    LAST_REPORT_DATE,
+    DEVICE_TYPE,
+    LAST_REPORT_WATTS,
+    MAX_REPORT_WATTS,
+    PCU_PRODUCING,
+    PCU_COMMUNICATING,
+    PCU_DEVICE_STATUS,
+    PRODUCTION,
+    TOTAL_CONSUMPTION,
+    NET_CONSUMPTION,
+    INVERTERS,
+    UNCHANGED,
+    SECTION_STATUS,
+    STATUS,
+    AGE,
+    STALE)
+
+
+class SnapshotRecord(Mapping):
+    """
+    Immutable record of a snapshot section, it is a read only mapping of the field names (the property names) to
+    the values, so it can be used wherever the section used to be a dict.
+
+    Every field of FIELDS is a read only property of a private slot, the __init__ of the subclass sets the slots.
+    Compared to a dict a record takes less than half the memory and is built as fast, the values are read as
+    attributes (ie. inverter.last_report_watts) as well. Fields in OPTIONAL_FIELDS may be left out, when they are
+    None they are not in the mapping, like a key that was not set.
+
+    json and orjson refuse a record, as_dict() returns the dict to serialize.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+    OPTIONAL_FIELDS = frozenset()
+    _FIELD_SET = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls.FIELDS)
+        for field in cls.FIELDS:
+            setattr(cls, field, property(attrgetter("_" + field)))
+
+    def __getitem__(self, key):
+        if key not in self._FIELD_SET:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None and key in self.OPTIONAL_FIELDS:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        if len(self.OPTIONAL_FIELDS) == 0:
+            return iter(self.FIELDS)
+        return (field for field in self.FIELDS
+                if field not in self.OPTIONAL_FIELDS or getattr(self, field) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.__values() == other.__values()
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(field, value) for field, value in self.items()))
+
+    def __reduce__(self):
+        return type(self), self.__values()
+
+    def __values(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def as_dict(self):
+        """
+        :return: the section as dict, ie. to serialize it
+        """
+        return dict(self.items())
+
+    def _replace(self, **changes):
+        return type(self)(*[changes.pop(field, getattr(self, field)) for field in self.FIELDS], **changes)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: dict with the values of the fields, optional fields may be left out
+        """
+        return cls(**data)
+
+
+PRODUCTION_FIELDS = (WATTS_NOW, WATT_HOURS_TODAY, WATT_HOURS_SEVEN_DAYS, WATT_HOURS_LIFETIME, ACTIVE_INVERTERS, PHASES)
+INVERTER_FIELDS = (SERIAL_NUMBER, LAST_REPORT_DATE, DEVICE_TYPE, LAST_REPORT_WATTS, MAX_REPORT_WATTS, PCU_PRODUCING,
+                   PCU_COMMUNICATING, PCU_DEVICE_STATUS)
+
+
+class ProductionData(SnapshotRecord):
+    """
+    The production or consumption section of a snapshot, the power in W and the energy in Wh. The active inverters
+    (not known for the consumption) and the power per phase (only of metered Envoys) are optional.
+    """
+
+    __slots__ = tuple("_" + field for field in PRODUCTION_FIELDS)
+    FIELDS = PRODUCTION_FIELDS
+    OPTIONAL_FIELDS = frozenset((ACTIVE_INVERTERS, PHASES))
+
+    def __init__(self, watts_now, watt_hours_today, watt_hours_seven_days, watt_hours_lifetime,
+                 active_inverters=None, phases=None):
+        self._watts_now = watts_now
+        self._watt_hours_today = watt_hours_today
+        self._watt_hours_seven_days = watt_hours_seven_days
+        self._watt_hours_lifetime = watt_hours_lifetime
+        self._active_inverters = active_inverters
+        self._phases = phases
+
+
+class InverterData(SnapshotRecord):
+    """
+    The readings of one inverter joined with its state in the inventory
+    """
+
+    __slots__ = tuple("_" + field for field in INVERTER_FIELDS)
+    FIELDS = INVERTER_FIELDS
+
+    def __init__(self, serial_number, last_report_date, device_type, last_report_watts, max_report_watts,
+                 producing, communicating, device_status):
+        self._serial_number = serial_number
+        self._last_report_date = last_report_date
+        self._device_type = device_type
+        self._last_report_watts = last_report_watts
+        self._max_report_watts = max_report_watts
+        self._producing = producing
+        self._communicating = communicating
+        self._device_status = device_status
+
+
+# Sections of a snapshot that are persisted, the inverter health is analyzed again from the inverters
+PERSISTED_SECTIONS = (PRODUCTION, TOTAL_CONSUMPTION, NET_CONSUMPTION)
+SAVED_AT = "saved_at"
+
+
+def snapshot_to_dict(data, now=None):
+    """
+    Convert a snapshot to plain dicts and lists, ie. to store the last good snapshot as json
+    :param data: the snapshot of an EnvoyReader
+    :param now: the time.time() of the snapshot, now by default
+    :return: dict with the serial number, the production and consumption sections and the inverters
+    """
+    stored = {
+        SAVED_AT: time.time() if now is None else now,
+        SERIAL_NUMBER: data.get(SERIAL_NUMBER),
+        INVERTERS: {serial_number: dict(inverter) for serial_number, inverter in data[INVERTERS].items()},
+    }
+    for section in PERSISTED_SECTIONS:
+        # The meter stream replaces the records by dicts, both are mappings
+        if data.get(section) is not None:
+            stored[section] = dict(data[section])
+    return stored
+
+
+def snapshot_from_dict(stored, now=None):
+    """
+    Restore a snapshot converted by snapshot_to_dict. Every section is marked stale with the age of the snapshot,
+    fields that were not stored (ie. the energy of a section of the meter stream) are None.
+    :param stored: dict returned by snapshot_to_dict
+    :param now: the current time.time(), now by default
+    :return: the snapshot
+    """
+    age = round((time.time() if now is None else now) - stored[SAVED_AT], 1)
+    data = {
+        SERIAL_NUMBER: stored[SERIAL_NUMBER],
+        INVERTERS: {serial_number: InverterData(*[inverter.get(field) for field in INVERTER_FIELDS])
+                    for serial_number, inverter in stored[INVERTERS].items()},
+        UNCHANGED: False,
+    }
+    for section in PERSISTED_SECTIONS:
+        if section in stored:
+            data[section] = ProductionData(*[stored[section].get(field) for field in PRODUCTION_FIELDS])
+    data[SECTION_STATUS] = {section: {STATUS: STALE, AGE: age}
+                            for section in (INVERTERS,) + PERSISTED_SECTIONS if section in data}
+    return data
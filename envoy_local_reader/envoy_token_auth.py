@@ -0,0 +1,191 @@
+import asyncio
+import base64
+import json
+import time
+
+import httpx
+
+from .envoy_reader_exception import EnvoyReaderError, EnvoyReaderAuthError
+
+
+class EnvoyTokenAuth(httpx.Auth):
+    """
+    Token authentication of Envoys with newer firmware (D7 and later).
+
+    The owner logs in at Enlighten and requests a token (a JWT) for the serial number of the Envoy. The Envoy
+    checks the token once at auth/check_jwt and answers with a session cookie, the requests are sent with that
+    cookie, or with the token as bearer while there is no session.
+
+    The token is requested with a client of its own that verifies the certificates of Enlighten, the sessions
+    passed in are connected to the Envoy (https with a self-signed certificate).
+
+    Fetching a token is slow and rate limited, so the token, its expiry and the session cookie are persisted in
+    a cache (EnvoyReaderCache) and reused across polls and restarts. ensure_token fetches a new token
+    refresh_margin seconds before the token expires, renew is called once for a request the Envoy rejected.
+    Every change of the credentials increments generation, so concurrent requests rejected with the same
+    credentials renew them only once.
+    """
+
+    LOGIN_URL = "https://enlighten.enphaseenergy.com/login/login.json"
+    TOKEN_URL = "https://entrez.enphaseenergy.com/tokens"
+    CHECK_JWT_URL = "auth/check_jwt"
+    SESSION_COOKIE = "sessionId"
+    REFRESH_MARGIN = 3600
+    HTTP_TIMEOUT = 20
+
+    def __init__(self, username, password, serial_number, host, port=443, cache=None, cache_key=None,
+                 login_url=LOGIN_URL, token_url=TOKEN_URL, refresh_margin=REFRESH_MARGIN, clock=time.time,
+                 scheme="https"):
+        self.username = username
+        self.password = password
+        self.serial_number = serial_number
+        self.host = host
+        self.port = port
+        self.scheme = scheme
+        self.cache = cache
+        self.cache_key = cache_key if cache_key is not None else "{}:{}".format(host, port)
+        self.login_url = login_url
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.token = None
+        self.expires_at = None
+        self.session_id = None
+        self.generation = 0
+        self._loaded = False
+        self._lock = None
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def auth_flow(self, request):
+        # The session cookie set by the Envoy replaces any cookie of the (shared) cookie jar of the client
+        if "Cookie" in request.headers:
+            del request.headers["Cookie"]
+        if self.session_id is not None:
+            request.headers["Cookie"] = "{}={}".format(self.SESSION_COOKIE, self.session_id)
+        elif self.token is not None:
+            request.headers["Authorization"] = "Bearer {}".format(self.token)
+        yield request
+
+    @property
+    def expiring(self):
+        """
+        :return: True when there is no token or it expires within refresh_margin seconds
+        """
+        if self.token is None:
+            return True
+        return self.expires_at is not None and self.expires_at - self.clock() < self.refresh_margin
+
+    async def ensure_token(self, session):
+        """
+        Load the cached token or fetch a new one when it (nearly) expired, and open a session on the Envoy
+        :raises EnvoyReaderAuthError: when Enlighten or the Envoy rejected the credentials
+        """
+        async with self.lock:
+            if not self._loaded:
+                await self.__load_cache()
+            if self.expiring:
+                await self.__fetch_token()
+            if self.session_id is None:
+                await self.__check_token(session)
+
+    async def renew(self, session, generation):
+        """
+        Renew the credentials after the Envoy rejected a request, first the session with the current token and
+        when the Envoy rejects the token as well with a new token
+        :param generation: the generation of the credentials the rejected request was sent with
+        :return: True when the request can be retried with renewed credentials
+        """
+        async with self.lock:
+            if generation != self.generation:
+                # Renewed by a concurrent request meanwhile
+                return True
+            self.session_id = None
+            if self.token is not None:
+                try:
+                    await self.__check_token(session)
+                    return True
+                except EnvoyReaderAuthError:
+                    pass
+            await self.__fetch_token()
+            await self.__check_token(session)
+            return True
+
+    def reset(self):
+        """
+        Keep the credentials, the session cookie does not depend on the connections of the client
+        """
+
+    @staticmethod
+    def token_expiry(token):
+        """
+        :param token: JWT
+        :return: the exp claim of the token, None when the token cannot be decoded
+        """
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return claims.get("exp")
+        except (IndexError, ValueError, AttributeError, TypeError):
+            return None
+
+    async def __fetch_token(self):
+        try:
+            async with httpx.AsyncClient(timeout=httpx.Timeout(self.HTTP_TIMEOUT)) as session:
+                resp = await session.post(self.login_url, data={"user[email]": self.username,
+                                                                "user[password]": self.password})
+                if resp.status_code != 200:
+                    raise EnvoyReaderAuthError("Enlighten login failed, error: {}".format(resp.status_code))
+                resp = await session.post(self.token_url, json={"session_id": resp.json()["session_id"],
+                                                                "serial_num": self.serial_number,
+                                                                "username": self.username})
+        except httpx.HTTPError as ex:
+            raise EnvoyReaderError("Cannot connect: {}".format(ex.__str__()))
+        except (KeyError, ValueError):
+            raise EnvoyReaderAuthError("Enlighten login failed, no session")
+        if resp.status_code != 200:
+            raise EnvoyReaderAuthError("Token request failed, error: {}".format(resp.status_code))
+        self.token = resp.text.strip()
+        self.expires_at = self.token_expiry(self.token)
+        self.session_id = None
+        self.generation += 1
+        await self.__save_cache()
+
+    async def __check_token(self, session):
+        try:
+            url = "{}://{}:{}/{}".format(self.scheme, self.host, self.port, self.CHECK_JWT_URL)
+            resp = await session.get(url, headers={"Authorization": "Bearer {}".format(self.token)})
+        except httpx.HTTPError as ex:
+            raise EnvoyReaderError("Cannot connect: {}".format(ex.__str__()))
+        if resp.status_code != 200:
+            raise EnvoyReaderAuthError("The Envoy rejected the token, error: {}".format(resp.status_code))
+        # Without a session cookie the requests are sent with the token as bearer
+        self.session_id = resp.cookies.get(self.SESSION_COOKIE)
+        self.generation += 1
+        await self.__save_cache()
+
+    async def __load_cache(self):
+        self._loaded = True
+        if self.cache is None:
+            return
+        entry = await self.cache.get(self.cache_key)
+        if entry is None or entry.get("serial_number") != self.serial_number:
+            return
+        self.token = entry["token"]
+        self.expires_at = entry["expires_at"]
+        self.session_id = entry["session_id"]
+        self.generation += 1
+
+    async def __save_cache(self):
+        if self.cache is None:
+            return
+        await self.cache.set(self.cache_key, {
+            "serial_number": self.serial_number,
+            "token": self.token,
+            "expires_at": self.expires_at,
+            "session_id": self.session_id,
+        })
@@ -0,0 +1,85 @@
+import random
+import time
+
+from .property_names_const import PRODUCTION, INVERTERS, WATTS_NOW, PCU_PRODUCING
+
+
+class AdaptivePollPolicy:
+    """
+    Decides the interval until the next poll of an Envoy.
+
+    While the site produces the Envoy is polled at poll_interval. When the production was at most
+    IDLE_WATTS (a metered Envoy reports a slightly negative production at night), or without a production
+    none of the inverters produced, for idle_delay seconds the interval grows to idle_interval, so the Envoy
+    is hardly polled at night. The first poll with production switches back to poll_interval, with the
+    seconds until sunrise the idle interval is shortened so the poll at dawn is not missed.
+
+    Consecutive failed polls back off exponentially from poll_interval up to max_backoff_interval with a
+    random jitter, so several Envoys that became unreachable together do not retry in lockstep. The
+    first successful poll resets the backoff.
+    """
+
+    IDLE_INTERVAL = 300
+    IDLE_DELAY = 900
+    MAX_BACKOFF_INTERVAL = 600
+    JITTER = 0.2
+    IDLE_WATTS = 1
+
+    def __init__(self, poll_interval, idle_interval=IDLE_INTERVAL, idle_delay=IDLE_DELAY,
+                 max_backoff_interval=MAX_BACKOFF_INTERVAL, jitter=JITTER, clock=time.monotonic):
+        self.poll_interval = poll_interval
+        self.idle_interval = max(idle_interval, poll_interval)
+        self.idle_delay = idle_delay
+        self.max_backoff_interval = max(max_backoff_interval, poll_interval)
+        self.jitter = jitter
+        self.clock = clock
+        self.failures = 0
+        self._idle_since = None
+
+    @property
+    def idle(self):
+        """
+        :return: True when the site did not produce for at least idle_delay seconds
+        """
+        return self._idle_since is not None and self.clock() - self._idle_since >= self.idle_delay
+
+    def next_interval(self, data=None, error=None, seconds_until_sunrise=None):
+        """
+        Update the policy with the result of a poll
+        :param data: the snapshot of a successful poll
+        :param error: the error of a failed poll
+        :param seconds_until_sunrise: optional, used to wake up in time while idle
+        :return: the interval in seconds until the next poll
+        """
+        if error is not None:
+            self.failures += 1
+            backoff = min(self.poll_interval * 2 ** self.failures, self.max_backoff_interval)
+            return backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        self.failures = 0
+        if data is not None:
+            if self.is_producing(data):
+                self._idle_since = None
+            elif self._idle_since is None:
+                self._idle_since = self.clock()
+
+        if not self.idle:
+            return self.poll_interval
+        if seconds_until_sunrise is not None:
+            return max(self.poll_interval, min(self.idle_interval, seconds_until_sunrise))
+        return self.idle_interval
+
+    @classmethod
+    def is_producing(cls, data):
+        """
+        :return: False when the production is at most IDLE_WATTS, or without a production when none of the
+        inverters produces
+        """
+        # The inventory is refreshed hourly, at dawn it may still have the producing state of the night
+        watts_now = (data.get(PRODUCTION) or {}).get(WATTS_NOW)
+        if watts_now is not None:
+            return watts_now > cls.IDLE_WATTS
+        inverters = data.get(INVERTERS) or {}
+        if len(inverters) > 0 and all(inverter.get(PCU_PRODUCING) is False for inverter in inverters.values()):
+            return False
+        return True
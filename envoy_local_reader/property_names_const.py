@@ -12,4 +12,14 @@ SERIAL_NUMBER = 'serial_number'
 LAST_REPORT_WATTS = 'last_report_watts'
 PCU_PRODUCING = "producing"
 PCU_COMMUNICATING = "communicating"
-PCU_DEVICE_STATUS = "device_status"
\ No newline at end of file
+PCU_DEVICE_STATUS = "device_status"
+UNCHANGED = 'unchanged'
+TOTAL_CONSUMPTION = 'total_consumption'
+NET_CONSUMPTION = 'net_consumption'
+PHASES = 'phases'
+INVERTER_HEALTH = 'inverter_health'
+SECTION_STATUS = 'section_status'
+STATUS = 'status'
+AGE = 'age'
+FRESH = 'fresh'
+STALE = 'stale'
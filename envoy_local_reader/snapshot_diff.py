@@ -0,0 +1,18 @@
+def changed_keys(old, new):
+    """
+    Compare a section (ie. the production data or the inverters) of two snapshots
+    :param old: dict with the section of the previous snapshot, or None
+    :param new: dict with the section of the new snapshot, or None
+    :return: set with the keys that were added, removed or of which the value changed
+    """
+    # Sections that were not refetched are the same object as in the previous snapshot
+    if old is new:
+        return set()
+    if old is None:
+        return set(new)
+    if new is None:
+        return set(old)
+
+    changed = {key for key, value in new.items() if key not in old or old[key] != value}
+    changed.update(key for key in old if key not in new)
+    return changed
@@ -1,18 +1,32 @@
 """Support for Enphase Envoy solar energy monitor."""
+import asyncio
 import logging
 import json
 import async_timeout
 
 from datetime import timedelta, datetime, timezone
 #from envoy_reader.envoy_reader import EnvoyReader
+from .envoy_local_reader.envoy_reader import EnvoyReader
+from .envoy_local_reader.envoy_fleet import EnvoyFleet
+from .envoy_local_reader.envoy_capture import EnvoyCapture
 from .envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
+from .envoy_local_reader.envoy_reader_stream import EnvoyMeterStream
+from .envoy_local_reader.envoy_history import ReadingHistory
+from .envoy_local_reader.poll_policy import AdaptivePollPolicy
+from .envoy_local_reader import inverter_health
+from .envoy_local_reader.inverter_health import InverterHealth, InverterHealthReport
+from .envoy_local_reader.envoy_reader_exception import EnvoyReaderError
+from .envoy_local_reader.envoy_snapshot import snapshot_to_dict, snapshot_from_dict
 from .envoy_local_reader import property_names_const as envoy_prop_names
+from .envoy_local_reader.snapshot_diff import changed_keys
 
+from aiohttp import web
+
+from homeassistant.components.http import HomeAssistantView
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
 
-import requests
 import voluptuous as vol
 
 from homeassistant.components.sensor import PLATFORM_SCHEMA
@@ -23,10 +37,16 @@ from homeassistant.const import (
     CONF_PASSWORD,
     CONF_USERNAME,
     ENERGY_WATT_HOUR,
+    EVENT_HOMEASSISTANT_STOP,
     POWER_WATT,
+    SUN_EVENT_SUNRISE,
 )
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.storage import Store
+from homeassistant.helpers.sun import get_astral_event_next
+import homeassistant.util.dt as dt_util
+from homeassistant.util import slugify
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -59,14 +79,155 @@ SENSORS = {
         'watt_hours_lifetime',
         ICON_SOLAR),
 
+    "consumption": (
+        "Envoy Current Energy Consumption",
+        POWER_WATT,
+        'watts_now',
+        ICON),
+
+    "daily_consumption": (
+        "Envoy Today's Energy Consumption",
+        ENERGY_WATT_HOUR,
+        'watt_hours_today',
+        ICON),
+
+    "seven_days_consumption": (
+        "Envoy Last Seven Days Energy Consumption",
+        ENERGY_WATT_HOUR,
+        'watt_hours_seven_days',
+        ICON),
+
+    "lifetime_consumption": (
+        "Envoy Lifetime Energy Consumption",
+        ENERGY_WATT_HOUR,
+        'watt_hours_lifetime',
+        ICON),
+
+    "net_consumption": (
+        "Envoy Current Net Power Consumption",
+        POWER_WATT,
+        'watts_now',
+        ICON),
+
     "inverters": (
         "Envoy Inverter",
         POWER_WATT,
         'last_report_watts',
         ICON_SOLAR),
+
+    "average_production": (
+        "Envoy Average Energy Production",
+        POWER_WATT,
+        'watts_now',
+        ICON_SOLAR),
+
+    "inverters_underperforming": (
+        "Envoy Underperforming Inverters",
+        "inverters",
+        inverter_health.UNDERPERFORMING,
+        ICON_SOLAR),
+
+    "inverters_stale": (
+        "Envoy Stale Inverters",
+        "inverters",
+        inverter_health.STALE,
+        ICON_SOLAR),
+
+    "inverters_outliers": (
+        "Envoy Outlier Inverters",
+        "inverters",
+        inverter_health.OUTLIER,
+        ICON_SOLAR),
+}
+
+# Snapshot section of the sensors that are not read from the production section, the consumption sections are only
+# in the snapshot of a metered Envoy
+SENSOR_SECTIONS = {
+    "consumption": envoy_prop_names.TOTAL_CONSUMPTION,
+    "daily_consumption": envoy_prop_names.TOTAL_CONSUMPTION,
+    "seven_days_consumption": envoy_prop_names.TOTAL_CONSUMPTION,
+    "lifetime_consumption": envoy_prop_names.TOTAL_CONSUMPTION,
+    "net_consumption": envoy_prop_names.NET_CONSUMPTION,
+}
+
+# Sections of the snapshot that are diffed key by key
+METER_SECTIONS = (
+    envoy_prop_names.PRODUCTION,
+    envoy_prop_names.TOTAL_CONSUMPTION,
+    envoy_prop_names.NET_CONSUMPTION,
+)
+
+# Attributes with the status of the section of a sensor, the consumption sections are built from the production
+# endpoints and have the status of the production section
+SECTION_STATUS_ATTRIBUTE = "section_status"
+SECTION_AGE_ATTRIBUTE = "section_age"
+
+# Diagnostic sensors, created when diagnostics is enabled. The data key is the key in EnvoyMetrics.summary
+DIAGNOSTIC_SENSORS = {
+    "refresh_duration": (
+        "Envoy Refresh Duration",
+        "ms",
+        'last_refresh_ms',
+        "mdi:timer-outline"),
+
+    "request_latency": (
+        "Envoy Request Latency",
+        "ms",
+        'last_latency_ms',
+        "mdi:timer-outline"),
+
+    "request_errors": (
+        "Envoy Request Errors",
+        "errors",
+        'errors',
+        "mdi:alert-circle-outline"),
+}
+
+
+# Flag of the inverters listed in the attributes of the inverter health sensors
+HEALTH_FLAGS = {
+    inverter_health.UNDERPERFORMING: InverterHealthReport.UNDERPERFORMING_FLAG,
+    inverter_health.STALE: InverterHealthReport.STALE_FLAG,
+    inverter_health.OUTLIER: InverterHealthReport.OUTLIER_FLAG,
 }
 
+# Window of the average_production sensor
+AVERAGE_WINDOW = timedelta(minutes=15)
+
+DOMAIN = "enphase_envoy"
+METRICS_URL = "/api/enphase_envoy/metrics"
+METRICS_VIEW = f"{DOMAIN}_metrics_view"
+# The discovered Envoy types and the tokens are kept in the storage of Home Assistant, like the snapshots
+DISCOVERY_STORAGE_KEY = f"{DOMAIN}.discovery"
+TOKEN_STORAGE_KEY = f"{DOMAIN}.tokens"
+CACHE_STORAGE_VERSION = 1
+# The last good snapshot of every Envoy is stored, so the entities are created at startup without waiting for it
+SNAPSHOT_STORAGE_KEY = f"{DOMAIN}.snapshot_{{}}"
+SNAPSHOT_STORAGE_VERSION = 1
+# Seconds the snapshot is saved after a refresh, the refreshes in between are written once
+SNAPSHOT_SAVE_DELAY = 60
+
 CONST_DEFAULT_HOST = "envoy"
+# Refreshes requested within this many seconds of the last one (ie. update_entity) reuse its snapshot
+DEFAULT_SNAPSHOT_MAX_AGE = 5
+
+CONF_MAX_CONCURRENT_REQUESTS = "max_concurrent_requests"
+CONF_PRODUCTION_INTERVAL = "production_interval"
+CONF_ENERGY_INTERVAL = "energy_interval"
+CONF_INVERTERS_INTERVAL = "inverters_interval"
+CONF_INVENTORY_INTERVAL = "inventory_interval"
+CONF_METER_STREAM = "meter_stream"
+CONF_STREAM_USERNAME = "stream_username"
+CONF_STREAM_PASSWORD = "stream_password"
+CONF_STREAM_UPDATE_INTERVAL = "stream_update_interval"
+CONF_DIAGNOSTICS = "diagnostics"
+CONF_IDLE_INTERVAL = "idle_interval"
+CONF_IDLE_DELAY = "idle_delay"
+CONF_MAX_BACKOFF_INTERVAL = "max_backoff_interval"
+CONF_SNAPSHOT_MAX_AGE = "snapshot_max_age"
+CONF_AUTH_MODE = "auth_mode"
+CONF_CAPTURE_FILE = "capture_file"
+CONF_MAX_STALE_AGE = "max_stale_age"
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
@@ -77,6 +238,30 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
             cv.ensure_list, [vol.In(list(SENSORS))]
         ),
         vol.Optional(CONF_NAME, default=""): cv.string,
+        # Global: the limit of the fleet shared by all Envoy platforms, see async_get_fleet
+        vol.Optional(CONF_MAX_CONCURRENT_REQUESTS): cv.positive_int,
+        vol.Optional(CONF_PRODUCTION_INTERVAL,
+                     default=EnvoyReader.REFRESH_INTERVALS[EnvoyReader.PRODUCTION_JSON_URL]): cv.positive_int,
+        vol.Optional(CONF_ENERGY_INTERVAL,
+                     default=EnvoyReader.REFRESH_INTERVALS[EnvoyReader.PRODUCTION_API_URL]): cv.positive_int,
+        vol.Optional(CONF_INVERTERS_INTERVAL,
+                     default=EnvoyReader.REFRESH_INTERVALS[EnvoyReader.INVERTERS_API_URL]): cv.positive_int,
+        vol.Optional(CONF_INVENTORY_INTERVAL,
+                     default=EnvoyReader.REFRESH_INTERVALS[EnvoyReader.INVENTORY_JSON_URL]): cv.positive_int,
+        vol.Optional(CONF_METER_STREAM, default=False): cv.boolean,
+        vol.Optional(CONF_STREAM_USERNAME, default="installer"): cv.string,
+        vol.Optional(CONF_STREAM_PASSWORD, default=""): cv.string,
+        vol.Optional(CONF_STREAM_UPDATE_INTERVAL, default=EnvoyMeterStream.MIN_UPDATE_INTERVAL): vol.Coerce(float),
+        vol.Optional(CONF_DIAGNOSTICS, default=False): cv.boolean,
+        vol.Optional(CONF_IDLE_INTERVAL, default=AdaptivePollPolicy.IDLE_INTERVAL): cv.positive_int,
+        vol.Optional(CONF_IDLE_DELAY, default=AdaptivePollPolicy.IDLE_DELAY): cv.positive_int,
+        vol.Optional(CONF_MAX_BACKOFF_INTERVAL, default=AdaptivePollPolicy.MAX_BACKOFF_INTERVAL): cv.positive_int,
+        vol.Optional(CONF_SNAPSHOT_MAX_AGE, default=DEFAULT_SNAPSHOT_MAX_AGE): vol.Coerce(float),
+        vol.Optional(CONF_CAPTURE_FILE): cv.string,
+        vol.Optional(CONF_MAX_STALE_AGE, default=EnvoyReader.MAX_STALE_AGE): cv.positive_int,
+        vol.Optional(CONF_AUTH_MODE, default=EnvoyReaderFactory.AUTH_AUTO): vol.In(
+            [EnvoyReaderFactory.AUTH_AUTO, EnvoyReaderFactory.AUTH_DIGEST, EnvoyReaderFactory.AUTH_TOKEN]
+        ),
     }
 )
 
@@ -88,55 +273,155 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     name = config[CONF_NAME]
     username = config[CONF_USERNAME]
     password = config[CONF_PASSWORD]
+    max_concurrent_requests = config.get(CONF_MAX_CONCURRENT_REQUESTS)
+    # Every Envoy endpoint is refreshed at its own interval, the coordinator polls at the shortest one
+    refresh_intervals = {
+        EnvoyReader.PRODUCTION_JSON_URL: config[CONF_PRODUCTION_INTERVAL],
+        EnvoyReader.PRODUCTION_URL: config[CONF_PRODUCTION_INTERVAL],
+        EnvoyReader.PRODUCTION_API_URL: config[CONF_ENERGY_INTERVAL],
+        EnvoyReader.INVERTERS_API_URL: config[CONF_INVERTERS_INTERVAL],
+        EnvoyReader.INVENTORY_JSON_URL: config[CONF_INVENTORY_INTERVAL],
+    }
     _LOGGER.info("Envoy async_setup_platform called")
 
-    f = EnvoyReaderFactory(host=ip_address, username=username, password=password)
-    # The factory will return a reader based on the SW/FW version found in info.xml
-    envoy_reader = await f.get_reader()
-
+    # Record the raw responses, ie. to replay a real day against the mock Envoy of the tests
+    capture = EnvoyCapture(hass.config.path(config[CONF_CAPTURE_FILE])) if CONF_CAPTURE_FILE in config else None
     entities = []
 
+    # All configured Envoys share one connection pool and request limit
+    fleet = async_get_fleet(hass, max_concurrent_requests)
+
+    def create_poll_policy(poll_interval, failures=0):
+        # Poll slower at night and back off while the Envoy fails
+        policy = AdaptivePollPolicy(
+            poll_interval,
+            idle_interval=config[CONF_IDLE_INTERVAL],
+            idle_delay=config[CONF_IDLE_DELAY],
+            max_backoff_interval=config[CONF_MAX_BACKOFF_INTERVAL],
+        )
+        policy.failures = failures
+        return policy
+
+    # Until the reader is created (the Envoy may be down at startup) the shortest configured interval is used
+    poll_policy = create_poll_policy(min(refresh_intervals.values()))
+
+    async def async_get_reader():
+        # The factory of the fleet returns a reader based on the SW/FW version found in info.xml
+        nonlocal poll_policy
+        envoy_reader = await fleet.add_host(ip_address, username=username, password=password,
+                                            refresh_intervals=refresh_intervals,
+                                            snapshot_max_age=config[CONF_SNAPSHOT_MAX_AGE],
+                                            auth_mode=config[CONF_AUTH_MODE],
+                                            token_cache=async_get_token_cache(hass),
+                                            capture=capture,
+                                            max_stale_age=config[CONF_MAX_STALE_AGE])
+        if poll_policy.poll_interval != envoy_reader.poll_interval:
+            poll_policy = create_poll_policy(envoy_reader.poll_interval, poll_policy.failures)
+        return envoy_reader
+
+    store = Store(hass, SNAPSHOT_STORAGE_VERSION, SNAPSHOT_STORAGE_KEY.format(slugify(ip_address)))
+    # The meter stream of a metered Envoy-S, its values are newer than the power values of the polls
+    meter_stream = None
+
     async def async_update_data():
         try:
+            # The reader keeps its endpoints within EnvoyReader.REFRESH_DEADLINE, so a slow endpoint results in a
+            # partial snapshot with a stale section before this timeout discards the whole refresh
             async with async_timeout.timeout(10):
-                return await envoy_reader.get_data()
-        except requests.exceptions.HTTPError as err:
-            raise UpdateFailed(f"Error communicating with API: {err}")
+                # The reader is created with the first refresh, the Envoy may be down at startup
+                await async_get_reader()
+                result = await fleet.poll_host(ip_address)
+        except asyncio.TimeoutError as ex:
+            coordinator.update_interval = timedelta(seconds=poll_policy.next_interval(error=ex))
+            raise UpdateFailed("Timeout communicating with API")
+        except EnvoyReaderError as ex:
+            # The Envoy could not be detected, backs off like a failed poll
+            coordinator.update_interval = timedelta(seconds=poll_policy.next_interval(error=ex))
+            raise UpdateFailed(f"Error detecting the Envoy: {ex}")
+        # The coordinator schedules the next refresh with the interval set here
+        if not result.success:
+            coordinator.update_interval = timedelta(seconds=poll_policy.next_interval(error=result.error))
+            raise UpdateFailed(f"Error communicating with API: {result.error}")
+        coordinator.update_interval = timedelta(seconds=poll_policy.next_interval(
+            data=result.data, seconds_until_sunrise=seconds_until_sunrise(hass)))
+        # Saved with the meter stream values merged into the snapshot by then
+        store.async_delay_save(lambda: snapshot_to_dict(coordinator.data), SNAPSHOT_SAVE_DELAY)
+        if meter_stream is not None and meter_stream.latest is not None:
+            # The polled power is up to a poll interval old, the sensors keep the live values of the stream
+            return merge_stream_sections(result.data, meter_stream.latest)
+        return result.data
 
     coordinator = DataUpdateCoordinator(
         hass,
         _LOGGER,
         name="EnphaseEnvoy",
         update_method=async_update_data,
-        update_interval= timedelta(seconds=30),
+        update_interval=timedelta(seconds=poll_policy.poll_interval),
     )
-
-    # Do an initial data collection so the list with inverters is filled
-    await coordinator.async_refresh()
+    # Recent readings are kept in memory, so averages do not need queries against the recorder
+    history = ReadingHistory()
+    state_updater = EnvoyStateUpdater(coordinator, history)
+
+    stored = await store.async_load()
+    if stored is not None:
+        # The entities are created with the last good snapshot, the first refresh runs in the background
+        coordinator.data = snapshot_from_dict(stored)
+        hass.async_create_task(coordinator.async_refresh())
+    else:
+        # Without a stored snapshot the first refresh tells which inverters and consumption meters there are
+        await coordinator.async_refresh()
+        if coordinator.data is not None:
+            history.add_snapshot(coordinator.data)
+    data = coordinator.data or {envoy_prop_names.INVERTERS: {}}
+    serial_number = data.get(envoy_prop_names.SERIAL_NUMBER)
+
+    if config[CONF_METER_STREAM]:
+        meter_stream = async_start_meter_stream(hass, config, coordinator, state_updater)
 
     # Iterate through the list of sensors configured
     for condition in monitored_conditions:
         if condition == "inverters":
-            # The initial data collection made sure we know all inverters that are available at this point
-            for inverter in coordinator.data['inverters']:
-                entities.append(
-                    EnvoyInverter(
-                        coordinator,
-                        inverter['serial_number'],
-                        envoy_reader,
-                        condition,
-                        f"{name}{SENSORS[condition][0]} {inverter['serial_number']}",
-                        SENSORS[condition][1],
-                        SENSORS[condition][2],
-                        SENSORS[condition][3]
-                    )
+            # The inverters of the snapshot, the inverters added or removed later are reconciled on the refreshes
+            async_start_inverter_reconciler(coordinator, state_updater, name, async_add_entities)
+        elif condition in ("inverters_underperforming", "inverters_stale", "inverters_outliers"):
+            if not InverterHealth.available():
+                _LOGGER.warning("Inverter health sensors need numpy, %s is not created", condition)
+                continue
+            entities.append(
+                EnvoyInverterHealth(
+                    coordinator,
+                    state_updater,
+                    serial_number,
+                    condition,
+                    f"{name}{SENSORS[condition][0]}",
+                    SENSORS[condition][1],
+                    SENSORS[condition][2],
+                    SENSORS[condition][3]
                 )
+            )
+        elif (condition in SENSOR_SECTIONS and SENSOR_SECTIONS[condition] not in data
+              and not config[CONF_METER_STREAM]):
+            _LOGGER.debug("Envoy has no consumption meters, %s is not created", condition)
+        elif condition == "average_production":
+            entities.append(
+                EnvoyAverage(
+                    history,
+                    coordinator,
+                    state_updater,
+                    serial_number,
+                    condition,
+                    f"{name}{SENSORS[condition][0]}",
+                    SENSORS[condition][1],
+                    SENSORS[condition][2],
+                    SENSORS[condition][3]
+                )
+            )
         else:
             entities.append(
                 Envoy(
                     coordinator,
-                    coordinator.data['serial_number'],
-                    envoy_reader,
+                    state_updater,
+                    serial_number,
                     condition,
                     f"{name}{SENSORS[condition][0]}",
                     SENSORS[condition][1],
@@ -144,16 +429,327 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
                     SENSORS[condition][3]
                 )
             )
+
+    if config[CONF_DIAGNOSTICS]:
+        async_register_metrics_view(hass, fleet)
+        for condition, (sensor_name, unit, data_key, icon) in DIAGNOSTIC_SENSORS.items():
+            entities.append(
+                EnvoyDiagnostic(
+                    fleet,
+                    ip_address,
+                    coordinator,
+                    state_updater,
+                    serial_number,
+                    condition,
+                    f"{name}{sensor_name}",
+                    unit,
+                    data_key,
+                    icon
+                )
+            )
     async_add_entities(entities)
 
 
+def seconds_until_sunrise(hass):
+    """Return the seconds until the next sunrise at the location of Home Assistant."""
+    next_sunrise = get_astral_event_next(hass, SUN_EVENT_SUNRISE)
+    if next_sunrise is None:
+        return None
+    return max((next_sunrise - dt_util.utcnow()).total_seconds(), 0)
+
+
+def merge_stream_sections(data, stream_data):
+    """Return a copy of the snapshot with the sections of the meter stream merged into its sections."""
+    data = dict(data)
+    for section, values in stream_data.items():
+        data[section] = dict(data.get(section) or {}, **values)
+    # The merged sections are diffed against the states written before
+    data[envoy_prop_names.UNCHANGED] = False
+    return data
+
+
+def section_status_attributes(data, section):
+    """Return the attributes with the status of the section, the age is only added while the section is stale."""
+    statuses = (data or {}).get(envoy_prop_names.SECTION_STATUS) or {}
+    status = statuses.get(section, statuses.get(envoy_prop_names.PRODUCTION))
+    if status is None:
+        return {}
+    if status[envoy_prop_names.STATUS] == envoy_prop_names.STALE:
+        return {SECTION_STATUS_ATTRIBUTE: envoy_prop_names.STALE, SECTION_AGE_ATTRIBUTE: status[envoy_prop_names.AGE]}
+    return {SECTION_STATUS_ATTRIBUTE: status[envoy_prop_names.STATUS]}
+
+
+@callback
+def async_get_fleet(hass, max_concurrent_requests=None):
+    """
+    Return the EnvoyFleet shared by all Envoy platforms, it is closed when Home Assistant stops.
+
+    max_concurrent_requests limits the requests of all Envoys together, so it is a global setting: the first platform
+    that is set up creates the fleet, a different limit of a later platform cannot be applied and is reported.
+    :param max_concurrent_requests: the limit of the platform, None when it is not configured
+    """
+    if DOMAIN in hass.data:
+        fleet = hass.data[DOMAIN]
+        if max_concurrent_requests is not None and max_concurrent_requests != fleet.max_concurrent_requests:
+            _LOGGER.warning("%s is shared by all Envoys, %s is ignored and the limit stays %s: configure the same "
+                            "value for every Envoy", CONF_MAX_CONCURRENT_REQUESTS, max_concurrent_requests,
+                            fleet.max_concurrent_requests)
+    else:
+        if max_concurrent_requests is None:
+            max_concurrent_requests = EnvoyFleet.MAX_CONCURRENT_REQUESTS
+        # The discovered Envoy types are cached, so a next start does not have to wait for info.xml
+        fleet = EnvoyFleet(max_concurrent_requests=max_concurrent_requests,
+                           cache=EnvoyStoreCache(hass, DISCOVERY_STORAGE_KEY))
+        hass.data[DOMAIN] = fleet
+
+        async def async_close_fleet(event):
+            await fleet.close()
+
+        # The readers keep their connections to the Envoys open, close them when Home Assistant stops
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_close_fleet)
+    return hass.data[DOMAIN]
+
+
+@callback
+def async_get_token_cache(hass):
+    """Return the cache of the tokens of Envoys with newer firmware, so a restart does not need new tokens."""
+    if TOKEN_STORAGE_KEY not in hass.data:
+        hass.data[TOKEN_STORAGE_KEY] = EnvoyStoreCache(hass, TOKEN_STORAGE_KEY, private=True)
+    return hass.data[TOKEN_STORAGE_KEY]
+
+
+class EnvoyStoreCache:
+    """Cache of the Envoy readers (like EnvoyReaderCache) with its entries in the storage of Home Assistant."""
+
+    def __init__(self, hass, key, private=False):
+        # A private store is only readable by the owner, the tokens are credentials
+        self._store = Store(hass, CACHE_STORAGE_VERSION, key, private=private)
+        self._entries = None
+        self._lock = asyncio.Lock()
+
+    async def get(self, key):
+        """
+        :return: the entry of the key or None when there is no entry
+        """
+        async with self._lock:
+            return (await self.__load()).get(key)
+
+    async def set(self, key, value):
+        async with self._lock:
+            entries = await self.__load()
+            entries[key] = value
+            await self._store.async_save(entries)
+
+    async def remove(self, key):
+        async with self._lock:
+            entries = await self.__load()
+            if entries.pop(key, None) is not None:
+                await self._store.async_save(entries)
+
+    async def __load(self):
+        if self._entries is None:
+            self._entries = await self._store.async_load() or {}
+        return self._entries
+
+
+@callback
+def async_register_metrics_view(hass, fleet):
+    """Serve the metrics of the fleet in the Prometheus text format at METRICS_URL."""
+    if METRICS_VIEW not in hass.data:
+        hass.data[METRICS_VIEW] = EnvoyMetricsView(fleet)
+        hass.http.register_view(hass.data[METRICS_VIEW])
+
+
+class EnvoyMetricsView(HomeAssistantView):
+    """Prometheus text snapshot of the request, parse and refresh metrics of all Envoys."""
+
+    url = METRICS_URL
+    name = "api:enphase_envoy:metrics"
+
+    def __init__(self, fleet):
+        self._fleet = fleet
+
+    async def get(self, request):
+        return web.Response(text=self._fleet.metrics_text(), content_type="text/plain")
+
+
+@callback
+def async_start_inverter_reconciler(coordinator, state_updater, name, async_add_entities):
+    """Create the inverter entities of the current snapshot and add or remove them as the inverters change."""
+    inverters = dict()
+
+    @callback
+    def async_reconcile():
+        data = coordinator.data
+        if data is None:
+            return
+        serial_numbers = data[envoy_prop_names.INVERTERS]
+        for serial_number in [serial_number for serial_number in inverters if serial_number not in serial_numbers]:
+            _LOGGER.info("Envoy inverter %s is no longer reported, its sensor is removed", serial_number)
+            coordinator.hass.async_create_task(inverters.pop(serial_number).async_remove())
+        added = [serial_number for serial_number in serial_numbers if serial_number not in inverters]
+        if len(added) == 0:
+            return
+        for serial_number in added:
+            inverters[serial_number] = EnvoyInverter(
+                coordinator,
+                state_updater,
+                serial_number,
+                "inverters",
+                f"{name}{SENSORS['inverters'][0]} {serial_number}",
+                SENSORS["inverters"][1],
+                SENSORS["inverters"][2],
+                SENSORS["inverters"][3]
+            )
+        async_add_entities([inverters[serial_number] for serial_number in added])
+
+    async_reconcile()
+    coordinator.async_add_listener(async_reconcile)
+
+
+@callback
+def async_start_meter_stream(hass, config, coordinator, state_updater):
+    """
+    Merge the live meter stream of a metered Envoy-S into the coordinator data between the polls, the refreshes
+    merge the latest values of the stream into the polled snapshot. Returns the stream.
+    """
+
+    @callback
+    def async_stream_update(stream_data):
+        if coordinator.data is None:
+            return
+        coordinator.data = merge_stream_sections(coordinator.data, stream_data)
+        state_updater.async_handle_update(refreshed=False)
+
+    stream = EnvoyMeterStream(
+        config[CONF_IP_ADDRESS],
+        username=config[CONF_STREAM_USERNAME],
+        password=config[CONF_STREAM_PASSWORD],
+        callback=async_stream_update,
+        min_update_interval=config[CONF_STREAM_UPDATE_INTERVAL],
+    )
+    stream.start()
+
+    async def async_stop_stream(event):
+        await stream.stop()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop_stream)
+    return stream
+
+
+class EnvoyStateUpdater:
+    """
+    Single coordinator listener that diffs every new snapshot against the previous one and only writes the
+    state of the entities of which the state or attributes changed. Unchanged inverters would otherwise
+    write a state (and a recorder row) on every refresh.
+    """
+
+    def __init__(self, coordinator, history=None):
+        self._coordinator = coordinator
+        self._history = history
+        self._entities = []
+        self._last_data = None
+        self._history_data = None
+        self._last_update_success = coordinator.last_update_success
+        self._remove_listener = None
+        self.written_states = 0
+        self.suppressed_writes = 0
+
+    @callback
+    def async_add_entity(self, entity):
+        """Register an entity, returns the callback to unregister it."""
+        self._entities.append(entity)
+        if self._remove_listener is None:
+            self._last_data = self._coordinator.data
+            self._history_data = self._coordinator.data
+            self._remove_listener = self._coordinator.async_add_listener(self.async_handle_update)
+
+        @callback
+        def remove_entity():
+            self._entities.remove(entity)
+            if len(self._entities) == 0 and self._remove_listener is not None:
+                self._remove_listener()
+                self._remove_listener = None
+
+        return remove_entity
+
+    @callback
+    def async_handle_update(self, refreshed=True):
+        """Write the changed states, refreshed is False for a meter stream update which is not added to the history."""
+        # The history has one site reading per refresh, the meter stream would add one every second
+        data = self._coordinator.data
+        last_data = self._last_data
+        self._last_data = data
+
+        if refreshed and data is not None and data is not self._history_data and self._history is not None:
+            self._history_data = data
+            self._history.add_snapshot(data)
+
+        # The availability of every entity follows the last refresh
+        last_update_success = self._last_update_success
+        self._last_update_success = self._coordinator.last_update_success
+
+        if data is None or last_data is None or last_update_success != self._last_update_success:
+            changed_sections = None
+            changed_inverters = None
+        elif data is last_data:
+            # A failed refresh, only the entities that change on every refresh (diagnostics) are written
+            changed_sections = dict()
+            changed_inverters = set()
+        elif data.get(envoy_prop_names.UNCHANGED):
+            # None of the Envoy responses changed since the previous snapshot, a failing endpoint may still have
+            # made a section stale
+            changed_sections, changed_inverters = self.__status_changes(last_data, data, dict(), set())
+        else:
+            changed_sections = {section: changed_keys(last_data.get(section), data.get(section))
+                                for section in METER_SECTIONS}
+            last_production = last_data[envoy_prop_names.PRODUCTION]
+            production = data[envoy_prop_names.PRODUCTION]
+            changed_inverters = changed_keys(last_data[envoy_prop_names.INVERTERS], data[envoy_prop_names.INVERTERS])
+            # The inverters report 0 when the total production is 0, so that switch changes every inverter
+            watts_now = envoy_prop_names.WATTS_NOW
+            if (watts_now in changed_sections[envoy_prop_names.PRODUCTION]
+                    and (last_production[watts_now] == 0) != (production[watts_now] == 0)):
+                changed_inverters = set(data[envoy_prop_names.INVERTERS])
+            # The health of an inverter also changes by the readings of its peers
+            health = data.get(envoy_prop_names.INVERTER_HEALTH)
+            last_health = last_data.get(envoy_prop_names.INVERTER_HEALTH)
+            if health is not None and health is not last_health:
+                changed_inverters = changed_inverters | health.changed_flags(last_health)
+            changed_sections, changed_inverters = self.__status_changes(last_data, data, changed_sections,
+                                                                        changed_inverters)
+
+        written_states = 0
+        for entity in self._entities:
+            if changed_sections is None or entity.is_changed(changed_sections, changed_inverters):
+                written_states += 1
+                entity.async_write_ha_state()
+        self.written_states += written_states
+        self.suppressed_writes += len(self._entities) - written_states
+        _LOGGER.debug("Envoy update wrote %d states, suppressed %d unchanged (%d suppressed in total)",
+                      written_states, len(self._entities) - written_states, self.suppressed_writes)
+
+    @staticmethod
+    def __status_changes(last_data, data, changed_sections, changed_inverters):
+        """Add the sections of which the status attributes changed, they are in the attributes of every entity."""
+        changed_sections = dict(changed_sections)
+        for section in METER_SECTIONS:
+            if section_status_attributes(last_data, section) != section_status_attributes(data, section):
+                changed_sections[section] = set(changed_sections.get(section, ())) | {envoy_prop_names.SECTION_STATUS}
+        inverters = envoy_prop_names.INVERTERS
+        if section_status_attributes(last_data, inverters) != section_status_attributes(data, inverters):
+            changed_sections[inverters] = {envoy_prop_names.SECTION_STATUS}
+            changed_inverters = set(data[inverters])
+        return changed_sections, changed_inverters
+
+
 class Envoy(Entity):
     """Implementation of the Enphase Envoy sensors."""
 
-    def __init__(self, coordinator, serial_number, envoy_reader, sensor_type, name, unit, data_key, icon):
+    def __init__(self, coordinator, state_updater, serial_number, sensor_type, name, unit, data_key, icon):
         """Initialize the sensor."""
         self._coordinator = coordinator
-        self._envoy_reader = envoy_reader
+        self._state_updater = state_updater
         self._type = sensor_type
         self._name = name
         self._unit_of_measurement = unit
@@ -162,6 +758,7 @@ class Envoy(Entity):
         self._data_key = data_key
         self._icon = icon
         self._serial_number = serial_number
+        self._section = SENSOR_SECTIONS.get(sensor_type, envoy_prop_names.PRODUCTION)
 
     @property
     def name(self):
@@ -171,8 +768,15 @@ class Envoy(Entity):
     @property
     def state(self):
         """Return the state of the sensor."""
-        state = self._coordinator.data['production'][self._data_key]
-        return state
+        # No data while the Envoy has not been reached since the first start
+        section = (self._coordinator.data or {}).get(self._section)
+        # The consumption sections of the meter stream may not have arrived yet
+        return None if section is None else section.get(self._data_key)
+
+    @property
+    def available(self):
+        """Return False while the Envoy cannot be refreshed, the state is the last value read then."""
+        return self._coordinator.last_update_success
 
     @property
     def unit_of_measurement(self):
@@ -186,7 +790,13 @@ class Envoy(Entity):
 
     @property
     def device_state_attributes(self):
-        return None
+        # A stale section is shown with the age of its last good value
+        attributes = section_status_attributes(self._coordinator.data, self._section)
+        # The power per phase of a metered Envoy
+        section = (self._coordinator.data or {}).get(self._section)
+        if self._data_key == envoy_prop_names.WATTS_NOW and section is not None and envoy_prop_names.PHASES in section:
+            attributes[envoy_prop_names.PHASES] = section[envoy_prop_names.PHASES]
+        return attributes or None
 
     @property
     def should_poll(self):
@@ -196,38 +806,156 @@ class Envoy(Entity):
     async def async_added_to_hass(self):
         """When entity is added to hass."""
         self.async_on_remove(
-            self._coordinator.async_add_listener(
-                self.async_write_ha_state
-            )
+            self._state_updater.async_add_entity(self)
         )
 
+    def is_changed(self, changed_sections, changed_inverters):
+        """Return True when the state or attributes depend on the changed keys of the new snapshot."""
+        changed = changed_sections.get(self._section, ())
+        return (self._data_key in changed or envoy_prop_names.SECTION_STATUS in changed
+                or (self._data_key == envoy_prop_names.WATTS_NOW and envoy_prop_names.PHASES in changed))
+
     async def async_update(self):
-        await self.coordinator.async_request_refresh()
+        """Request a refresh, concurrent requests of the entities are coalesced into one Envoy refresh."""
+        await self._coordinator.async_request_refresh()
+
+
+class EnvoyAverage(Envoy):
+    """Implementation of the Enphase Envoy sensor with the average production of the last minutes."""
+
+    def __init__(self, history, *args):
+        super().__init__(*args)
+        self._history = history
+
+    @property
+    def state(self):
+        now = datetime.now(timezone.utc).timestamp()
+        mean = self._history.site.mean(now - AVERAGE_WINDOW.total_seconds(), now)
+        return None if mean is None else round(mean, 1)
+
+    @property
+    def device_state_attributes(self):
+        now = datetime.now(timezone.utc).timestamp()
+        return {
+            "window_minutes": int(AVERAGE_WINDOW.total_seconds() / 60),
+            "max": self._history.site.max(now - AVERAGE_WINDOW.total_seconds(), now),
+        }
+
+
+class EnvoyInverterHealth(Envoy):
+    """Implementation of the Enphase Envoy sensors with the number of inverters with a health flag."""
+
+    @property
+    def state(self):
+        report = self.__get_report()
+        return None if report is None else report.summary[self._data_key]
+
+    @property
+    def device_state_attributes(self):
+        report = self.__get_report()
+        if report is None:
+            return None
+        attributes = {
+            "inverter_count": report.summary[inverter_health.INVERTER_COUNT],
+            "median_peer_ratio": report.summary[inverter_health.MEDIAN_PEER_RATIO],
+            "min_peer_ratio": report.summary[inverter_health.MIN_PEER_RATIO],
+            "serial_numbers": report.flagged(HEALTH_FLAGS[self._data_key]),
+        }
+        attributes.update(section_status_attributes(self._coordinator.data, envoy_prop_names.INVERTERS))
+        return attributes
+
+    def is_changed(self, changed_sections, changed_inverters):
+        return len(changed_inverters) > 0
+
+    def __get_report(self):
+        # The report is not stored, a restored snapshot has none until the first refresh
+        return (self._coordinator.data or {}).get(envoy_prop_names.INVERTER_HEALTH)
+
+
+class EnvoyDiagnostic(Envoy):
+    """Implementation of the Enphase Envoy diagnostic sensors with the metrics of the reader."""
+
+    def __init__(self, fleet, host, *args):
+        super().__init__(*args)
+        self._fleet = fleet
+        self._host = host
+
+    @property
+    def state(self):
+        summary = self.__get_summary()
+        if summary is None:
+            return None
+        if self._type == "request_latency":
+            # The slowest endpoint of the last requests
+            latencies = [endpoint[self._data_key] for endpoint in summary["endpoints"].values()]
+            return max(latencies) if len(latencies) > 0 else None
+        if self._type == "request_errors":
+            return sum(endpoint[self._data_key] for endpoint in summary["endpoints"].values())
+        return summary[self._data_key]
+
+    @property
+    def device_state_attributes(self):
+        summary = self.__get_summary()
+        if summary is None:
+            return None
+        attributes = {key: value for key, value in summary.items() if key != "endpoints"}
+        for url_path, endpoint in summary["endpoints"].items():
+            attributes[url_path] = endpoint
+        # The status (fresh or stale) and age of every section of the last snapshot
+        data = self._coordinator.data
+        if data is not None and envoy_prop_names.SECTION_STATUS in data:
+            attributes[envoy_prop_names.SECTION_STATUS] = data[envoy_prop_names.SECTION_STATUS]
+        return attributes
+
+    def is_changed(self, changed_sections, changed_inverters):
+        # The metrics change on every refresh
+        return True
+
+    def __get_summary(self):
+        # The fleet replaces the reader after a firmware upgrade, the metrics move along. There is no reader until
+        # the Envoy was reached
+        reader = self._fleet.readers.get(self._host)
+        return None if reader is None else reader.metrics.summary()
 
 
 class EnvoyInverter(Envoy):
     """Implementation of the Enphase Envoy Inverter sensors."""
+
+    def is_changed(self, changed_sections, changed_inverters):
+        return self._serial_number in changed_inverters
+
     @property
     def state(self):
         # Inverters report the last known value. If the total production is 0 correct the value for the
         # inverters also to 0
-        if self._coordinator.data['production']['watts_now'] == 0:
+        inverter = self.__get_inverter()
+        if inverter is None:
+            state = None
+        elif self._coordinator.data['production']['watts_now'] == 0:
             state = 0
         else:
-            state = self.__get_inverter()[self._data_key]
+            state = inverter[self._data_key]
         return state
 
     @property
     def device_state_attributes(self):
         inverter = self.__get_inverter()
+        if inverter is None:
+            return None
         ts = datetime.fromtimestamp(inverter['last_report_date'], timezone.utc)
-        return {
+        attributes = {
             "last_reported": ts.isoformat(),
             "communicating": inverter[envoy_prop_names.PCU_COMMUNICATING],
             "producing": inverter[envoy_prop_names.PCU_PRODUCING],
             "device_state": ','.join(inverter[envoy_prop_names.PCU_DEVICE_STATUS])
         }
+        attributes.update(section_status_attributes(self._coordinator.data, envoy_prop_names.INVERTERS))
+        report = self._coordinator.data.get(envoy_prop_names.INVERTER_HEALTH)
+        if report is not None:
+            attributes.update(report.inverter(self._serial_number) or {})
+        return attributes
 
     def __get_inverter(self):
-        return list(filter(lambda x: x['serial_number'] == self._serial_number, self._coordinator.data['inverters']))[0]
+        # The inverter is gone from the snapshot until the reconciler removed its entity
+        return self._coordinator.data['inverters'].get(self._serial_number)
 
@@ -0,0 +1,351 @@
+"""
+Benchmark of the Envoy reader and the sensor entities against the mock Envoy with synthetic sites.
+
+For every site size it measures the poll latency, the number of requests per poll, the parse time, the
+build time and memory per inverter of the snapshot records (all new and partly reused) compared to plain
+dicts, the time of the inverter health analytics, the peak memory of a poll, the longest event loop block of
+a poll with the parsing on and off the event loop and the cost of reading the state of an entity. The results
+are written as JSON so the results of two versions can be compared. Parse times are reported for every
+available JSON decoder backend, also for the fixtures in tests/data.
+
+Usage (from the repository root):
+    python -m tests.benchmark [--inverters 10 100 1000 5000] [--latency 0.05] [--polls 5] [--output file.json]
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from envoy_local_reader.envoy_json_decoder import EnvoyJsonDecoder
+from envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
+from envoy_local_reader.envoy_reader_model_s import EnvoyReaderS
+from envoy_local_reader.inverter_health import InverterHealth
+from tests import synthetic_envoy
+from tests.mock_envoy import TestMockEnvoy, RequestType
+from tests.test_envoy_json_decoder import FIXTURES
+
+import envoy_local_reader.property_names_const as props
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+SITE_SIZES = (10, 100, 1000, 5000)
+DIGEST_CREDENTIALS = ("envoy", "0000")
+
+
+def site_file_map(inverter_count):
+    serial_numbers = synthetic_envoy.inverter_serial_numbers(inverter_count)
+    return {
+        RequestType.INFO: 'data/info_model_s.xml',
+        RequestType.PROD_JSON: synthetic_envoy.production_json(inverter_count),
+        RequestType.API_PROD: synthetic_envoy.api_production_json(),
+        RequestType.API_INVERTERS: synthetic_envoy.inverters_json(serial_numbers),
+        RequestType.INVENTORY_JSON: synthetic_envoy.inventory_json(serial_numbers),
+    }
+
+
+async def measure_poll_latency(reader, server, polls):
+    """
+    Latency of complete polls (all endpoints due) and the number of requests they take
+    """
+    latencies = []
+    server.reset_counters()
+    for _ in range(polls):
+        reader.scheduler.invalidate()
+        start = time.perf_counter()
+        await reader.get_data()
+        latencies.append(time.perf_counter() - start)
+    return {
+        "poll_latency_mean_s": sum(latencies) / len(latencies),
+        "poll_latency_max_s": max(latencies),
+        "requests_full_poll": server.request_count / polls,
+    }
+
+
+async def measure_requests_per_poll(reader, server, duration=3600):
+    """
+    Average number of requests per poll when the reader is polled at its poll interval for duration seconds
+    """
+    now = [0.0]
+    clock = reader.scheduler.clock
+    reader.scheduler.clock = lambda: now[0]
+    reader.scheduler.invalidate()
+    response_delay = server.response_delay
+    server.response_delay = 0
+    server.reset_counters()
+
+    polls = int(duration / reader.poll_interval)
+    for _ in range(polls):
+        await reader.get_data()
+        now[0] += reader.poll_interval
+
+    reader.scheduler.clock = clock
+    server.response_delay = response_delay
+    return {"poll_interval_s": reader.poll_interval, "requests_per_poll": server.request_count / polls}
+
+
+def measure_parse_time(file_map, repeat=5):
+    """
+    Time to decode the inverter and inventory payloads and build the inverter snapshot, per decoder backend
+    """
+    build_inverters = EnvoyReaderS._EnvoyReaderS__process_inverter_json
+    parse_times = dict()
+    for backend in EnvoyJsonDecoder.available_backends():
+        decoder = EnvoyJsonDecoder(backend)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            build_inverters(decoder.decode(file_map[RequestType.API_INVERTERS]),
+                            decoder.decode(file_map[RequestType.INVENTORY_JSON]))
+            timings.append(time.perf_counter() - start)
+        parse_times[backend] = min(timings)
+    return {
+        "parse_time_s": parse_times,
+        "payload_bytes": len(file_map[RequestType.API_INVERTERS]) + len(file_map[RequestType.INVENTORY_JSON]),
+    }
+
+
+def measure_fixture_parse_time(repeat=100):
+    """
+    Decode time of the fixtures in tests/data per decoder backend
+    """
+    parse_times = dict()
+    for fixture in FIXTURES:
+        with open(os.path.join(THIS_DIR, fixture), "rb") as file:
+            raw = file.read()
+        parse_times[fixture] = dict()
+        for backend in EnvoyJsonDecoder.available_backends():
+            decoder = EnvoyJsonDecoder(backend)
+            timings = []
+            for _ in range(repeat):
+                decoder.decode(raw, fixture)
+                timings.append(decoder.parse_timings[fixture])
+            parse_times[fixture][backend] = min(timings)
+    return parse_times
+
+
+def build_dict_inverters(raw_inverter_json, raw_inventory_json):
+    """
+    The inverter section built as plain dicts, the representation before InverterData, as baseline
+    """
+    pcu_devices = dict()
+    for group in raw_inventory_json:
+        if group['type'] == 'PCU':
+            pcu_devices = {device['serial_num']: device for device in group['devices']}
+            break
+    inverter_data = dict()
+    for raw_json in raw_inverter_json:
+        inverter_in_inventory = pcu_devices.get(raw_json['serialNumber'], {})
+        inverter_data[raw_json['serialNumber']] = {
+            props.SERIAL_NUMBER: raw_json['serialNumber'],
+            props.LAST_REPORT_DATE: raw_json['lastReportDate'],
+            props.DEVICE_TYPE: raw_json['devType'],
+            props.LAST_REPORT_WATTS: raw_json['lastReportWatts'],
+            props.MAX_REPORT_WATTS: raw_json['maxReportWatts'],
+            props.PCU_PRODUCING: inverter_in_inventory.get('producing'),
+            props.PCU_COMMUNICATING: inverter_in_inventory.get('communicating'),
+            props.PCU_DEVICE_STATUS: inverter_in_inventory.get('device_status', []),
+        }
+    return inverter_data
+
+
+def measure_snapshot_representation(file_map, repeat=5, reported_share=0.2):
+    """
+    Build time and memory per inverter of the inverter section with InverterData records and with plain dicts,
+    from already decoded payloads. The records are built once with every inverter reporting since the previous
+    build and once with reported_share of the inverters reporting, the records of the others are reused.
+    """
+    build_inverters = EnvoyReaderS._EnvoyReaderS__process_inverter_json
+    decoder = EnvoyJsonDecoder()
+    raw_inverters = decoder.decode(file_map[RequestType.API_INVERTERS])
+    raw_inventory = decoder.decode(file_map[RequestType.INVENTORY_JSON])
+    # The previous build, the inverters that reported since have an older report
+    step = max(int(1 / reported_share), 1)
+    previous = build_inverters([dict(raw_json, lastReportDate=raw_json['lastReportDate'] - 300) if i % step == 0
+                                else raw_json for i, raw_json in enumerate(raw_inverters)], raw_inventory)
+    builders = {
+        "records": build_inverters,
+        "records_partial": lambda raw_inverter_json, raw_inventory_json: build_inverters(
+            raw_inverter_json, raw_inventory_json, previous),
+        "dicts": build_dict_inverters,
+    }
+    build_times = dict()
+    bytes_per_inverter = dict()
+    for name, build in builders.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            build(raw_inverters, raw_inventory)
+            timings.append(time.perf_counter() - start)
+        build_times[name] = min(timings)
+
+        # The values are shared with the decoded payloads, only the records (or dicts) and the section are new
+        tracemalloc.start()
+        inverters = build(raw_inverters, raw_inventory)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        bytes_per_inverter[name] = size / max(len(inverters), 1)
+        del inverters
+    return {"snapshot_build_s": build_times, "snapshot_bytes_per_inverter": bytes_per_inverter}
+
+
+def measure_health_time(file_map, repeat=20):
+    """
+    Time of the inverter health analytics of the inverter snapshot, None when numpy is not installed
+    """
+    if not InverterHealth.available():
+        return {"health_time_s": None}
+    decoder = EnvoyJsonDecoder()
+    inverters = EnvoyReaderS._EnvoyReaderS__process_inverter_json(
+        decoder.decode(file_map[RequestType.API_INVERTERS]), decoder.decode(file_map[RequestType.INVENTORY_JSON]))
+    health = InverterHealth()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        health.analyze(inverters).summary
+        timings.append(time.perf_counter() - start)
+    return {"health_time_s": min(timings)}
+
+
+async def measure_loop_blocking(server, offload_threshold, polls=3):
+    """
+    Longest time the event loop was blocked during complete polls, with the parsing on the event loop
+    (offload_threshold None) or on a worker thread
+    """
+    reader = await EnvoyReaderFactory("localhost", port=server.server_port,
+                                      offload_threshold=offload_threshold).get_reader()
+    await reader.get_data()
+    max_block = 0.0
+    for _ in range(polls):
+        # Changed responses are parsed again, identical ones are skipped
+        reader.scheduler.invalidate()
+        reader._fingerprints.clear()
+        polling = asyncio.ensure_future(reader.get_data())
+        last = time.perf_counter()
+        while not polling.done():
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            max_block = max(max_block, now - last - 0.001)
+            last = now
+        await polling
+    await reader.close()
+    return max_block
+
+
+async def measure_offloaded_parsing(server):
+    return {
+        "loop_block_inline_s": await measure_loop_blocking(server, None),
+        "loop_block_offloaded_s": await measure_loop_blocking(server, 0),
+    }
+
+
+async def measure_peak_memory(reader):
+    reader.scheduler.invalidate()
+    tracemalloc.start()
+    await reader.get_data()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"peak_memory_bytes": peak}
+
+
+def load_sensor_module():
+    """
+    Import sensor.py as part of the component package, this needs Home Assistant to be installed
+    """
+    component_dir = os.path.dirname(THIS_DIR)
+    sys.path.insert(0, os.path.dirname(component_dir))
+    try:
+        return importlib.import_module("{}.sensor".format(os.path.basename(component_dir))), None
+    except ImportError as ex:
+        return None, str(ex)
+    finally:
+        sys.path.pop(0)
+
+
+def measure_state_read(sensor, data, repeat=3):
+    """
+    Cost of reading the state and attributes of every inverter entity
+    """
+    coordinator = SimpleNamespace(data=data)
+    name, unit, data_key, icon = sensor.SENSORS["inverters"]
+    entities = [sensor.EnvoyInverter(coordinator, None, serial_number, "inverters", name, unit, data_key, icon)
+                for serial_number in data[props.INVERTERS]]
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for entity in entities:
+            entity.state
+            entity.device_state_attributes
+        timings.append(time.perf_counter() - start)
+    return {"state_read_per_entity_us": min(timings) / max(len(entities), 1) * 1e6}
+
+
+async def benchmark_site(server, inverter_count, polls, sensor):
+    file_map = site_file_map(inverter_count)
+    server.set_file_map(file_map)
+    reader = await EnvoyReaderFactory("localhost", port=server.server_port).get_reader()
+
+    result = {"inverters": inverter_count}
+    result.update(await measure_poll_latency(reader, server, polls))
+    result["endpoint_parse_time_s"] = dict(reader.parse_timings)
+    result.update(await measure_requests_per_poll(reader, server))
+    result.update(measure_parse_time(file_map))
+    result.update(measure_snapshot_representation(file_map))
+    result.update(measure_health_time(file_map))
+    result.update(await measure_peak_memory(reader))
+    result.update(await measure_offloaded_parsing(server))
+    if sensor is not None:
+        reader.scheduler.invalidate()
+        result.update(measure_state_read(sensor, await reader.get_data()))
+    await reader.close()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=THIS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Envoy reader against synthetic sites")
+    parser.add_argument("--inverters", type=int, nargs="+", default=list(SITE_SIZES))
+    parser.add_argument("--latency", type=float, default=0.05, help="response delay of the mock Envoy (s)")
+    parser.add_argument("--polls", type=int, default=5, help="number of complete polls to average")
+    parser.add_argument("--output", help="file to write the JSON results to, default stdout")
+    args = parser.parse_args()
+
+    server = TestMockEnvoy(digest_credentials=DIGEST_CREDENTIALS)
+    server.response_delay = args.latency
+    sensor, sensor_error = load_sensor_module()
+
+    loop = asyncio.get_event_loop()
+    results = [loop.run_until_complete(benchmark_site(server, inverter_count, args.polls, sensor))
+               for inverter_count in args.inverters]
+
+    output = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "latency_s": args.latency,
+        "sensor_skipped": sensor_error,
+        "decoder": EnvoyJsonDecoder().backend,
+        "fixture_parse_time_s": measure_fixture_parse_time(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,23 @@
+import base64
+import hashlib
+import json
 import os
+import uuid
 from enum import Enum
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.request import parse_http_list
 import socket
-from threading import Thread
+import ssl
+import time
+from threading import Lock, Thread
 
 import requests
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Self-signed certificate and key of the https server, like the certificate of a real Envoy it cannot be verified
+TLS_CERT_FILE = os.path.join(THIS_DIR, "data", "mock_envoy_tls.pem")
 
 class RequestType(Enum):
     UNKNOWN = 0
@@ -15,6 +26,11 @@ class RequestType(Enum):
     API_PROD = 3
     API_INVERTERS = 4
     INVENTORY_JSON = 5
+    STREAM_METER = 6
+    LOGIN = 7
+    TOKEN = 8
+    CHECK_JWT = 9
+    PROD_HTML = 10
 
 def get_free_port():
     s = socket.socket(socket.AF_INET, type=socket.SOCK_STREAM)
@@ -24,26 +40,174 @@ def get_free_port():
     return port
 
 class RequestHandler(BaseHTTPRequestHandler):
+    # Keep the connections open like the Envoy does
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.envoy.connection_count += 1
+
     def do_GET(self):
+        envoy = self.server.envoy
+        envoy.request_count += 1
         request_type = self._get_request_type()
+        if envoy.redirect_to_https and not self.server.tls and request_type not in (RequestType.LOGIN,
+                                                                                     RequestType.TOKEN):
+            self._send_data(301, b"", [("Location", "https://localhost{}".format(self.path))])
+            return
+        with envoy.lock:
+            envoy.in_flight += 1
+            envoy.max_in_flight = max(envoy.max_in_flight, envoy.in_flight)
+        try:
+            time.sleep(envoy.get_delay(request_type))
+            self._send_page(request_type)
+        finally:
+            with envoy.lock:
+                envoy.in_flight -= 1
+
+    def do_POST(self):
+        envoy = self.server.envoy
+        envoy.request_count += 1
+        request_type = self._get_request_type()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if request_type == RequestType.LOGIN:
+            form = parse_qs(body.decode())
+            credentials = (form.get("user[email]", [None])[0], form.get("user[password]", [None])[0])
+            if envoy.token_credentials is not None and credentials == envoy.token_credentials:
+                envoy.login_count += 1
+                self._send_data(200, json.dumps({"message": "success", "session_id": uuid.uuid4().hex}).encode())
+                return
+        elif request_type == RequestType.TOKEN:
+            request = json.loads(body.decode())
+            if envoy.token_credentials is not None and request.get("session_id") \
+                    and request.get("username") == envoy.token_credentials[0]:
+                self._send_data(200, envoy.issue_token(request.get("serial_num")).encode())
+                return
+        self._send_data(401, b"")
+
+    def _send_data(self, status, data, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
 
-        if request_type != RequestType.UNKNOWN and request_type in TestMockEnvoy.file_map:
-            with open(os.path.join(THIS_DIR, TestMockEnvoy.file_map[request_type])) as file:
-                data = file.read()
+    def _send_page(self, request_type):
+        envoy = self.server.envoy
 
-                self.send_response(200)
-                self.send_header("Content-Type", "text/html; charset=UTF-8")
-                self.end_headers()
-                self.wfile.write(bytearray(data, "UTF-8"))
+        if request_type == RequestType.CHECK_JWT:
+            self._check_jwt()
+        elif request_type != RequestType.INFO and envoy.token_credentials is not None:
+            if self._has_valid_token():
+                self._send_file(request_type)
+            else:
+                self._send_data(401, b"")
+        elif request_type != RequestType.INFO and not self._is_authorized():
+            envoy.challenge_count += 1
+            self.send_response(401)
+            self.send_header("WWW-Authenticate",
+                             'Digest realm="{}", qop="auth", nonce="{}"'.format(envoy.REALM, envoy.nonce))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self._send_file(request_type)
+
+    def _send_file(self, request_type):
+        envoy = self.server.envoy
+        if request_type == RequestType.STREAM_METER and envoy.stream_records is not None:
+            self._send_stream()
+        elif request_type != RequestType.UNKNOWN and request_type in envoy.file_map:
+            data = envoy.get_page(request_type)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=UTF-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
         else:
             self.send_response(404)
+            self.send_header("Content-Length", "0")
             self.end_headers()
 
+    def _send_stream(self):
+        # Send the records as a chunked stream, every record is split over 2 chunks
+        envoy = self.server.envoy
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for record in envoy.stream_records:
+            data = "data: {}\r\n\r\n".format(json.dumps(record)).encode()
+            for chunk in (data[:len(data) // 2], data[len(data) // 2:]):
+                self.wfile.write("{:x}\r\n".format(len(chunk)).encode() + chunk + b"\r\n")
+                self.wfile.flush()
+            time.sleep(envoy.stream_interval)
+        self.wfile.write(b"0\r\n\r\n")
+        # The stream ends with closing the connection, like a restarting Envoy
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _check_jwt(self):
+        envoy = self.server.envoy
+        envoy.jwt_check_count += 1
+        token = self._bearer_token()
+        if token is not None and envoy.is_valid_token(token):
+            session_id = uuid.uuid4().hex
+            envoy.sessions[session_id] = token
+            self._send_data(200, b"<html>Valid token.</html>",
+                            [("Set-Cookie", "sessionId={}; Path=/; HttpOnly".format(session_id))])
+        else:
+            self._send_data(401, b"")
+
+    def _bearer_token(self):
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        return token if scheme.lower() == "bearer" else None
+
+    def _has_valid_token(self):
+        envoy = self.server.envoy
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        if "sessionId" in cookie:
+            token = envoy.sessions.get(cookie["sessionId"].value)
+            return token is not None and envoy.is_valid_token(token)
+        token = self._bearer_token()
+        return token is not None and envoy.is_valid_token(token)
+
+    def _is_authorized(self):
+        envoy = self.server.envoy
+        if envoy.digest_credentials is None:
+            return True
+
+        header = self.headers.get("Authorization", "")
+        scheme, _, fields = header.partition(" ")
+        if scheme.lower() != "digest":
+            return False
+        auth = dict()
+        for field in parse_http_list(fields):
+            key, _, value = field.strip().partition("=")
+            auth[key] = value.strip('"')
+        if auth.get("nonce") != envoy.nonce:
+            return False
+
+        def md5(s):
+            return hashlib.md5(s.encode()).hexdigest()
+
+        username, password = envoy.digest_credentials
+        ha1 = md5("{}:{}:{}".format(username, envoy.REALM, password))
+        ha2 = md5("GET:{}".format(self.path))
+        expected = md5("{}:{}:{}:{}:{}:{}".format(ha1, envoy.nonce, auth.get("nc"), auth.get("cnonce"), "auth", ha2))
+        return auth.get("username") == username and auth.get("response") == expected
+
     def _get_request_type(self):
         request_type = RequestType.UNKNOWN
         if self.path == '/info.xml':
             request_type = RequestType.INFO
-        elif self.path == '/production' or self.path == '/production.json':
+        elif self.path == '/production':
+            request_type = RequestType.PROD_HTML
+        elif self.path == '/production.json':
             request_type = RequestType.PROD_JSON
         elif self.path == '/api/v1/production':
             request_type = RequestType.API_PROD
@@ -51,19 +215,134 @@ class RequestHandler(BaseHTTPRequestHandler):
             request_type = RequestType.API_INVERTERS
         elif self.path == '/inventory.json':
             request_type = RequestType.INVENTORY_JSON
+        elif self.path == '/stream/meter':
+            request_type = RequestType.STREAM_METER
+        elif self.path == '/login/login.json':
+            request_type = RequestType.LOGIN
+        elif self.path == '/tokens':
+            request_type = RequestType.TOKEN
+        elif self.path == '/auth/check_jwt':
+            request_type = RequestType.CHECK_JWT
         return request_type
 
 
 class TestMockEnvoy():
-    file_map = dict()
+    """
+    Mock Envoy serving the files of the file map. Every connection is handled in its own thread and
+    kept open. When digest credentials are set all pages except info.xml require digest auth,
+    like the real Envoy does.
+
+    A file map value is either the path of a file relative to the tests directory or the content of
+    the page as bytes (ie. a generated payload). Every request is delayed response_delay seconds, or the
+    delay of its request type in response_delays.
+
+    When stream_records is set stream/meter sends these records as a chunked stream, one every
+    stream_interval seconds, and then closes the connection.
+
+    When token credentials are set the mock serves the Enlighten login and token endpoints too (login_url and
+    token_url) and all pages except info.xml require a token, like newer firmware: tokens expire after
+    token_lifetime seconds, auth/check_jwt answers a valid token with a session cookie.
+
+    With https the same pages are served over https at https_port too, with a self-signed certificate. When
+    redirect_to_https is set the http server redirects the pages of the Envoy to https, like newer firmware.
+    """
+    REALM = "enphaseenergy.com"
+
+    def __init__(self, digest_credentials=None, token_credentials=None, token_lifetime=86400, https=False):
+        self.file_map = dict()
+        self.digest_credentials = digest_credentials
+        self.token_credentials = token_credentials
+        self.token_lifetime = token_lifetime
+        self.tokens = dict()
+        self.sessions = dict()
+        self.response_delay = 0
+        self.response_delays = dict()
+        self.stream_records = None
+        self.stream_interval = 0.01
+        self.redirect_to_https = False
+        self.lock = Lock()
+        self.in_flight = 0
+        self.nonce = uuid.uuid4().hex
+        self.reset_counters()
 
-    def __init__(self):
         self.server_port = get_free_port()
-        self.mock_server = HTTPServer(('localhost', self.server_port), RequestHandler)
+        self.mock_server = self.__start_server(self.server_port)
+
+        self.https_port = None
+        if https:
+            self.https_port = get_free_port()
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(TLS_CERT_FILE)
+            self.mock_https_server = self.__start_server(self.https_port, context)
+
+    def __start_server(self, port, ssl_context=None):
+        server = ThreadingHTTPServer(('localhost', port), RequestHandler)
+        server.envoy = self
+        server.tls = ssl_context is not None
+        if ssl_context is not None:
+            server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
 
-        self.mock_server_thread = Thread(target=self.mock_server.serve_forever)
-        self.mock_server_thread.setDaemon(True)
-        self.mock_server_thread.start()
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
 
     def set_file_map(self, new_file_map):
-        TestMockEnvoy.file_map = new_file_map
+        self.file_map = new_file_map
+
+    def get_delay(self, request_type):
+        return self.response_delays.get(request_type, self.response_delay)
+
+    def get_page(self, request_type):
+        page = self.file_map[request_type]
+        if isinstance(page, bytes):
+            return page
+        with open(os.path.join(THIS_DIR, page)) as file:
+            return bytearray(file.read(), "UTF-8")
+
+    def reset_counters(self):
+        self.request_count = 0
+        self.challenge_count = 0
+        self.connection_count = 0
+        self.max_in_flight = 0
+        self.login_count = 0
+        self.token_count = 0
+        self.jwt_check_count = 0
+
+    @property
+    def login_url(self):
+        return "http://localhost:{}/login/login.json".format(self.server_port)
+
+    @property
+    def token_url(self):
+        return "http://localhost:{}/tokens".format(self.server_port)
+
+    def issue_token(self, serial_number):
+        def encode(claims):
+            return base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+
+        self.token_count += 1
+        expires_at = time.time() + self.token_lifetime
+        token = "{}.{}.{}".format(encode({"alg": "ES256", "typ": "JWT"}),
+                                  encode({"serial": serial_number, "exp": expires_at}), uuid.uuid4().hex)
+        self.tokens[token] = expires_at
+        return token
+
+    def is_valid_token(self, token):
+        return self.tokens.get(token, 0) > time.time()
+
+    def expire_sessions(self):
+        """
+        Forget the session cookies, like a restarted Envoy
+        """
+        self.sessions.clear()
+
+    def revoke_tokens(self):
+        self.tokens.clear()
+        self.sessions.clear()
+
+    def renew_nonce(self):
+        """
+        Invalidate the current nonce, so clients have to answer a new challenge
+        """
+        self.nonce = uuid.uuid4().hex
@@ -0,0 +1,96 @@
+import argparse
+import time
+from bisect import bisect_right
+
+from envoy_local_reader.envoy_capture import EnvoyCapture
+from envoy_local_reader.envoy_reader import EnvoyReader
+from tests.mock_envoy import TestMockEnvoy, RequestType
+
+URL_PATH_REQUEST_TYPES = {
+    EnvoyReader.PRODUCTION_JSON_URL: RequestType.PROD_JSON,
+    EnvoyReader.PRODUCTION_URL: RequestType.PROD_HTML,
+    EnvoyReader.PRODUCTION_API_URL: RequestType.API_PROD,
+    EnvoyReader.INVERTERS_API_URL: RequestType.API_INVERTERS,
+    EnvoyReader.INVENTORY_JSON_URL: RequestType.INVENTORY_JSON,
+}
+
+
+class TestReplayEnvoy(TestMockEnvoy):
+    """
+    Mock Envoy replaying the responses recorded by an EnvoyCapture.
+
+    The recording is played from its first response, speed times faster than real time. A request is answered
+    with the last response of its endpoint recorded at the current replay time (the first one before that), after
+    the recorded latency divided by speed. Failed responses are not replayed, endpoints that are not in the
+    recording (ie. info.xml) are served from the file map.
+    """
+
+    def __init__(self, responses, speed=1.0, file_map=None, replay_latency=True, clock=time.monotonic, **kwargs):
+        super().__init__(**kwargs)
+        self.speed = speed
+        self.replay_latency = replay_latency
+        self.clock = clock
+        self.recording = dict()
+        for response in responses:
+            request_type = URL_PATH_REQUEST_TYPES.get(response.url_path)
+            if request_type is not None and response.status == 200:
+                self.recording.setdefault(request_type, []).append(response)
+        self.timestamps = {request_type: [response.timestamp for response in recorded]
+                           for request_type, recorded in self.recording.items()}
+        self.start_timestamp = min((recorded[0].timestamp for recorded in self.recording.values()), default=0)
+        self.end_timestamp = max((recorded[-1].timestamp for recorded in self.recording.values()), default=0)
+        file_map = dict(file_map or {})
+        file_map.update((request_type, None) for request_type in self.recording)
+        self.set_file_map(file_map)
+        self.restart()
+
+    def restart(self):
+        """
+        Play the recording from its start again
+        """
+        self.replay_start = self.clock()
+
+    @property
+    def replay_timestamp(self):
+        """
+        :return: the recorded time that is replayed now
+        """
+        return self.start_timestamp + (self.clock() - self.replay_start) * self.speed
+
+    @property
+    def finished(self):
+        return self.replay_timestamp > self.end_timestamp
+
+    def current_response(self, request_type):
+        recorded = self.recording[request_type]
+        index = bisect_right(self.timestamps[request_type], self.replay_timestamp) - 1
+        return recorded[max(index, 0)]
+
+    def get_delay(self, request_type):
+        if self.replay_latency and request_type in self.recording:
+            return self.current_response(request_type).latency / self.speed
+        return super().get_delay(request_type)
+
+    def get_page(self, request_type):
+        if request_type in self.recording:
+            return self.current_response(request_type).content
+        return super().get_page(request_type)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a recording of an Envoy")
+    parser.add_argument("capture", help="archive written by an EnvoyCapture")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, ie. 60 plays an hour a minute")
+    parser.add_argument("--info", default="data/info_model_s.xml", help="info.xml to serve")
+    args = parser.parse_args()
+
+    server = TestReplayEnvoy(EnvoyCapture.read(args.capture), speed=args.speed,
+                             file_map={RequestType.INFO: args.info})
+    print("Replaying {:.0f} seconds at http://localhost:{}".format(
+        server.end_timestamp - server.start_timestamp, server.server_port))
+    while not server.finished:
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
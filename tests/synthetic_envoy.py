@@ -0,0 +1,84 @@
+import json
+import random
+
+FIRST_REPORT_DATE = 1589224800
+
+
+def inverter_serial_numbers(count, seed=0):
+    rnd = random.Random(seed)
+    serial_numbers = set()
+    while len(serial_numbers) < count:
+        serial_numbers.add(str(rnd.randrange(100000000000, 999999999999)))
+    return sorted(serial_numbers)
+
+
+def inverters_json(serial_numbers, report_date=FIRST_REPORT_DATE, seed=0):
+    """
+    Generate the api/v1/production/inverters payload for the inverters
+    """
+    rnd = random.Random(seed)
+    return json.dumps([
+        {
+            "serialNumber": serial_number,
+            "lastReportDate": report_date + rnd.randrange(0, 300),
+            "devType": 1,
+            "lastReportWatts": rnd.randrange(0, 300),
+            "maxReportWatts": rnd.choice((290, 296, 297))
+        } for serial_number in serial_numbers], indent=2).encode()
+
+
+def inventory_json(serial_numbers):
+    """
+    Generate the inventory.json payload for the inverters
+    """
+    return json.dumps([
+        {
+            "type": "PCU",
+            "devices": [
+                {
+                    "part_num": "800-00631-r02",
+                    "installed": str(FIRST_REPORT_DATE),
+                    "serial_num": serial_number,
+                    "device_status": ["envoy.global.ok"],
+                    "last_rpt_date": str(FIRST_REPORT_DATE),
+                    "admin_state": 1,
+                    "dev_type": 1,
+                    "created_date": str(FIRST_REPORT_DATE),
+                    "img_load_date": "1548755627",
+                    "img_pnum_running": "520-00082-r01-v02.14.02",
+                    "ptpn": "540-00135-r01-v02.14.04",
+                    "chaneid": 1627390225 + i,
+                    "device_control": [{"gficlearset": False}],
+                    "producing": True,
+                    "communicating": True,
+                    "provisioned": True,
+                    "operating": False
+                } for i, serial_number in enumerate(serial_numbers)]
+        },
+        {"type": "ACB", "devices": []},
+        {"type": "NSRB", "devices": []}
+    ], indent=2).encode()
+
+
+def production_json(active_count, watts_now=1000.0):
+    """
+    Generate the production.json payload of a site without consumption meters
+    """
+    return json.dumps({
+        "production": [
+            {"type": "inverters", "activeCount": active_count, "readingTime": FIRST_REPORT_DATE,
+             "wNow": watts_now, "whLifetime": 1289279}
+        ],
+        "storage": [
+            {"type": "acb", "activeCount": 0, "readingTime": 0, "wNow": 0, "whNow": 0, "state": "idle"}
+        ]
+    }, indent=2).encode()
+
+
+def api_production_json(watts_now=1000):
+    return json.dumps({
+        "wattHoursToday": 25179,
+        "wattHoursSevenDays": 182847,
+        "wattHoursLifetime": 1289278,
+        "wattsNow": watts_now
+    }, indent=2).encode()
@@ -0,0 +1,82 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from envoy_local_reader.envoy_capture import EnvoyCapture, CapturedResponse
+from envoy_local_reader.envoy_reader import EnvoyReader
+from envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
+from tests.mock_envoy import TestMockEnvoy, RequestType
+from tests.replay_envoy import TestReplayEnvoy
+from tests.test_envoy_reader_factory import DEFAULT_FILE_MAP
+
+import envoy_local_reader.property_names_const as props
+
+
+def production_json(watts_now):
+    return json.dumps({"production": [{"type": "inverters", "activeCount": 12, "readingTime": 1589232000,
+                                       "wNow": watts_now, "whLifetime": 1000}]}).encode()
+
+
+class TestEnvoyCapture(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._server = TestMockEnvoy()
+        cls._server.set_file_map(DEFAULT_FILE_MAP.copy())
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._tmp_dir.name, "capture.jsonl.gz")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def testCapture(self):
+        loop = asyncio.get_event_loop()
+        capture = EnvoyCapture(self._path)
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port,
+                                                       capture=capture).get_reader())
+        loop.run_until_complete(r.get_data())
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        loop.run_until_complete(r.close())
+
+        responses = EnvoyCapture.read(self._path)
+        self.assertEqual(len(responses), 2 * len(r.url_paths()))
+        self.assertEqual({response.url_path for response in responses}, set(r.url_paths()))
+        with open(os.path.join(os.path.dirname(__file__), DEFAULT_FILE_MAP[RequestType.INVENTORY_JSON]), "rb") as file:
+            inventory = file.read()
+        for response in responses:
+            self.assertEqual(response.status, 200)
+            self.assertGreater(response.latency, 0)
+            if response.url_path == EnvoyReader.INVENTORY_JSON_URL:
+                self.assertEqual(response.content, inventory)
+
+        # The bodies of the second refresh are references to the first
+        with gzip.open(self._path, "rt") as file:
+            entries = [json.loads(line) for line in file]
+        self.assertEqual(sum("body" in entry for entry in entries), len(r.url_paths()))
+
+    def testReplay(self):
+        now = [0.0]
+        responses = [CapturedResponse(1000 + t, EnvoyReader.PRODUCTION_JSON_URL, 200, 0.5, production_json(t))
+                     for t in (0, 60, 120)]
+        server = TestReplayEnvoy(responses, speed=60, file_map=DEFAULT_FILE_MAP, clock=lambda: now[0])
+        self.assertEqual(server.get_delay(RequestType.PROD_JSON), 0.5 / 60)
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=server.server_port).get_reader())
+        self.assertEqual(loop.run_until_complete(r.call_http_api(r.PRODUCTION_JSON_URL)).content, production_json(0))
+        # 1.5 second at 60 times the real speed replays the response recorded after 90 seconds
+        now[0] = 1.5
+        self.assertEqual(loop.run_until_complete(r.call_http_api(r.PRODUCTION_JSON_URL)).content, production_json(60))
+        self.assertFalse(server.finished)
+        now[0] = 10
+        self.assertEqual(loop.run_until_complete(r.call_http_api(r.PRODUCTION_JSON_URL)).content,
+                         production_json(120))
+        self.assertTrue(server.finished)
+        # Endpoints that are not recorded are served from the file map
+        self.assertEqual(len(loop.run_until_complete(r.get_data())[props.INVERTERS]), 12)
+        loop.run_until_complete(r.close())
@@ -0,0 +1,51 @@
+import asyncio
+import time
+from unittest import TestCase
+
+from envoy_local_reader.envoy_fleet import EnvoyFleet
+from envoy_local_reader.envoy_reader_exception import EnvoyReaderEndpointError
+from tests.mock_envoy import TestMockEnvoy, RequestType
+from tests.test_envoy_reader_factory import DEFAULT_FILE_MAP
+
+import envoy_local_reader.property_names_const as props
+
+
+class TestEnvoyFleet(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._servers = [TestMockEnvoy(digest_credentials=("envoy", "0000")) for _ in range(3)]
+
+    def setUp(self):
+        for server in self._servers:
+            server.set_file_map(DEFAULT_FILE_MAP.copy())
+            server.response_delay = 0.05
+            server.reset_counters()
+
+    def testFleetPoll(self):
+        hosts = ["localhost:{}".format(server.server_port) for server in self._servers]
+        fm = DEFAULT_FILE_MAP.copy()
+        del fm[RequestType.INVENTORY_JSON]
+        self._servers[2].set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        fleet = EnvoyFleet(hosts, max_concurrent_requests=2, stagger_delay=0.1)
+        start = time.monotonic()
+        results = loop.run_until_complete(fleet.get_data())
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(set(results), set(hosts))
+        self.assertTrue(results[hosts[0]].success)
+        self.assertEqual(results[hosts[1]].data[props.PRODUCTION][props.ACTIVE_INVERTERS], 12)
+        self.assertIsInstance(results[hosts[2]].error, EnvoyReaderEndpointError)
+
+        # The fleet shares one request limit: 3 info.xml + 3 x 5 requests, at most 2 in flight
+        self.assertGreaterEqual(elapsed, 18 * 0.05 / 2)
+        self.assertTrue(all(server.max_in_flight <= 2 for server in self._servers))
+
+        # The polls of the hosts are staggered
+        durations = sorted(result.duration for result in results.values())
+        self.assertGreaterEqual(durations[-1] - durations[0], 0.1)
+
+        # All readers share the connection pool of the fleet
+        self.assertEqual(len({id(reader.session) for reader in fleet.readers.values()}), 1)
+        loop.run_until_complete(fleet.close())
@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from envoy_local_reader.envoy_history import RingBuffer, DownsampledSeries, ReadingHistory
+
+
+class TestEnvoyHistory(TestCase):
+    def testRingBufferOverwritesOldest(self):
+        buffer = RingBuffer(3)
+        for t in range(5):
+            buffer.append(t, t * 10, t * 10)
+        self.assertEqual(buffer.size, 3)
+        self.assertEqual(buffer.oldest, 2)
+        self.assertEqual(buffer.newest, 4)
+        self.assertEqual([sample[0] for sample in buffer.samples()], [2, 3, 4])
+        self.assertEqual([sample[0] for sample in buffer.samples(3, 3)], [3])
+
+    def testDownsampledQueries(self):
+        # Every sample of the last 10 samples, 60 second buckets for older samples
+        series = DownsampledSeries(((0, 10), (60, 100)))
+        for t in range(0, 600, 15):
+            series.add(t, 100 if t < 300 else 200)
+
+        # The raw tier only holds the last 10 samples, older ones come from the 60 second buckets, stamped at the
+        # mean time of their samples. The bucket of 420 to 480 replaces the first two raw samples it overlaps.
+        points = series.points()
+        self.assertEqual(points[0], (22.5, 100, 100, 4))
+        self.assertEqual(points[-9], (442.5, 200, 200, 4))
+        self.assertEqual([point[3] for point in points[-8:]], [1] * 8)
+        self.assertEqual(sum(point[3] for point in points), 40)
+
+        self.assertAlmostEqual(series.mean(), 150)
+        self.assertAlmostEqual(series.mean(300, 600), 200)
+        self.assertEqual(series.max(), 200)
+        self.assertEqual(series.max(0, 250), 100)
+        self.assertIsNone(series.mean(1000, 2000))
+        # 100 W between the first and the last bucket of the range
+        self.assertAlmostEqual(series.energy_between(0, 300), 100 * 240 / 3600)
+
+    def testEnergyOverBuckets(self):
+        series = DownsampledSeries(((0, 10), (60, 100)))
+        for t in range(0, 1200, 15):
+            series.add(t, t)
+        # A ramp is integrated exactly by the trapezoidal rule, the buckets add no shift. Only the part before the
+        # first bucket (22.5 seconds) is left out.
+        self.assertAlmostEqual(series.energy_between(0, 1185), (1185 ** 2 - 22.5 ** 2) / 2 / 3600)
+
+    def testSnapshots(self):
+        history = ReadingHistory()
+        inverter = {'last_report_watts': 100, 'last_report_date': 1000}
+        history.add_snapshot({'production': {'watts_now': 500}, 'inverters': {'1': inverter}}, timestamp=1000)
+        # The inverter did not report a new value, the site reading is stored
+        history.add_snapshot({'production': {'watts_now': 700}, 'inverters': {'1': inverter}}, timestamp=1015)
+        history.add_snapshot({'production': {'watts_now': 600},
+                              'inverters': {'1': {'last_report_watts': 120, 'last_report_date': 1300}}},
+                             timestamp=1300)
+
+        self.assertAlmostEqual(history.site.mean(), 600)
+        self.assertEqual(history.site.max(), 700)
+        self.assertEqual([point[1] for point in history.inverter('1').points()[-2:]], [100, 120])
+        self.assertIsNone(history.inverter('2'))
+
+        # An inverter that left the inventory is forgotten
+        history.add_snapshot({'production': {'watts_now': 600},
+                              'inverters': {'2': {'last_report_watts': 50, 'last_report_date': 1300}}},
+                             timestamp=1315)
+        self.assertIsNone(history.inverter('1'))
+        self.assertEqual(list(history.inverters), ['2'])
+
+    def testMemoryIsFixed(self):
+        history = ReadingHistory()
+        per_inverter = ReadingHistory.memory_bytes_per_inverter()
+        inverters = {str(n): {'last_report_watts': 0, 'last_report_date': 0} for n in range(1000)}
+        history.add_snapshot({'production': {'watts_now': 0}, 'inverters': inverters}, timestamp=0)
+        memory = history.memory_bytes()
+        self.assertEqual(memory, history.site.memory_bytes() + 1000 * per_inverter)
+
+        for t in range(1, 500):
+            inverters['1'] = {'last_report_watts': t, 'last_report_date': t * 300}
+            history.add_snapshot({'production': {'watts_now': t}, 'inverters': inverters}, timestamp=t * 15)
+        self.assertEqual(history.memory_bytes(), memory)
+
+        # The memory of the inverters that are gone is released
+        del inverters['2']
+        history.add_snapshot({'production': {'watts_now': 0}, 'inverters': inverters}, timestamp=500 * 15)
+        self.assertEqual(history.memory_bytes(), memory - per_inverter)
@@ -0,0 +1,25 @@
+import json
+import os
+from unittest import TestCase
+
+from envoy_local_reader.envoy_json_decoder import EnvoyJsonDecoder
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = ('data/production.json', 'data/api_v1_production.json', 'data/api_v1_production_inverters.json',
+            'data/inventory.json')
+
+
+class TestEnvoyJsonDecoder(TestCase):
+    def testBackendsDecodeFixtures(self):
+        for fixture in FIXTURES:
+            with open(os.path.join(THIS_DIR, fixture), 'rb') as file:
+                raw = file.read()
+            for backend in EnvoyJsonDecoder.available_backends():
+                decoder = EnvoyJsonDecoder(backend)
+                self.assertEqual(decoder.decode(raw, fixture), json.loads(raw.decode()))
+                self.assertIn(fixture, decoder.parse_timings)
+
+    def testInvalidJson(self):
+        for backend in EnvoyJsonDecoder.available_backends():
+            with self.assertRaises(ValueError):
+                EnvoyJsonDecoder(backend).decode(b'<html></html>')
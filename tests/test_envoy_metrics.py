@@ -0,0 +1,98 @@
+import asyncio
+from unittest import TestCase
+
+from envoy_local_reader.envoy_fleet import EnvoyFleet
+from envoy_local_reader.envoy_metrics import EnvoyMetrics, Histogram, prometheus_text
+from envoy_local_reader.envoy_reader_exception import EnvoyReaderEndpointError, EnvoyReaderError
+from envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
+from tests.mock_envoy import TestMockEnvoy, RequestType
+from tests.test_envoy_reader_factory import DEFAULT_FILE_MAP
+
+
+class TestEnvoyMetrics(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._server = TestMockEnvoy(digest_credentials=("envoy", "0000"))
+
+    def setUp(self):
+        self._server.set_file_map(DEFAULT_FILE_MAP.copy())
+
+    def testHistogram(self):
+        histogram = Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative_counts(), [(0.1, 2), (1, 3), (float("inf"), 4)])
+        self.assertAlmostEqual(histogram.sum, 5.65)
+        self.assertEqual(histogram.last, 5)
+
+    def testErrorMessage(self):
+        self.assertEqual(str(EnvoyReaderError("Cannot connect")), "Cannot connect")
+
+    def testReaderMetrics(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        loop.run_until_complete(r.get_data())
+
+        metrics = r.metrics
+        self.assertEqual(set(metrics.latency), set(r.url_paths()))
+        self.assertEqual(metrics.status_codes[(r.INVERTERS_API_URL, "200")], 1)
+        # The first request answered the digest challenge
+        self.assertEqual(sum(metrics.retries.values()), 1)
+        self.assertGreater(metrics.response_bytes[r.INVENTORY_JSON_URL], 0)
+        self.assertEqual(set(metrics.parse_time), set(r.url_paths()))
+        self.assertEqual(set(metrics.build_time), {"production", "inverters"})
+        self.assertEqual(metrics.refreshes, 1)
+        self.assertEqual(metrics.failed_refreshes, 0)
+
+        summary = metrics.summary()
+        self.assertEqual(summary["endpoints"][r.INVENTORY_JSON_URL]["requests"], 1)
+        self.assertEqual(summary["endpoints"][r.INVENTORY_JSON_URL]["errors"], 0)
+        self.assertIsNotNone(summary["last_refresh_ms"])
+
+        fm = DEFAULT_FILE_MAP.copy()
+        del fm[RequestType.INVENTORY_JSON]
+        self._server.set_file_map(fm)
+        r.scheduler.invalidate()
+        # The failed endpoint is counted, the refresh falls back to the last good inventory
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(metrics.errors(), 1)
+        self.assertEqual(metrics.errors(r.INVENTORY_JSON_URL), 1)
+        self.assertEqual(metrics.status_codes[(r.INVENTORY_JSON_URL, "404")], 1)
+        self.assertEqual(metrics.failed_refreshes, 0)
+
+        loop.run_until_complete(r.close())
+
+        # Without a last good inventory the refresh fails
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        with self.assertRaises(EnvoyReaderEndpointError):
+            loop.run_until_complete(r.get_data())
+        self.assertEqual(r.metrics.failed_refreshes, 1)
+        loop.run_until_complete(r.close())
+
+    def testPrometheusText(self):
+        metrics = EnvoyMetrics()
+        metrics.record_request("production.json", 0.02, 200, 1000, 1)
+        metrics.record_request("production.json", 0.5, EnvoyMetrics.STATUS_ERROR)
+        metrics.record_parse("production.json", 0.0002)
+        metrics.record_refresh(0.6, False)
+
+        lines = prometheus_text({"envoy": metrics}).splitlines()
+        self.assertIn("# TYPE envoy_request_duration_seconds histogram", lines)
+        self.assertIn('envoy_request_duration_seconds_bucket{host="envoy",endpoint="production.json",le="0.025"} 1',
+                      lines)
+        self.assertIn('envoy_request_duration_seconds_bucket{host="envoy",endpoint="production.json",le="+Inf"} 2',
+                      lines)
+        self.assertIn('envoy_request_duration_seconds_count{host="envoy",endpoint="production.json"} 2', lines)
+        self.assertIn('envoy_response_bytes_total{host="envoy",endpoint="production.json"} 1000', lines)
+        self.assertIn('envoy_responses_total{host="envoy",endpoint="production.json",status="error"} 1', lines)
+        self.assertIn('envoy_request_retries_total{host="envoy",endpoint="production.json"} 1', lines)
+        self.assertIn('envoy_refreshes_total{host="envoy",result="failure"} 1', lines)
+
+    def testFleetMetricsText(self):
+        host = "localhost:{}".format(self._server.server_port)
+        fleet = EnvoyFleet([host])
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(fleet.get_data())
+        text = fleet.metrics_text()
+        self.assertIn('envoy_refreshes_total{{host="{}",result="success"}} 1'.format(host), text)
+        loop.run_until_complete(fleet.close())
@@ -0,0 +1,348 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase
+
+from envoy_local_reader.envoy_reader_exception import EnvoyReaderEndpointError
+from envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
+from tests import synthetic_envoy
+from tests.mock_envoy import TestMockEnvoy, RequestType, get_free_port
+from tests.test_envoy_reader_factory import DEFAULT_FILE_MAP
+
+import envoy_local_reader.property_names_const as props
+
+
+class TestEnvoyReader(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The factory uses the last 6 digits of the serial number as password
+        cls._server = TestMockEnvoy(digest_credentials=("envoy", "0000"))
+
+    def setUp(self):
+        self._server.set_file_map(DEFAULT_FILE_MAP.copy())
+        self._server.response_delay = 0
+        self._server.response_delays = dict()
+
+    def testDigestNonceReuse(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+
+        self._server.reset_counters()
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        first_poll_requests = self._server.request_count
+        self.assertEqual(self._server.challenge_count, 1)
+
+        # In steady state every endpoint costs exactly one request on the same connection
+        self._server.reset_counters()
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.challenge_count, 0)
+        self.assertEqual(self._server.request_count, first_poll_requests - 1)
+        self.assertEqual(self._server.connection_count, 0)
+
+        # A stale nonce is answered with a new challenge, after that the new nonce is reused
+        self._server.renew_nonce()
+        self._server.reset_counters()
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        self.assertGreater(self._server.challenge_count, 0)
+        self._server.reset_counters()
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.challenge_count, 0)
+
+        loop.run_until_complete(r.close())
+
+    def testConcurrentFetch(self):
+        self._server.response_delay = 0.2
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port,
+                                                       max_concurrent_requests=2).get_reader())
+        loop.run_until_complete(r.get_data())
+        self._server.reset_counters()
+        r.scheduler.invalidate()
+        start = time.monotonic()
+        loop.run_until_complete(r.get_data())
+        elapsed = time.monotonic() - start
+
+        # 4 endpoints, 2 at a time: 2 round trips instead of 4
+        self.assertEqual(self._server.max_in_flight, 2)
+        self.assertLess(elapsed, 0.2 * 4)
+        loop.run_until_complete(r.close())
+
+    def testEndpointFailures(self):
+        fm = DEFAULT_FILE_MAP.copy()
+        del fm[RequestType.INVENTORY_JSON]
+        del fm[RequestType.API_PROD]
+        self._server.set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        with self.assertRaises(EnvoyReaderEndpointError) as cm:
+            loop.run_until_complete(r.get_data())
+        self.assertEqual(set(cm.exception.errors), {r.INVENTORY_JSON_URL, r.PRODUCTION_API_URL})
+        self.assertIn(r.INVENTORY_JSON_URL, str(cm.exception))
+        loop.run_until_complete(r.close())
+
+    def testMultiRatePolling(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        now = [1000.0]
+        r.scheduler.clock = lambda: now[0]
+        self.assertEqual(r.poll_interval, 15)
+
+        loop.run_until_complete(r.get_data())
+
+        # Only production.json is due after one poll interval, the other sections are merged from the last poll
+        now[0] += 15
+        self._server.reset_counters()
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.request_count, 1)
+        self.assertEqual(len(data[props.INVERTERS]), 12)
+        self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_SEVEN_DAYS], 182847)
+
+        # Polls are a bit late or early, the inverters are due on the poll closest to their interval
+        now[0] += 284
+        self._server.reset_counters()
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.request_count, 3)
+        self.assertEqual(r.scheduler.due(r.url_paths(), now[0] + 3300), r.url_paths())
+        loop.run_until_complete(r.close())
+
+    def testSyntheticSite(self):
+        serial_numbers = synthetic_envoy.inverter_serial_numbers(250)
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.API_INVERTERS] = synthetic_envoy.inverters_json(serial_numbers)
+        fm[RequestType.INVENTORY_JSON] = synthetic_envoy.inventory_json(serial_numbers)
+        self._server.set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(sorted(data[props.INVERTERS]), serial_numbers)
+        self.assertTrue(data[props.INVERTERS][serial_numbers[0]][props.PCU_PRODUCING])
+        self.assertEqual(data[props.INVERTER_HEALTH].summary['inverter_count'], 250)
+        loop.run_until_complete(r.close())
+
+    def testUnchangedResponses(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        data = loop.run_until_complete(r.get_data())
+        self.assertFalse(data[props.UNCHANGED])
+
+        # Identical responses are not parsed again and the sections are reused
+        r.scheduler.invalidate()
+        r.parse_timings.clear()
+        next_data = loop.run_until_complete(r.get_data())
+        self.assertTrue(next_data[props.UNCHANGED])
+        self.assertIs(next_data[props.INVERTERS], data[props.INVERTERS])
+        self.assertIs(next_data[props.INVERTER_HEALTH], data[props.INVERTER_HEALTH])
+        self.assertEqual(r.parse_timings, {})
+
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.API_INVERTERS] = synthetic_envoy.inverters_json(list(data[props.INVERTERS]))
+        self._server.set_file_map(fm)
+        r.scheduler.invalidate()
+        next_data = loop.run_until_complete(r.get_data())
+        self.assertFalse(next_data[props.UNCHANGED])
+        self.assertEqual(list(r.parse_timings), [r.INVERTERS_API_URL])
+        self.assertIs(next_data[props.PRODUCTION], data[props.PRODUCTION])
+        loop.run_until_complete(r.close())
+
+    def testSingleFlight(self):
+        self._server.response_delay = 0.1
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        loop.run_until_complete(r.get_data())
+
+        # Concurrent callers share one refresh, a cancelled caller does not cancel it for the others
+        r.scheduler.invalidate()
+        self._server.reset_counters()
+
+        async def get_data_concurrently():
+            impatient = asyncio.ensure_future(asyncio.wait_for(r.get_data(), 0.01))
+            results = await asyncio.gather(*[r.get_data() for _ in range(10)])
+            with self.assertRaises(asyncio.TimeoutError):
+                await impatient
+            return results
+
+        results = loop.run_until_complete(get_data_concurrently())
+        self.assertEqual(self._server.request_count, len(r.url_paths()))
+        self.assertTrue(all(data is results[0] for data in results))
+        loop.run_until_complete(r.close())
+
+    def testSnapshotMaxAge(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port,
+                                                       snapshot_max_age=5).get_reader())
+        now = [1000.0]
+        r.scheduler.clock = lambda: now[0]
+        data = loop.run_until_complete(r.get_data())
+
+        # Within the freshness window the cached snapshot is returned without requests
+        self._server.reset_counters()
+        r.scheduler.invalidate()
+        now[0] += 4
+        self.assertIs(loop.run_until_complete(r.get_data()), data)
+        self.assertEqual(self._server.request_count, 0)
+
+        now[0] += 1
+        self.assertIsNot(loop.run_until_complete(r.get_data()), data)
+        self.assertEqual(self._server.request_count, len(r.url_paths()))
+
+        data = loop.run_until_complete(r.get_data())
+        r.invalidate_snapshot()
+        self.assertIsNot(loop.run_until_complete(r.get_data()), data)
+        loop.run_until_complete(r.close())
+
+    def testDeadlineWithStaleFallback(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port,
+                                                       refresh_deadline=0.5).get_reader())
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(data[props.SECTION_STATUS][props.INVERTERS][props.STATUS], props.FRESH)
+
+        # The slow inventory misses its deadline, the production arrives and the inverters use the last data
+        self._server.response_delays = {RequestType.INVENTORY_JSON: 1}
+        r.scheduler.invalidate()
+        start = time.monotonic()
+        data = loop.run_until_complete(r.get_data())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(data[props.SECTION_STATUS][props.PRODUCTION][props.STATUS], props.FRESH)
+        self.assertEqual(data[props.SECTION_STATUS][props.INVERTERS][props.STATUS], props.STALE)
+        self.assertEqual(len(data[props.INVERTERS]), 12)
+        self.assertEqual(r.metrics.status_codes[(r.INVENTORY_JSON_URL, "timeout")], 1)
+
+        # The missed endpoint stays due, the next poll fetches it again
+        self._server.response_delays = dict()
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(data[props.SECTION_STATUS][props.INVERTERS][props.STATUS], props.FRESH)
+        self.assertEqual(r.scheduler.due(r.url_paths()), [])
+        loop.run_until_complete(r.close())
+
+    def testEnvoyDown(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        loop.run_until_complete(r.get_data())
+
+        # Nothing listens on the port anymore, every poll fails instead of returning the last data as stale
+        r.port = get_free_port()
+        for _ in range(3):
+            r.scheduler.invalidate()
+            with self.assertRaises(EnvoyReaderEndpointError) as cm:
+                loop.run_until_complete(r.get_data())
+            self.assertEqual(set(cm.exception.errors), set(r.url_paths()))
+        # Only the production endpoint is due, it fails as well
+        with self.assertRaises(EnvoyReaderEndpointError):
+            loop.run_until_complete(r.get_data())
+        self.assertEqual(r.metrics.failed_refreshes, 4)
+
+        r.port = self._server.server_port
+        r.scheduler.invalidate()
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(data[props.SECTION_STATUS][props.INVERTERS][props.STATUS], props.FRESH)
+        loop.run_until_complete(r.close())
+
+    def testMaxStaleAge(self):
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port,
+                                                       max_stale_age=60).get_reader())
+        now = [1000.0]
+        r.scheduler.clock = lambda: now[0]
+        loop.run_until_complete(r.get_data())
+
+        # The inverters fall back to their last data until they have been failing for max_stale_age seconds
+        fm = DEFAULT_FILE_MAP.copy()
+        del fm[RequestType.API_INVERTERS]
+        self._server.set_file_map(fm)
+        for seconds, stale in ((15, True), (75, True), (80, False)):
+            now[0] = 1000 + seconds
+            r.scheduler.invalidate()
+            if stale:
+                data = loop.run_until_complete(r.get_data())
+                self.assertEqual(data[props.SECTION_STATUS][props.INVERTERS][props.STATUS], props.STALE)
+                self.assertEqual(data[props.SECTION_STATUS][props.PRODUCTION][props.STATUS], props.FRESH)
+            else:
+                with self.assertRaises(EnvoyReaderEndpointError) as cm:
+                    loop.run_until_complete(r.get_data())
+                self.assertEqual(set(cm.exception.errors), {r.INVERTERS_API_URL})
+        loop.run_until_complete(r.close())
+
+    def testOffloadedParsing(self):
+        serial_numbers = synthetic_envoy.inverter_serial_numbers(250)
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.API_INVERTERS] = synthetic_envoy.inverters_json(serial_numbers)
+        fm[RequestType.INVENTORY_JSON] = synthetic_envoy.inventory_json(serial_numbers)
+        self._server.set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port,
+                                                       offload_threshold=64 * 1024).get_reader())
+        # Small payloads are parsed on the event loop, large ones on a worker thread
+        self.assertEqual(loop.run_until_complete(r.run_parser(100, threading.get_ident)), threading.get_ident())
+        self.assertNotEqual(loop.run_until_complete(r.run_parser(64 * 1024, threading.get_ident)),
+                            threading.get_ident())
+
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(sorted(data[props.INVERTERS]), serial_numbers)
+        # The timings of the worker thread are recorded on the event loop
+        self.assertIn(r.INVERTERS_API_URL, r.parse_timings)
+        self.assertEqual(r.metrics.parse_time[r.INVERTERS_API_URL].count, 1)
+        self.assertEqual(r.metrics.build_time[props.INVERTERS].count, 1)
+        loop.run_until_complete(r.close())
+
+    def testMeteredProductionJson(self):
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.PROD_JSON] = 'data/production_metered.json'
+        self._server.set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        data = loop.run_until_complete(r.get_data())
+
+        # The production meter is active, everything is read from production.json
+        self.assertEqual(data[props.PRODUCTION], {
+            props.WATTS_NOW: 2850.5,
+            props.WATT_HOURS_TODAY: 10520.0,
+            props.WATT_HOURS_SEVEN_DAYS: 182001.0,
+            props.WATT_HOURS_LIFETIME: 1290470.0,
+            props.PHASES: {"ph-a": 1430.25, "ph-b": 1420.25},
+            props.ACTIVE_INVERTERS: 12,
+        })
+        self.assertEqual(data[props.TOTAL_CONSUMPTION][props.WATTS_NOW], 1210.5)
+        self.assertEqual(data[props.TOTAL_CONSUMPTION][props.WATT_HOURS_LIFETIME], 2010040.0)
+        self.assertEqual(data[props.NET_CONSUMPTION][props.PHASES], {"ph-a": -630.25, "ph-b": -1009.75})
+        self.assertNotIn(r.PRODUCTION_API_URL, r.url_paths())
+
+        # The production api is not fetched anymore
+        self._server.reset_counters()
+        r.scheduler.invalidate()
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.request_count, 3)
+        self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_TODAY], 10520.0)
+
+        # Without consumption meters there are no consumption sections
+        fm[RequestType.PROD_JSON] = 'data/production.json'
+        r.scheduler.invalidate()
+        data = loop.run_until_complete(r.get_data())
+        self.assertNotIn(props.TOTAL_CONSUMPTION, data)
+        self.assertIn(r.PRODUCTION_API_URL, r.url_paths())
+        r.scheduler.invalidate()
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_SEVEN_DAYS], 182847)
+
+        # When the meter is active again the production api response is dropped, it would be outdated by the time
+        # the meter is deactivated again
+        fm[RequestType.PROD_JSON] = 'data/production_metered.json'
+        r.scheduler.invalidate()
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_TODAY], 10520.0)
+        self.assertNotIn(r.PRODUCTION_API_URL, r.url_paths())
+        self.assertIsNone(r.scheduler.last_fetched(r.PRODUCTION_API_URL))
+        fm[RequestType.PROD_JSON] = 'data/production.json'
+        r.scheduler.invalidate()
+        data = loop.run_until_complete(r.get_data())
+        self.assertIsNone(data[props.PRODUCTION][props.WATT_HOURS_TODAY])
+        loop.run_until_complete(r.close())
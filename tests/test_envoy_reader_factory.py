@@ -1,6 +1,10 @@
 import asyncio
+import os
+import tempfile
 from unittest import TestCase
 
+from envoy_local_reader.envoy_reader_cache import EnvoyReaderCache
+from envoy_local_reader.envoy_reader_exception import EnvoyReaderSchemaError, EnvoyReaderEndpointError
 from envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
 from envoy_local_reader.envoy_reader_model_c_old import EnvoyReaderOldC
 from envoy_local_reader.envoy_reader_model_s import EnvoyReaderS
@@ -13,7 +17,8 @@ DEFAULT_FILE_MAP = {
     RequestType.API_PROD:       'data/api_v1_production.json',
     RequestType.API_INVERTERS:  'data/api_v1_production_inverters.json',
     RequestType.PROD_JSON:      'data/production.json',
-    RequestType.INVENTORY_JSON: 'data/inventory.json'
+    RequestType.INVENTORY_JSON: 'data/inventory.json',
+    RequestType.PROD_HTML:      'data/production_model_c_old.html'
 }
 
 
@@ -54,4 +59,119 @@ class TestEnvoyReaderFactory(TestCase):
         self.assertTrue(props.INVERTERS in data)
         self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_SEVEN_DAYS], 182847)
         self.assertEqual(data[props.PRODUCTION][props.ACTIVE_INVERTERS], 12)
-        self.assertEqual(data[props.INVERTERS][0][props.LAST_REPORT_DATE], 1589224854)
+        self.assertEqual(len(data[props.INVERTERS]), 12)
+        inverter = data[props.INVERTERS]['135286449995']
+        self.assertEqual(inverter[props.LAST_REPORT_DATE], 1589224854)
+        self.assertEqual(inverter[props.PCU_DEVICE_STATUS], ['envoy.global.ok'])
+
+    def testEnvoyReaderSProductionJson(self):
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.INFO] = 'data/info_model_c.xml'
+        self._server.set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        data = loop.run_until_complete(r.get_data())
+
+        self.assertTrue(r.use_production_json)
+        # The production meter is not active, the production is the one of the inverters and the energy is read
+        # from the production api
+        self.assertIn(r.PRODUCTION_API_URL, r.url_paths())
+        self.assertEqual(data[props.PRODUCTION][props.WATTS_NOW], 0)
+        self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_TODAY], 25179)
+        self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_SEVEN_DAYS], 182847)
+        self.assertEqual(data[props.PRODUCTION][props.WATT_HOURS_LIFETIME], 1289278)
+        self.assertNotIn(props.TOTAL_CONSUMPTION, data)
+
+    def testEnvoyReaderOldC(self):
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.INFO] = 'data/info_model_c_old.xml'
+        self._server.set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=self._server.server_port).get_reader())
+        data = loop.run_until_complete(r.get_data())
+
+        self.assertEqual(r.url_paths(), [r.PRODUCTION_URL])
+        self.assertEqual(data[props.SERIAL_NUMBER], '0000000000')
+        self.assertEqual(data[props.PRODUCTION], {
+            props.ACTIVE_INVERTERS: 11,
+            props.WATTS_NOW: 1230,
+            props.WATT_HOURS_TODAY: 4560,
+            props.WATT_HOURS_SEVEN_DAYS: 182000,
+            props.WATT_HOURS_LIFETIME: 12300000,
+        })
+        self.assertEqual(data[props.INVERTERS], {})
+        self.assertEqual(data[props.SECTION_STATUS][props.PRODUCTION][props.STATUS], props.FRESH)
+        self.assertFalse(data[props.UNCHANGED])
+
+        r.scheduler.invalidate()
+        self.assertTrue(loop.run_until_complete(r.get_data())[props.UNCHANGED])
+
+        # The production page is the only endpoint, a poll without it failed
+        del fm[RequestType.PROD_HTML]
+        r.scheduler.invalidate()
+        with self.assertRaises(EnvoyReaderEndpointError):
+            loop.run_until_complete(r.get_data())
+        loop.run_until_complete(r.close())
+
+    def testParseProductionHtml(self):
+        with open(os.path.join(os.path.dirname(__file__), 'data/production_model_c_old_night.html'), 'rb') as file:
+            data = EnvoyReaderOldC.parse_production_html(file.read())
+        self.assertEqual(data[props.ACTIVE_INVERTERS], 0)
+        self.assertEqual(data[props.WATTS_NOW], 0)
+        self.assertEqual(data[props.WATT_HOURS_TODAY], 812)
+        self.assertEqual(data[props.WATT_HOURS_SEVEN_DAYS], 27100)
+        self.assertEqual(data[props.WATT_HOURS_LIFETIME], 1020000)
+
+        with self.assertRaises(EnvoyReaderSchemaError):
+            EnvoyReaderOldC.parse_production_html(b"<html><body>Not found</body></html>")
+
+    def testDiscoveryCache(self):
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.INFO] = 'data/info_model_c.xml'
+        self._server.set_file_map(fm)
+
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = EnvoyReaderCache(os.path.join(tmp_dir, "discovery.json"))
+            f = EnvoyReaderFactory("localhost", port=self._server.server_port, cache=cache)
+            loop.run_until_complete(f.get_reader())
+            entry = loop.run_until_complete(cache.get(f.cache_key))
+            self.assertEqual(entry["firmware_version"], "R3.9.0")
+
+            # With a cached entry the reader is created without info.xml
+            del fm[RequestType.INFO]
+            f = EnvoyReaderFactory("localhost", port=self._server.server_port, cache=cache)
+            r = loop.run_until_complete(f.get_reader())
+            self.assertIsInstance(r, EnvoyReaderS)
+            self.assertTrue(r.use_production_json)
+            self.assertEqual(r.serial_number, '0000000000')
+            self.assertEqual(r.password, '0000')
+            loop.run_until_complete(f._background_probe)
+            self.assertFalse(f.reader_outdated)
+
+            # The background probe detects the firmware upgrade
+            fm[RequestType.INFO] = 'data/info_model_s.xml'
+            f = EnvoyReaderFactory("localhost", port=self._server.server_port, cache=cache)
+            r = loop.run_until_complete(f.get_reader())
+            self.assertTrue(r.use_production_json)
+            loop.run_until_complete(f._background_probe)
+            self.assertTrue(f.reader_outdated)
+            r = loop.run_until_complete(f.get_reader())
+            self.assertFalse(r.use_production_json)
+            entry = loop.run_until_complete(cache.get(f.cache_key))
+            self.assertEqual(entry["reader_type"], EnvoyReaderFactory.READER_S)
+
+            # Closing the factory cancels a probe that is still running
+            self._server.response_delays[RequestType.INFO] = 5
+            try:
+                f = EnvoyReaderFactory("localhost", port=self._server.server_port, cache=cache)
+                loop.run_until_complete(f.get_reader())
+                probe = f._background_probe
+                loop.run_until_complete(asyncio.sleep(0.1))
+                loop.run_until_complete(f.close())
+                self.assertTrue(probe.cancelled())
+                self.assertIsNone(f._background_probe)
+            finally:
+                del self._server.response_delays[RequestType.INFO]
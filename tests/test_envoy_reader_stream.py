@@ -0,0 +1,57 @@
+import asyncio
+from unittest import TestCase
+
+from envoy_local_reader.envoy_reader_stream import EnvoyMeterStream, MeterStreamParser
+from tests.mock_envoy import TestMockEnvoy
+
+import envoy_local_reader.property_names_const as props
+
+
+def meter_record(production_watts, consumption_watts):
+    return {
+        "production": {"ph-a": {"p": production_watts / 2, "q": 0, "v": 240}, "ph-b": {"p": production_watts / 2}},
+        "net-consumption": {"ph-a": {"p": (consumption_watts - production_watts) / 2},
+                            "ph-b": {"p": (consumption_watts - production_watts) / 2}},
+        "total-consumption": {"ph-a": {"p": consumption_watts / 2}, "ph-b": {"p": consumption_watts / 2}},
+    }
+
+
+class TestEnvoyMeterStream(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._server = TestMockEnvoy(digest_credentials=("installer", "secret"))
+
+    def testParser(self):
+        parser = MeterStreamParser()
+        self.assertEqual(parser.feed(b'data: {"production": {"ph-a": {"p": 1'), [])
+        records = parser.feed(b'00}, "ph-b": {"p": 50}}}\r\n\r\ndata: {}\r\n')
+        self.assertEqual(len(records), 2)
+
+        data = MeterStreamParser.to_snapshot(records[0])
+        self.assertEqual(data[props.PRODUCTION][props.WATTS_NOW], 150)
+        self.assertEqual(data[props.PRODUCTION][props.PHASES], {"ph-a": 100, "ph-b": 50})
+        self.assertNotIn(props.NET_CONSUMPTION, data)
+
+    def testStreamCoalescingAndReconnect(self):
+        self._server.stream_records = [meter_record(1000 + i, 500) for i in range(10)]
+        self._server.stream_interval = 0.02
+        self._server.reset_counters()
+
+        updates = []
+        loop = asyncio.get_event_loop()
+        stream = EnvoyMeterStream("localhost", port=self._server.server_port, username="installer",
+                                  password="secret", callback=updates.append, min_update_interval=0.1,
+                                  reconnect_delay=0.05)
+        stream.start()
+        loop.run_until_complete(asyncio.sleep(0.5))
+        loop.run_until_complete(stream.stop())
+
+        # The records arrive every 20 ms, the updates are throttled to one per 100 ms
+        self.assertGreaterEqual(stream.record_count, 10)
+        self.assertLess(len(updates), stream.record_count)
+        self.assertEqual(updates[0][props.PRODUCTION][props.WATTS_NOW], 1000)
+        self.assertEqual(updates[0][props.NET_CONSUMPTION][props.WATTS_NOW], -500)
+        # The stream is opened again after the Envoy closed it
+        self.assertGreaterEqual(stream.connect_count, 2)
+        # The values of a closed stream are not kept
+        self.assertIsNone(stream.latest)
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import pickle
+from unittest import TestCase
+
+from envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
+from envoy_local_reader.envoy_reader_model_s import EnvoyReaderS
+from envoy_local_reader.envoy_snapshot import ProductionData, InverterData, snapshot_to_dict, snapshot_from_dict
+from tests import synthetic_envoy
+from tests.mock_envoy import TestMockEnvoy
+from tests.test_envoy_reader_factory import DEFAULT_FILE_MAP
+
+import envoy_local_reader.property_names_const as props
+
+
+def inverter(serial_number="121", watts=100):
+    return InverterData(serial_number, 1589224854, 1, watts, 250, True, True, ['envoy.global.ok'])
+
+
+class TestEnvoySnapshot(TestCase):
+    def testMapping(self):
+        data = inverter()
+        self.assertEqual(data[props.LAST_REPORT_WATTS], 100)
+        self.assertEqual(data.last_report_watts, 100)
+        self.assertEqual(data.get(props.PCU_PRODUCING), True)
+        self.assertIsNone(data.get("unknown"))
+        self.assertNotIn("unknown", data)
+        self.assertEqual(list(data.keys()), list(InverterData.FIELDS))
+        self.assertEqual(len(data), len(InverterData.FIELDS))
+        with self.assertRaises(KeyError):
+            data[0]
+
+    def testOptionalFields(self):
+        data = ProductionData.from_dict({props.WATTS_NOW: 10, props.WATT_HOURS_TODAY: 20,
+                                         props.WATT_HOURS_SEVEN_DAYS: 30, props.WATT_HOURS_LIFETIME: 40})
+        self.assertNotIn(props.ACTIVE_INVERTERS, data)
+        self.assertNotIn(props.PHASES, data)
+        self.assertEqual(len(data), 4)
+        with self.assertRaises(KeyError):
+            data[props.PHASES]
+
+        data = data._replace(active_inverters=12)
+        self.assertEqual(data[props.ACTIVE_INVERTERS], 12)
+        self.assertEqual(data.watts_now, 10)
+
+    def testEquality(self):
+        data = inverter()
+        self.assertEqual(data, inverter())
+        self.assertNotEqual(data, inverter(watts=101))
+        self.assertEqual(data, data.as_dict())
+        self.assertEqual(data.as_dict(), data)
+        self.assertNotEqual(data, tuple(data.as_dict().values()))
+
+    def testImmutable(self):
+        data = inverter()
+        with self.assertRaises(AttributeError):
+            data.last_report_watts = 0
+        with self.assertRaises(TypeError):
+            data[props.LAST_REPORT_WATTS] = 0
+        with self.assertRaises(AttributeError):
+            data.extra = 0
+        self.assertNotIsInstance(data, tuple)
+        with self.assertRaises(TypeError):
+            InverterData("121")
+
+    def testSerialization(self):
+        data = inverter()
+        self.assertEqual(pickle.loads(pickle.dumps(data)), data)
+        self.assertIsInstance(pickle.loads(pickle.dumps(data)), InverterData)
+        # json can not write a record, as_dict keeps the field names
+        with self.assertRaises(TypeError):
+            json.dumps(data)
+        self.assertEqual(json.loads(json.dumps(data.as_dict())), data)
+
+    def testStoredSnapshot(self):
+        data = {
+            props.SERIAL_NUMBER: "0000000000",
+            props.PRODUCTION: ProductionData(1000, 2000, 3000, 4000, 2),
+            # A section of the meter stream, without energy values
+            props.NET_CONSUMPTION: {props.WATTS_NOW: -500, props.PHASES: {"ph-a": -250, "ph-b": -250}},
+            props.INVERTERS: {"121": inverter("121"), "122": inverter("122", watts=0)},
+            props.UNCHANGED: True,
+        }
+        # The storage of Home Assistant writes json
+        stored = json.loads(json.dumps(snapshot_to_dict(data, now=1000)))
+        restored = snapshot_from_dict(stored, now=1060)
+
+        self.assertEqual(restored[props.SERIAL_NUMBER], "0000000000")
+        self.assertEqual(restored[props.PRODUCTION], data[props.PRODUCTION])
+        self.assertEqual(restored[props.INVERTERS], data[props.INVERTERS])
+        self.assertIsInstance(restored[props.INVERTERS]["121"], InverterData)
+        self.assertEqual(restored[props.NET_CONSUMPTION].watts_now, -500)
+        self.assertIsNone(restored[props.NET_CONSUMPTION].watt_hours_today)
+        self.assertEqual(restored[props.NET_CONSUMPTION][props.PHASES], {"ph-a": -250, "ph-b": -250})
+        self.assertNotIn(props.TOTAL_CONSUMPTION, restored)
+        self.assertFalse(restored[props.UNCHANGED])
+        self.assertEqual(restored[props.SECTION_STATUS][props.INVERTERS], {props.STATUS: props.STALE, props.AGE: 60})
+        self.assertEqual(set(restored[props.SECTION_STATUS]),
+                         {props.INVERTERS, props.PRODUCTION, props.NET_CONSUMPTION})
+
+    def testReaderRecords(self):
+        server = TestMockEnvoy()
+        server.set_file_map(DEFAULT_FILE_MAP.copy())
+
+        loop = asyncio.get_event_loop()
+        r = loop.run_until_complete(EnvoyReaderFactory("localhost", port=server.server_port).get_reader())
+        data = loop.run_until_complete(r.get_data())
+
+        self.assertIsInstance(data[props.PRODUCTION], ProductionData)
+        self.assertEqual(data[props.PRODUCTION].active_inverters, 12)
+        for serial_number, record in data[props.INVERTERS].items():
+            self.assertIsInstance(record, InverterData)
+            self.assertEqual(record.serial_number, serial_number)
+
+    def testReusedRecords(self):
+        build_inverters = EnvoyReaderS._EnvoyReaderS__process_inverter_json
+        serial_numbers = synthetic_envoy.inverter_serial_numbers(3)
+        raw_inventory = json.loads(synthetic_envoy.inventory_json(serial_numbers))
+        raw_inverters = json.loads(synthetic_envoy.inverters_json(serial_numbers))
+        previous = build_inverters(raw_inverters, raw_inventory)
+
+        # Only the inverter with a new report gets a new record
+        raw_inverters[0] = dict(raw_inverters[0], lastReportDate=raw_inverters[0]['lastReportDate'] + 300)
+        inverters = build_inverters(raw_inverters, raw_inventory, previous)
+        self.assertIsNot(inverters[serial_numbers[0]], previous[serial_numbers[0]])
+        self.assertEqual(inverters[serial_numbers[0]].last_report_date, raw_inverters[0]['lastReportDate'])
+        self.assertIs(inverters[serial_numbers[1]], previous[serial_numbers[1]])
+        self.assertIs(inverters[serial_numbers[2]], previous[serial_numbers[2]])
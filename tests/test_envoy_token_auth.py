@@ -0,0 +1,188 @@
+import asyncio
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import httpx
+
+from envoy_local_reader.envoy_fleet import EnvoyFleet
+from envoy_local_reader.envoy_reader_cache import EnvoyReaderCache
+from envoy_local_reader.envoy_reader_exception import EnvoyReaderAuthError
+from envoy_local_reader.envoy_reader_factory import EnvoyReaderFactory
+from envoy_local_reader.envoy_token_auth import EnvoyTokenAuth
+from tests.mock_envoy import TestMockEnvoy, RequestType
+from tests.test_envoy_reader_factory import DEFAULT_FILE_MAP
+
+import envoy_local_reader.property_names_const as props
+
+TOKEN_CREDENTIALS = ("owner@example.com", "secret")
+
+
+class TestEnvoyTokenAuth(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Like newer firmware the pages are served over https with a self-signed certificate
+        cls._server = TestMockEnvoy(token_credentials=TOKEN_CREDENTIALS, https=True)
+
+    def setUp(self):
+        fm = DEFAULT_FILE_MAP.copy()
+        fm[RequestType.INFO] = 'data/info_model_s_d7.xml'
+        self._server.set_file_map(fm)
+        self._server.token_lifetime = 86400
+        self._server.redirect_to_https = False
+        self._server.revoke_tokens()
+        self._server.reset_counters()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._token_cache = EnvoyReaderCache(os.path.join(self._tmp_dir.name, "tokens.json"))
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def get_reader(self, **kwargs):
+        factory = EnvoyReaderFactory("localhost", port=self._server.server_port, username=TOKEN_CREDENTIALS[0],
+                                     password=TOKEN_CREDENTIALS[1], token_cache=self._token_cache,
+                                     login_url=self._server.login_url, token_url=self._server.token_url,
+                                     https_port=self._server.https_port, **kwargs)
+        return asyncio.get_event_loop().run_until_complete(factory.get_reader())
+
+    def testTokenExpiry(self):
+        self.assertEqual(EnvoyTokenAuth.token_expiry(self._server.issue_token("0000000000")),
+                         self._server.tokens[max(self._server.tokens, key=self._server.tokens.get)])
+        self.assertIsNone(EnvoyTokenAuth.token_expiry("not a jwt"))
+
+    def testTokenReusedAcrossPolls(self):
+        loop = asyncio.get_event_loop()
+        r = self.get_reader()
+        self.assertIsNotNone(r.token_auth)
+
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(len(data[props.INVERTERS]), 12)
+        self.assertEqual(self._server.token_count, 1)
+        self.assertEqual(self._server.jwt_check_count, 1)
+        self.assertIsNotNone(r.token_auth.session_id)
+
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        # The session cookie is reused, the token is neither fetched nor checked again
+        self.assertEqual(self._server.token_count, 1)
+        self.assertEqual(self._server.jwt_check_count, 1)
+        loop.run_until_complete(r.close())
+
+    def testHttps(self):
+        loop = asyncio.get_event_loop()
+        # The http pages redirect to https, info.xml is read over https as well
+        self._server.redirect_to_https = True
+        r = self.get_reader()
+        self.assertEqual(r.scheme, "https")
+        self.assertEqual(r.port, self._server.https_port)
+        data = loop.run_until_complete(r.get_data())
+        self.assertEqual(data[props.SERIAL_NUMBER], '0000000000')
+        self.assertEqual(len(data[props.INVERTERS]), 12)
+        self.assertEqual(r.token_auth.port, self._server.https_port)
+        loop.run_until_complete(r.close())
+
+        # Digest auth keeps http
+        self._server.redirect_to_https = False
+        r = self.get_reader(auth_mode=EnvoyReaderFactory.AUTH_DIGEST)
+        self.assertEqual(r.scheme, "http")
+        self.assertEqual(r.port, self._server.server_port)
+        # Only the sessions of the https pages of the Envoy skip the verification of the certificate
+        with self.assertRaises(httpx.HTTPError):
+            loop.run_until_complete(r.session.get("https://localhost:{}/info.xml".format(self._server.https_port)))
+        loop.run_until_complete(r.close())
+
+    def testFleetHttps(self):
+        loop = asyncio.get_event_loop()
+        self._server.redirect_to_https = True
+        fleet = EnvoyFleet(["localhost:{}".format(self._server.server_port)], username=TOKEN_CREDENTIALS[0],
+                           password=TOKEN_CREDENTIALS[1], token_cache=self._token_cache,
+                           login_url=self._server.login_url, token_url=self._server.token_url,
+                           https_port=self._server.https_port)
+        results = loop.run_until_complete(fleet.get_data())
+        result = next(iter(results.values()))
+        self.assertTrue(result.success)
+        self.assertEqual(len(result.data[props.INVERTERS]), 12)
+        # The shared session of the fleet verifies certificates
+        with self.assertRaises(httpx.HTTPError):
+            loop.run_until_complete(fleet.session.get("https://localhost:{}/info.xml"
+                                                      .format(self._server.https_port)))
+        loop.run_until_complete(fleet.close())
+
+    def testTokenReusedAcrossRestarts(self):
+        loop = asyncio.get_event_loop()
+        r = self.get_reader()
+        loop.run_until_complete(r.get_data())
+        loop.run_until_complete(r.close())
+
+        r = self.get_reader()
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.login_count, 1)
+        self.assertEqual(self._server.jwt_check_count, 1)
+        loop.run_until_complete(r.close())
+
+    def testProactiveRefresh(self):
+        loop = asyncio.get_event_loop()
+        r = self.get_reader()
+        loop.run_until_complete(r.get_data())
+        token = r.token_auth.token
+
+        # Within refresh_margin of the expiry a new token is fetched before the poll, without a rejected request
+        r.token_auth.clock = lambda: time.time() + 86400 - r.token_auth.refresh_margin / 2
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        self.assertNotEqual(r.token_auth.token, token)
+        self.assertEqual(self._server.token_count, 2)
+        self.assertEqual(r.metrics.errors(), 0)
+        loop.run_until_complete(r.close())
+
+    def testRenewOnceOnRejectedRequest(self):
+        loop = asyncio.get_event_loop()
+        r = self.get_reader()
+        loop.run_until_complete(r.get_data())
+
+        # A restarted Envoy forgets its sessions, the token is still valid
+        self._server.expire_sessions()
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.token_count, 1)
+        self.assertEqual(self._server.jwt_check_count, 2)
+
+        # An expired token is replaced once for all concurrently rejected requests
+        self._server.token_lifetime = 0.2
+        self._server.revoke_tokens()
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.token_count, 2)
+        self.assertEqual(r.metrics.errors(), 0)
+
+        # Without refresh margin the expired token is only noticed by the rejected request
+        r.token_auth.refresh_margin = 0
+        time.sleep(0.3)
+        r.scheduler.invalidate()
+        loop.run_until_complete(r.get_data())
+        self.assertEqual(self._server.token_count, 3)
+        loop.run_until_complete(r.close())
+
+    def testRejectedCredentials(self):
+        loop = asyncio.get_event_loop()
+        factory = EnvoyReaderFactory("localhost", port=self._server.server_port, username=TOKEN_CREDENTIALS[0],
+                                     password="wrong", login_url=self._server.login_url,
+                                     token_url=self._server.token_url, https_port=self._server.https_port)
+        r = loop.run_until_complete(factory.get_reader())
+        with self.assertRaises(EnvoyReaderAuthError):
+            loop.run_until_complete(r.get_data())
+        loop.run_until_complete(r.close())
+
+        # Token auth needs the Enlighten credentials, the serial number is no password
+        factory = EnvoyReaderFactory("localhost", port=self._server.server_port)
+        with self.assertRaises(EnvoyReaderAuthError):
+            loop.run_until_complete(factory.get_reader())
+
+    def testAuthMode(self):
+        self.assertIsNone(self.get_reader(auth_mode=EnvoyReaderFactory.AUTH_DIGEST).token_auth)
+
+        fm = DEFAULT_FILE_MAP.copy()
+        self._server.set_file_map(fm)
+        self.assertIsNone(self.get_reader().token_auth)
+        self.assertIsNotNone(self.get_reader(auth_mode=EnvoyReaderFactory.AUTH_TOKEN).token_auth)
@@ -0,0 +1,68 @@
+import json
+from unittest import TestCase
+
+from envoy_local_reader.envoy_reader_model_s import EnvoyReaderS
+from envoy_local_reader.inverter_health import InverterHealth, InverterHealthReport
+from tests import synthetic_envoy
+
+
+def inverter(watts, max_watts=290, report_date=1000):
+    return {'last_report_watts': watts, 'max_report_watts': max_watts, 'last_report_date': report_date}
+
+
+class TestInverterHealth(TestCase):
+    def testPeerRatio(self):
+        inverters = {str(n): inverter(200) for n in range(10)}
+        inverters['low'] = inverter(50)
+        # Peers of a different size are compared with each other only
+        inverters['big1'] = inverter(300, max_watts=366)
+        inverters['big2'] = inverter(320, max_watts=366)
+        inverters['big3'] = inverter(310, max_watts=366)
+
+        report = InverterHealth().analyze(inverters)
+        self.assertEqual(report.inverter('0')['peer_ratio'], 1.0)
+        self.assertEqual(report.inverter('low')['peer_ratio'], 0.25)
+        self.assertTrue(report.inverter('low')['underperforming'])
+        self.assertTrue(report.inverter('low')['outlier'])
+        self.assertEqual(report.inverter('big1')['peer_ratio'], round(300 / 310, 3))
+        self.assertFalse(report.inverter('big1')['underperforming'])
+        self.assertFalse(report.inverter('big1')['outlier'])
+        self.assertIsNone(report.inverter('unknown'))
+
+        self.assertEqual(report.summary['inverter_count'], 14)
+        self.assertEqual(report.summary['underperforming'], 1)
+        self.assertEqual(report.summary['outlier'], 1)
+        self.assertEqual(report.summary['stale'], 0)
+        self.assertEqual(report.flagged(InverterHealthReport.UNDERPERFORMING_FLAG), ['low'])
+
+    def testNight(self):
+        # Nothing is flagged when the peers do not produce
+        inverters = {str(n): inverter(n % 2) for n in range(10)}
+        report = InverterHealth().analyze(inverters)
+        self.assertEqual(report.summary['underperforming'], 0)
+        self.assertEqual(report.summary['outlier'], 0)
+
+    def testStale(self):
+        inverters = {str(n): inverter(200, report_date=10000 + n) for n in range(10)}
+        inverters['stuck'] = inverter(200, report_date=10000 - 3600)
+        report = InverterHealth().analyze(inverters)
+        self.assertEqual(report.flagged(InverterHealthReport.STALE_FLAG), ['stuck'])
+
+        # The stuck inverter did not change, but its flags changed with the readings of the others
+        previous = InverterHealth().analyze(dict(inverters, stuck=inverter(200, report_date=10000)))
+        self.assertEqual(report.changed_flags(previous), {'stuck'})
+        self.assertEqual(report.changed_flags(None), set(inverters))
+
+    def testEmpty(self):
+        report = InverterHealth().analyze({})
+        self.assertEqual(report.summary['inverter_count'], 0)
+        self.assertEqual(report.flagged(InverterHealthReport.STALE_FLAG), [])
+
+    def testSyntheticSite(self):
+        serial_numbers = synthetic_envoy.inverter_serial_numbers(1000)
+        inverters = EnvoyReaderS._EnvoyReaderS__process_inverter_json(
+            json.loads(synthetic_envoy.inverters_json(serial_numbers)),
+            json.loads(synthetic_envoy.inventory_json(serial_numbers)))
+        report = InverterHealth().analyze(inverters)
+        self.assertEqual(report.summary['inverter_count'], 1000)
+        self.assertEqual(report.summary['stale'], 0)
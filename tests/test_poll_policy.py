@@ -0,0 +1,71 @@
+from unittest import TestCase
+
+from envoy_local_reader.envoy_reader_exception import EnvoyReaderError
+from envoy_local_reader.poll_policy import AdaptivePollPolicy
+
+
+def snapshot(watts_now, producing=True):
+    return {'production': {'watts_now': watts_now},
+            'inverters': {'1': {'producing': producing}, '2': {'producing': producing}}}
+
+
+class TestAdaptivePollPolicy(TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.policy = AdaptivePollPolicy(15, idle_interval=300, idle_delay=900, max_backoff_interval=600,
+                                         jitter=0, clock=lambda: self.now[0])
+
+    def testDayAndNight(self):
+        self.assertEqual(self.policy.next_interval(snapshot(1000)), 15)
+
+        # Production stopped, the interval only grows after idle_delay
+        self.now[0] = 100
+        self.assertEqual(self.policy.next_interval(snapshot(0)), 15)
+        self.now[0] = 1000
+        self.assertEqual(self.policy.next_interval(snapshot(0)), 300)
+        self.assertTrue(self.policy.idle)
+        # Wake up in time for sunrise
+        self.assertEqual(self.policy.next_interval(snapshot(0), seconds_until_sunrise=120), 120)
+        self.assertEqual(self.policy.next_interval(snapshot(0), seconds_until_sunrise=0), 15)
+
+        # Dawn
+        self.now[0] = 2000
+        self.assertEqual(self.policy.next_interval(snapshot(5)), 15)
+        self.assertFalse(self.policy.idle)
+
+    def testInvertersNotProducing(self):
+        # Without a production the inventory decides
+        self.policy.next_interval(snapshot(None, producing=False))
+        self.now[0] = 900
+        self.assertEqual(self.policy.next_interval(snapshot(None, producing=False)), 300)
+        # Unknown producing state of the inventory does not count as idle
+        self.assertTrue(AdaptivePollPolicy.is_producing(snapshot(None, producing=None)))
+
+    def testDawnWithNightInventory(self):
+        self.policy.next_interval(snapshot(0, producing=False))
+        self.now[0] = 1000
+        self.assertEqual(self.policy.next_interval(snapshot(0, producing=False)), 300)
+        # The hourly inventory still has the state of the night, the production wins
+        self.assertEqual(self.policy.next_interval(snapshot(40, producing=False)), 15)
+        self.assertFalse(self.policy.idle)
+
+    def testMeteredNight(self):
+        # A production meter reports a slightly negative production at night
+        self.assertFalse(AdaptivePollPolicy.is_producing(snapshot(-0.216)))
+        self.assertFalse(AdaptivePollPolicy.is_producing(snapshot(AdaptivePollPolicy.IDLE_WATTS)))
+        self.policy.next_interval(snapshot(-0.216))
+        self.now[0] = 1000
+        self.assertEqual(self.policy.next_interval(snapshot(-0.216)), 300)
+
+    def testFailureBackoff(self):
+        error = EnvoyReaderError("Cannot connect")
+        self.assertEqual([self.policy.next_interval(error=error) for _ in range(7)], [30, 60, 120, 240, 480, 600, 600])
+        self.assertEqual(self.policy.failures, 7)
+        self.assertEqual(self.policy.next_interval(snapshot(1000)), 15)
+        self.assertEqual(self.policy.failures, 0)
+
+    def testJitter(self):
+        policy = AdaptivePollPolicy(15, jitter=0.2)
+        for _ in range(20):
+            policy.failures = 0
+            self.assertTrue(24 <= policy.next_interval(error=EnvoyReaderError("timeout")) <= 36)
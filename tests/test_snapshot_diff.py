@@ -0,0 +1,14 @@
+from unittest import TestCase
+
+from envoy_local_reader.snapshot_diff import changed_keys
+
+
+class TestSnapshotDiff(TestCase):
+    def testChangedKeys(self):
+        inverters = {'1': {'last_report_watts': 10}, '2': {'last_report_watts': 20}}
+        self.assertEqual(changed_keys(inverters, inverters), set())
+        self.assertEqual(changed_keys(None, inverters), {'1', '2'})
+
+        new_inverters = {'1': {'last_report_watts': 10}, '2': {'last_report_watts': 21}, '3': {'last_report_watts': 0}}
+        self.assertEqual(changed_keys(inverters, new_inverters), {'2', '3'})
+        self.assertEqual(changed_keys(new_inverters, inverters), {'2', '3'})